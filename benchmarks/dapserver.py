@@ -0,0 +1,235 @@
+"""
+A local OPeNDAP server with synthetic model runs, laid out like NOMADS.
+
+Every run of the model has the same fields: surface fields of (time, lat, lon) and pressure fields of
+(time, lev, lat, lon), filled with smooth values that are computed when they're asked for, so a large
+grid costs no memory. The listings of days and runs are served at the same urls as on NOMADS, so
+RunDiscovery finds the runs:
+
+    /dods/{model}                                  days
+    /dods/{model}/{model}{date}                    runs of a day
+    /dods/{model}/{model}{date}/{model}_{hour}z    a run (.dds, .das, .dods)
+
+Usage:
+server = DapServer('nam', nlat=200, nlon=400, ntime=12, nlev=8, days=2)
+server.start()
+m = Model('nam')
+m.setserver(server.url)
+...
+server.stop()
+
+or on its own:
+python benchmarks/dapserver.py --port 8001 --nlat 200 --nlon 400
+"""
+
+import argparse
+import re
+import threading
+from datetime import datetime, timedelta
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+import SocketServer
+
+import numpy as np
+from pydap.model import DatasetType, GridType, BaseType, Float32, Float64
+from pydap.handlers.lib import SimpleHandler
+
+SURFACE = ['tmp2m', 'ugrd10m', 'vgrd10m', 'pressfc', 'tmpsfc']
+PRESSURE = ['tmpprs', 'ugrdprs', 'vgrdprs', 'hgtprs']
+
+class SyntheticArray:
+    """
+    A read-only array whose values are computed from their indices when they're sliced
+    """
+
+    def __init__(self, shape, seed):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype('f4')
+        self.seed = seed
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),)*(len(self.shape) - len(index))
+        axes = []
+        for i, (s, n) in enumerate(zip(index, self.shape)):
+            if isinstance(s, slice):
+                axes.append(np.arange(n)[s])
+            else:
+                axes.append(np.array([s % n]))
+        grids = np.ix_(*axes)
+        values = np.zeros([len(a) for a in axes], dtype='f4')
+        values += 280. + self.seed
+        # time, (lev,) lat, lon
+        values += 0.1*grids[0]
+        values += 20*np.sin(grids[-2]/17.)*np.cos(grids[-1]/23.)
+        if len(grids) == 4:
+            values -= 0.5*grids[1]
+        squeeze = tuple([i for i, s in enumerate(index) if not isinstance(s, slice)])
+        if len(squeeze) > 0:
+            values = values.squeeze(axis=squeeze)
+        return values
+
+    def __array__(self, dtype=None):
+        return self[(slice(None),)*len(self.shape)]
+
+def dataset(name, datatime, nlat, nlon, ntime, nlev):
+    """
+    The synthetic run of a model at datatime, as a pydap dataset
+    """
+
+    # days since 0001-01-01 (plus one), as NOMADS sends them
+    start = datatime.toordinal() + 1 + datatime.hour/24.
+    axes = {'time': np.array([start + it/8. for it in range(ntime)]),
+            'lev': np.linspace(1000., 100., nlev),
+            'lat': np.linspace(20., 55., nlat),
+            'lon': np.linspace(230., 300., nlon)}
+
+    ds = DatasetType(name)
+    for seed, field in enumerate(SURFACE + PRESSURE):
+        dims = ('time', 'lev', 'lat', 'lon') if field in PRESSURE else ('time', 'lat', 'lon')
+        shape = tuple([len(axes[d]) for d in dims])
+        g = GridType(name=field)
+        g[field] = BaseType(name=field, data=SyntheticArray(shape, seed), shape=shape, dimensions=dims, type=Float32)
+        for d in dims:
+            g[d] = BaseType(name=d, data=axes[d], shape=axes[d].shape, type=Float64)
+        ds[field] = g
+    return ds
+
+class _Handler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class DapServer:
+    """
+    DAPSERVER serves synthetic runs of a model, see the top of this file
+    """
+
+    modelname = 'nam'
+    nlat = 100
+    nlon = 200
+    ntime = 12
+    nlev = 8
+
+    # number of days of runs, ending with the latest run due by now, and the hours of the runs of each day
+    days = 2
+    hours = [0, 6, 12, 18]
+
+    def __init__(self, modelname=None, nlat=None, nlon=None, ntime=None, nlev=None, days=None, hours=None):
+        if modelname != None:
+            self.modelname = modelname
+        if nlat != None:
+            self.nlat = nlat
+        if nlon != None:
+            self.nlon = nlon
+        if ntime != None:
+            self.ntime = ntime
+        if nlev != None:
+            self.nlev = nlev
+        if days != None:
+            self.days = days
+        if hours != None:
+            self.hours = hours
+        self.server = None
+        self.url = None
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def runs(self):
+        """
+        RUNS returns the datatimes of the runs served, oldest first
+        """
+
+        runs = []
+        datatime = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        while len(runs) < self.days*len(self.hours):
+            if datatime.hour in self.hours:
+                runs.append(datatime)
+            datatime = datatime - timedelta(hours=1)
+        return sorted(runs)
+
+    def start(self, port=0, host='127.0.0.1'):
+        """
+        START serving from a background thread. The base url (http://host:port/dods) is in self.url.
+        """
+
+        self.server = make_server(host, port, self, server_class=_Server, handler_class=_Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://%s:%d/dods' % (host, self.server.server_address[1])
+        return self.url
+
+    def stop(self):
+        """
+        STOP serving
+        """
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        with self.lock:
+            self.requests.append(path)
+        m = self.modelname
+        runs = self.runs()
+
+        if path.rstrip('/') == '/dods/%s' % m:
+            days = sorted(set([r.strftime('%Y%m%d') for r in runs]))
+            return self._html(start_response, ' '.join(['<a href="%s/%s%s">%s%s</a>' % (self.url, m, d, m, d) for d in days]))
+
+        match = re.match('^/dods/%s/%s(\d{8})/?$' % (m, m), path)
+        if match:
+            hours = [r.hour for r in runs if r.strftime('%Y%m%d') == match.group(1)]
+            if len(hours) == 0:
+                return self._notfound(start_response)
+            return self._html(start_response, ' '.join(['<b>%s_%02dz:</b>' % (m, h) for h in hours]))
+
+        match = re.match('^/dods/%s/%s(\d{8})/%s_(\d\d)z\.(dds|das|dods)$' % (m, m, m), path)
+        if match:
+            datatime = datetime.strptime(match.group(1) + match.group(2), '%Y%m%d%H')
+            if datatime not in runs:
+                return self._notfound(start_response)
+            ds = dataset('%s_%sz' % (m, match.group(2)), datatime, self.nlat, self.nlon, self.ntime, self.nlev)
+            environ = dict(environ)
+            environ['PATH_INFO'] = '/run.' + match.group(3)
+            return SimpleHandler(ds)(environ, start_response)
+
+        return self._notfound(start_response)
+
+    def _html(self, start_response, body):
+        start_response('200 OK', [('Content-Type', 'text/html'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _notfound(self, start_response):
+        body = 'not found'
+        start_response('404 Not Found', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+        return [body]
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic model runs over OPeNDAP')
+    parser.add_argument('--model', default='nam')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--nlat', type=int, default=DapServer.nlat)
+    parser.add_argument('--nlon', type=int, default=DapServer.nlon)
+    parser.add_argument('--ntime', type=int, default=DapServer.ntime)
+    parser.add_argument('--nlev', type=int, default=DapServer.nlev)
+    parser.add_argument('--days', type=int, default=DapServer.days)
+    args = parser.parse_args()
+
+    server = DapServer(args.model, args.nlat, args.nlon, args.ntime, args.nlev, args.days)
+    print 'Serving %s at %s' % (args.model, server.start(args.port))
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
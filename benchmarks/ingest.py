@@ -0,0 +1,177 @@
+"""
+Measure the ingest of model runs, without depending on NOMADS.
+
+A local OPeNDAP server (see dapserver.py) serves synthetic runs laid out like NOMADS, and each scenario
+transfers a fresh run of it into a scratch database with Model.transfer, the way the daemon does:
+
+    setupgrid     writing the grid into the database and reading the gridpointids back
+    full          a surface field over the whole grid
+    pressure      a pressure field over the whole grid, every fourth level
+    bbox          a surface field in a bounding box
+    knn           a surface field at a handful of points and their neighbours
+    calculated    two fields and a calculated field computed as they come in
+    calculated-database
+                  the same, with a calculation left to the database
+
+For each scenario the wall time, the values written, the bytes and requests sent to the server and the
+time spent in each stage of the transfer are reported, from the metrics of the run (see forecasting/metrics.py).
+With --repeat, each scenario runs several times and the median is reported.
+
+Usage:
+python benchmarks/ingest.py --database bench [--nlat 200 --nlon 400 --ntime 12 --nlev 8 --repeat 3] [--out results.json]
+
+The database is created if needed and has to have PostGIS available. Results are printed as json.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from dapserver import DapServer
+from forecasting import metrics
+from forecasting.model import Model
+
+WIND = 'sqrt(ugrd10m^2+vgrd10m^2)'
+
+# (name, fields, geos, pressure, calculated fields)
+SCENARIOS = [
+    ('full', ['tmp2m'], None, {'min': 100, 'max': 1000}, []),
+    ('pressure', ['tmpprs'], None, {'min': 100, 'max': 1000}, []),
+    ('bbox', ['tmp2m'], {'n': 45., 's': 30., 'e': 270., 'w': 250.}, {'min': 100, 'max': 1000}, []),
+    ('knn', ['tmp2m'], [{'lat': 39.97, 'lon': 254.86, 'k': 4}, {'lat': 40.71, 'lon': 285.99, 'k': 4}, {'lat': 29.76, 'lon': 264.63, 'k': 4}], {'min': 100, 'max': 1000}, []),
+    ('calculated', ['ugrd10m', 'vgrd10m'], None, {'min': 100, 'max': 1000}, [('wnd10m', WIND)]),
+    ('calculated-database', ['ugrd10m', 'vgrd10m'], None, {'min': 100, 'max': 1000}, [('wnd10m', 'case when ugrd10m > vgrd10m then ugrd10m else vgrd10m end')]),
+]
+
+def snapshot(model, host):
+    """
+    The metrics a scenario is measured by
+    """
+    stages = {}
+    for stage in ('fetch', 'encode', 'copy'):
+        stages[stage] = metrics.counter('forecasting_stage_seconds_total').get(model=model, stage=stage)
+    return {'values': metrics.counter('forecasting_rows_sent_total').get(storage='rows'),
+            'bytes': metrics.counter('forecasting_http_bytes_total').get(host=host),
+            'requests': sum([metrics.counter('forecasting_http_requests_total').get(host=host, status=status) for status in (200, 404)]),
+            'stages': stages}
+
+def transfer(m, host, run, fields, geos, pressure, calcs):
+    """
+    Time the transfer of a run, and measure what went into it
+    """
+    m.calcfields = []
+    for name, calculation in calcs:
+        m.addcalculatedfield(name, fields, calculation)
+
+    before = snapshot(m.modelname, host)
+    starttime = time.time()
+    m.transfer(fields, run, geos=geos, pressure=pressure)
+    seconds = time.time() - starttime
+    after = snapshot(m.modelname, host)
+
+    return {'seconds': seconds,
+            'values': after['values'] - before['values'],
+            'bytes': after['bytes'] - before['bytes'],
+            'requests': after['requests'] - before['requests'],
+            'stages': dict([(stage, after['stages'][stage] - before['stages'][stage]) for stage in after['stages']])}
+
+def setupgrid(m, server):
+    """
+    Time writing the grid of a new model into the database, and reading the gridpointids back
+    """
+    lat = np.linspace(20., 55., server.nlat)
+    lon = np.linspace(230., 300., server.nlon)
+    m.database.cachemodelid('%sgrid%d' % (m.modelname, int(time.time()*1000) % 1000000))
+    starttime = time.time()
+    m.database.setupgrid(lat, lon)
+    m.database.retrievegridids()
+    seconds = time.time() - starttime
+    m.database.curs.execute('delete from gridpoints where modelid = %s', (m.database.dbmodelid,))
+    m.database.conn.commit()
+    m.database.cachemodelid(m.modelname)
+    return {'seconds': seconds, 'values': server.nlat*server.nlon}
+
+def median(results):
+    """
+    The median of each measurement of repeated results
+    """
+    if len(results) == 1:
+        return results[0]
+    merged = {}
+    for key in results[0]:
+        if isinstance(results[0][key], dict):
+            merged[key] = median([r[key] for r in results])
+        else:
+            merged[key] = float(np.median([r[key] for r in results]))
+    return merged
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the ingest of synthetic model runs from a local OPeNDAP server')
+    parser.add_argument('--database', default='forecastingbench')
+    parser.add_argument('--model', default='nam')
+    parser.add_argument('--nlat', type=int, default=200)
+    parser.add_argument('--nlon', type=int, default=400)
+    parser.add_argument('--ntime', type=int, default=12)
+    parser.add_argument('--nlev', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--scenarios', default=','.join(['setupgrid'] + [s[0] for s in SCENARIOS]))
+    parser.add_argument('--out', help='also write the results to this file')
+    args = parser.parse_args()
+
+    os.system("echo 'create database %s;' | psql postgres > /dev/null 2>&1" % args.database)
+    os.system("echo 'create extension if not exists postgis;' | psql %s > /dev/null 2>&1" % args.database)
+
+    scenarios = args.scenarios.split(',')
+    transfers = [s for s in SCENARIOS if s[0] in scenarios]
+
+    # every transfer gets a run of its own, so nothing is already in the database
+    nruns = len(transfers)*args.repeat + 1
+    server = DapServer(args.model, args.nlat, args.nlon, args.ntime, args.nlev, days=nruns//4 + 1)
+    url = server.start()
+    host = url.split('/')[2]
+
+    m = Model(args.model)
+    m.setserver(url)
+    m.setgridcache(None)
+    m.setworkers(args.workers)
+    m.connect(database=args.database)
+
+    results = []
+    try:
+        # the grid has to be in place before the transfers
+        m._setup()
+        runs = server.runs()
+
+        if 'setupgrid' in scenarios:
+            results.append(dict(median([setupgrid(m, server) for i in range(args.repeat)]), scenario='setupgrid'))
+
+        for name, fields, geos, pressure, calcs in transfers:
+            measured = []
+            for i in range(args.repeat):
+                run = runs.pop()
+                measured.append(transfer(m, host, run, fields, geos, pressure, calcs))
+            result = median(measured)
+            result['scenario'] = name
+            result['values_per_second'] = result['values']/max(result['seconds'], 1e-9)
+            results.append(result)
+    finally:
+        # clean up after ourselves
+        m.dropruns(-1)
+        m.database.close()
+        server.stop()
+
+    output = json.dumps({'grid': [args.nlat, args.nlon], 'ntime': args.ntime, 'nlev': args.nlev,
+                         'workers': args.workers, 'repeat': args.repeat, 'results': results}, indent=2, sort_keys=True)
+    if args.out:
+        open(args.out, 'w').write(output + '\n')
+    print output
+
+if __name__ == '__main__':
+    main()
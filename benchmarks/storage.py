@@ -0,0 +1,119 @@
+"""
+Compare the row storage and the array storage of the data.
+
+For each storage, a synthetic run is loaded into a scratch database through the same path a transfer
+uses (encodedata and senddata), then the size of its partitions is measured, along with the time taken
+by point queries (gettimeseries) and by reading a whole field back (readdata / readarrays).
+
+Usage:
+python benchmarks/storage.py --database bench [--nlat 200 --nlon 400 --ntime 24 --precision 0.01]
+
+The database is created if needed and has to have PostGIS available. Results are printed as json.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from forecasting.database import Database
+
+def synthetic(nlat, nlon, it):
+    """
+    A smooth field, like temperature, that changes a little every timestep
+    """
+    lat = np.linspace(-1, 1, nlat)[:,np.newaxis]
+    lon = np.linspace(-1, 1, nlon)[np.newaxis,:]
+    return (280. + 20*np.sin(3*lat + it/10.)*np.cos(2*lon) + np.random.normal(0, .1, (nlat, nlon))).astype('f4')
+
+def partitionsize(d, table, runid):
+    d.curs.execute("select pg_total_relation_size(%s)", ('%s_r%d' % (table, runid),))
+    return d.curs.fetchone()[0]
+
+def bench(d, storage, precision, args, datatime):
+    d.setstorage(storage, precision)
+    fieldid = d.getfieldid('bench_%s' % storage)
+    runid = d.getrunid(datatime)
+    gridpointids = d.retrievegridids()
+    ords = np.arange(args.nlat*args.nlon)
+    forecastids = d.getforecastids([(fieldid, datatime, datatime + timedelta(hours=it), None) for it in range(args.ntime)])
+
+    dtype = [('forecastid','i4'), ('gridpointid','i4'), ('value','f4'), ('runid','i4')]
+    starttime = time.time()
+    for it in range(args.ntime):
+        data = np.empty(len(gridpointids), dtype)
+        data['forecastid'] = forecastids[it]
+        data['gridpointid'] = gridpointids
+        data['value'] = synthetic(args.nlat, args.nlon, it).ravel()
+        data['runid'] = runid
+        if storage == 'arrays':
+            d.senddata(d.encodedata(data, ords))
+        else:
+            d.senddata(d.encodedata(data))
+    load = time.time() - starttime
+
+    d.curs.execute('analyze')
+    size = partitionsize(d, 'data' if storage == 'rows' else 'dataarrays', runid)
+
+    # point queries, a handful of random points at a time
+    latencies = []
+    for i in range(args.queries):
+        points = np.random.randint(0, len(ords), 4)
+        starttime = time.time()
+        d.gettimeseries(['bench_%s' % storage], runid, gridpointids[points], ords[points])
+        latencies.append(time.time() - starttime)
+
+    starttime = time.time()
+    if storage == 'arrays':
+        d.readarrays(forecastids[:1], runid)
+    else:
+        d.readdata(forecastids[:1], runid)
+    readfield = time.time() - starttime
+
+    d.conn.commit()
+    return {'storage': storage,
+            'precision': precision,
+            'load_seconds': load,
+            'bytes': size,
+            'bytes_per_value': float(size)/(len(ords)*args.ntime),
+            'point_query_ms_median': 1000*np.median(latencies),
+            'point_query_ms_p95': 1000*np.percentile(latencies, 95),
+            'read_field_seconds': readfield}
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the row and array storage of the data')
+    parser.add_argument('--database', default='forecastingbench')
+    parser.add_argument('--nlat', type=int, default=200)
+    parser.add_argument('--nlon', type=int, default=400)
+    parser.add_argument('--ntime', type=int, default=24)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--precision', type=float, default=0.01)
+    args = parser.parse_args()
+
+    os.system("echo 'create database %s;' | psql postgres > /dev/null 2>&1" % args.database)
+    os.system("echo 'create extension if not exists postgis;' | psql %s > /dev/null 2>&1" % args.database)
+
+    d = Database(database=args.database)
+    d.cachemodelid('bench%dx%d' % (args.nlat, args.nlon))
+    if d.numberofgridpoints() != args.nlat*args.nlon:
+        d.setupgrid(np.linspace(20, 50, args.nlat), np.linspace(-130, -60, args.nlon))
+
+    # every storage gets a run of its own, so the partitions can be measured separately
+    results = []
+    base = datetime(2000, 1, 1) + timedelta(hours=int(time.time()) % 10000)
+    for i, (storage, precision) in enumerate([('rows', None), ('arrays', None), ('arrays', args.precision)]):
+        results.append(bench(d, storage, precision, args, base + timedelta(days=i)))
+
+    # clean up after ourselves
+    d.dropruns(0)
+    d.close()
+
+    print json.dumps({'grid': [args.nlat, args.nlon], 'ntime': args.ntime, 'results': results}, indent=2)
+
+if __name__ == '__main__':
+    main()
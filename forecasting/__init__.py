@@ -1,4 +1,5 @@
 from forecasting.model import Model
 from forecasting.daemon import Daemon
 from forecasting.database import Database
+from forecasting.sources import OpendapSource, FileSource, GribSource
 
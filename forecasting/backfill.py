@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import sys
+from datetime import datetime, timedelta
+from urlparse import urlsplit
+
+from calculation import Calculation
+from scheduler import loadmodel
+
+# state of a worker process, see _initworker
+_worker = {}
+
+class Backfill:
+    """
+    BACKFILL loads every run of one or more models between two datatimes, the way the daemon loads the latest one.
+
+    The work is split into (run, fields) units: a field on its own, or the dependents of a calculated field together
+    so the calculation can be done as they come in (calculated fields whose dependents aren't all among the fields
+    of the config are left out). The units are run on a pool of processes, with at most perhost units downloading
+    from the same server at a time. Each completed unit is recorded in the checkpoints table of the database, so a
+    backfill that is stopped or fails part way only does the remaining units when it's started again.
+
+    Usage:
+    b = Backfill([yaml.load(open('config/nam.yaml'))], processes=4, perhost=2)
+    failed = b.run(datetime(2014,2,1), datetime(2014,2,14,18))
+
+    or from the command line:
+    python forecasting/backfill.py config/nam.yaml 2014-02-01 2014-02-14 --processes 4 --perhost 2
+    """
+
+    # number of worker processes
+    processes = 4
+
+    # largest number of units transferred from the same host at the same time
+    perhost = 2
+
+    configs = []
+
+    def __init__(self, configs, processes=None, perhost=None):
+        self.configs = list(configs)
+        if processes != None:
+            self.processes = processes
+        if perhost != None:
+            self.perhost = perhost
+
+    def plan(self, start, end):
+        """
+        PLAN returns the (config index, datatime, fields) units between start and end that haven't been completed yet.
+        The grid of each model is set up on the way, so the workers don't race to do it, and the hosts the models
+        download from (with their server, files or grib settings) are collected in self.hosts.
+        """
+
+        units = []
+        self.hosts = set()
+        for index, config in enumerate(self.configs):
+            m, args = loadmodel(config)
+            self.hosts.add(self.host(m.baseurl))
+            try:
+                m._setup()
+                datatimes = self.datatimes(m.runs, start, end)
+                groups = self.groups(m, config['fields'])
+                done = m.database.getcheckpoints(self.scope(config), start, end)
+            finally:
+                m.database.close()
+            planned = [(index, datatime, fields) for datatime in datatimes for fields in groups]
+            remaining = self.pending(planned, done)
+            print '%s: %d runs, %d units, %d already done' % (config['model'], len(datatimes), len(planned), len(planned) - len(remaining))
+            units.extend(remaining)
+        units.sort(key=lambda unit: (unit[1], unit[0]))
+        return units
+
+    def run(self, start, end):
+        """
+        RUN transfers every remaining unit between start and end, and returns the list of (model, datatime, fields, error)
+        of the units that failed. Failed units are tried again by the next run.
+        """
+
+        units = self.plan(start, end)
+        if len(units) == 0:
+            print 'Nothing to do'
+            return []
+
+        semaphores = dict([(host, multiprocessing.BoundedSemaphore(self.perhost)) for host in self.hosts])
+
+        failed = []
+        pool = multiprocessing.Pool(min(self.processes, len(units)), _initworker, (self.configs, semaphores))
+        try:
+            for i, (index, datatime, fields, error) in enumerate(pool.imap_unordered(_transferunit, units)):
+                model = self.configs[index]['model']
+                if error == None:
+                    print '[%d/%d] %s %s %s done' % (i+1, len(units), model, datatime, ','.join(fields))
+                else:
+                    print '[%d/%d] %s %s %s failed: %s' % (i+1, len(units), model, datatime, ','.join(fields), error)
+                    failed.append((model, datatime, fields, error))
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        print '%d units done, %d failed' % (len(units) - len(failed), len(failed))
+        return failed
+
+    def datatimes(self, runs, start, end):
+        """
+        DATATIMES returns the datatimes of the runs listed by a RunDiscovery between start and end (inclusive)
+        """
+
+        datatimes = []
+        for day in runs.days():
+            if day < int(start.strftime('%Y%m%d')) or day > int(end.strftime('%Y%m%d')):
+                continue
+            for hour in runs.runs(day):
+                datatime = datetime.strptime('%d%02d' % (day, hour), '%Y%m%d%H')
+                if start <= datatime <= end:
+                    datatimes.append(datatime)
+        return datatimes
+
+    def groups(self, m, fields):
+        """
+        GROUPS splits the fields of a model into the units of a run: a field on its own, or the dependents of a
+        calculated field together
+        """
+
+        calcs = []
+        for calcfield in m.calcfields:
+            for name, p in calcfield.items():
+                if all([d in fields for d in p['dependents']]):
+                    calcs.append(Calculation(name,p['dependents'],p['calculation'],p.get('parameters')))
+        return [group for group, groupcalcs in m._groupfields(fields,calcs)]
+
+    def pending(self, units, done):
+        """
+        PENDING returns the units with a field missing from the completed (datatime, field) pairs
+        """
+
+        return [unit for unit in units if not all([(unit[1], field) in done for field in unit[2]])]
+
+    def scope(self, config):
+        """
+        SCOPE identifies the part of the grid a config transfers, so a unit transferred for one set of geos and
+        pressure levels doesn't count as done for another
+        """
+
+        return hashlib.sha1(json.dumps([config.get('geos'), config.get('pressure')], sort_keys=True)).hexdigest()
+
+    def host(self, url):
+        """
+        HOST returns the server of a url
+        """
+
+        return urlsplit(url).netloc
+
+def _initworker(configs, semaphores):
+    """
+    Set up a worker process. The models are connected when they're first needed.
+    """
+
+    _worker['configs'] = configs
+    _worker['semaphores'] = semaphores
+    _worker['models'] = {}
+
+def _transferunit(unit):
+    """
+    Transfer a (config index, datatime, fields) unit in a worker process, and record it as completed.
+    Returns the unit, with the error message if it failed or None.
+    """
+
+    index, datatime, fields = unit
+    try:
+        config = _worker['configs'][index]
+        if index not in _worker['models']:
+            m, args = loadmodel(config)
+            _worker['models'][index] = (m, args, list(m.calcfields))
+        m, args, calcfields = _worker['models'][index]
+
+        # only the calculations of this unit's fields
+        m.calcfields = [calcfield for calcfield in calcfields if all([d in fields for p in calcfield.values() for d in p['dependents']])]
+
+        semaphore = _worker['semaphores'][Backfill([]).host(m.baseurl)]
+        semaphore.acquire()
+        try:
+            m.transfer(fields, datatime, **args)
+        finally:
+            semaphore.release()
+        m.database.setcheckpoint(datatime, fields, Backfill(_worker['configs']).scope(config))
+    except KeyboardInterrupt:
+        raise
+    except Exception, e:
+        # start the next unit of this model with fresh connections
+        if index in _worker.get('models', {}):
+            try:
+                _worker['models'].pop(index)[0].database.close()
+            except Exception:
+                pass
+        return index, datatime, fields, str(e) or e.__class__.__name__
+    return index, datatime, fields, None
+
+def parsetime(value, end=False):
+    """
+    Parse a datatime given on the command line: 2014-02-01, 2014-02-01T18 or 2014020118.
+    A day on its own stands for its first run, or its last if it's the end of a range.
+    """
+
+    for fmt in ('%Y-%m-%dT%H', '%Y-%m-%d %H', '%Y%m%d%H'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    for fmt in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            day = datetime.strptime(value, fmt)
+            return day + timedelta(hours=23) if end else day
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Unknown datatime %s' % value)
+
+def main():
+    import yaml
+
+    parser = argparse.ArgumentParser(description='Load every run of one or more models between two datatimes')
+    parser.add_argument('configs', nargs='+', help='yaml config files, as for the daemon')
+    parser.add_argument('start', help='first run, like 2014-02-01 or 2014-02-01T06')
+    parser.add_argument('end', help='last run, like 2014-02-14 or 2014-02-14T18')
+    parser.add_argument('--processes', type=int, default=Backfill.processes, help='number of worker processes')
+    parser.add_argument('--perhost', type=int, default=Backfill.perhost, help='largest number of units downloading from a server at a time')
+    args = parser.parse_args()
+
+    configs = []
+    for filename in args.configs:
+        config = yaml.load(open(filename,'r').read())
+        if not all([i in config for i in ('model','database','fields')]):
+            raise Exception('Make sure %s has the model, database, and fields' % filename)
+        configs.append(config)
+
+    b = Backfill(configs, args.processes, args.perhost)
+    failed = b.run(parsetime(args.start), parsetime(args.end, end=True))
+    sys.exit(1 if len(failed) > 0 else 0)
+
+if __name__ == '__main__':
+    main()
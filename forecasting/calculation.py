@@ -0,0 +1,148 @@
+import ast
+import re
+
+import numpy as np
+
+class Calculation:
+    """
+    CALCULATION evaluates the expression of a calculated field on numpy arrays.
+
+    The expressions are written for the database (see Model.addcalculatedfield), so they follow SQL rather than
+    python: ^ is a power, ln is the natural log and log is base 10. Only arithmetic on the dependents, numbers and
+    a handful of functions is understood. Constants passed as parameters are written as %(name)s. Anything else, or anything that could mean something different in python
+    than in SQL (like -x^2 or x^y^z), can't be evaluated here; check supported() and leave those to the database.
+
+    Usage:
+    c = Calculation('wnd10m', ['ugrd10m','vgrd10m'], 'sqrt(ugrd10m^2+vgrd10m^2)')
+    if c.supported():
+        values = c.evaluate({'ugrd10m': u, 'vgrd10m': v})
+    """
+
+    # SQL functions and their numpy counterparts
+    functions = {
+        'sqrt': np.sqrt,
+        'abs': np.abs,
+        'exp': np.exp,
+        'ln': np.log,
+        'log': np.log10,
+        'power': np.power,
+        'greatest': np.maximum,
+        'least': np.minimum,
+        'sin': np.sin,
+        'cos': np.cos,
+        'tan': np.tan,
+        'atan': np.arctan,
+        'atan2': np.arctan2,
+        'degrees': np.degrees,
+        'radians': np.radians,
+    }
+
+    operators = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+    name = ''
+    dependents = []
+    calculation = ''
+    parameters = {}
+
+    def __init__(self, name, dependents, calculation, parameters=None):
+        self.name = name
+        self.dependents = list(dependents)
+        self.calculation = calculation
+        if parameters != None:
+            self.parameters = dict(parameters)
+        self.code = None
+        self.reason = None
+        try:
+            expression = re.sub('%\\((\\w+)\\)s', '\\1', calculation).replace('^','**').strip()
+            tree = ast.parse(expression, mode='eval')
+            self._check(tree.body)
+            self.code = compile(tree, '<%s>' % name, 'eval')
+        except SyntaxError:
+            self.reason = 'not a valid expression'
+        except ValueError, e:
+            self.reason = str(e)
+
+    def validate(self):
+        """
+        VALIDATE checks the expression before it's run in the database, and raises an exception naming the problem:
+        a %(name)s constant without a parameter, a dependent that isn't a plain name, or anything besides arithmetic on
+        the dependents, numbers and the functions above. What python and SQL read differently (like -x^2) is fine here,
+        the database reads it as SQL.
+        """
+
+        for parameter in re.findall('%\\((\\w+)\\)s', self.calculation):
+            if parameter not in self.parameters:
+                raise Exception('Calculation %s has no parameter %s' % (self.name, parameter))
+        for dependent in self.dependents:
+            if not re.match('^[A-Za-z_]\\w*$', dependent):
+                raise Exception('Calculation %s: %s is not a valid field name' % (self.name, dependent))
+        try:
+            expression = re.sub('%\\((\\w+)\\)s', '\\1', self.calculation).replace('^','**').strip()
+            self._check(ast.parse(expression, mode='eval').body, sql=True)
+        except SyntaxError:
+            raise Exception('Calculation %s is not a valid expression' % self.name)
+        except ValueError, e:
+            raise Exception('Calculation %s: %s' % (self.name, e))
+
+    def supported(self):
+        """
+        SUPPORTED tells whether the expression can be evaluated with numpy
+        """
+        return self.code != None
+
+    def evaluate(self, values):
+        """
+        EVALUATE returns the calculated values, given a dictionary with an array for each dependent.
+        Invalid results (like the square root of a negative number) come back as nan.
+        """
+
+        if self.code == None:
+            raise Exception('Calculation %s can not be evaluated in numpy: %s' % (self.name, self.reason))
+
+        namespace = dict(self.functions)
+        for parameter, value in self.parameters.items():
+            namespace[parameter] = float(value)
+        for dependent in self.dependents:
+            namespace[dependent] = np.asarray(values[dependent],dtype='f8')
+        with np.errstate(all='ignore'):
+            result = eval(self.code, {'__builtins__': {}}, namespace)
+
+        # an expression may not use every dependent, but there is still a value for every cell
+        shape = np.broadcast(*[namespace[d] for d in self.dependents]).shape
+        return np.array(np.broadcast_to(result,shape),dtype='f8')
+
+    def _check(self, node, sql=False):
+        """
+        Walk the expression and raise a ValueError at the first thing that isn't understood. With sql, the
+        expressions that only python would read differently are let through.
+        """
+
+        if isinstance(node, ast.Num):
+            return
+        elif isinstance(node, ast.Name):
+            if node.id not in self.dependents and node.id not in self.parameters:
+                raise ValueError('unknown name %s' % node.id)
+        elif isinstance(node, ast.BinOp):
+            if not isinstance(node.op, self.operators):
+                raise ValueError('unsupported operator')
+            # SQL reads x^y^z as (x^y)^z, python as x^(y^z)
+            if not sql and isinstance(node.op, ast.Pow) and isinstance(node.right, ast.BinOp) and isinstance(node.right.op, ast.Pow):
+                raise ValueError('ambiguous chain of powers')
+            self._check(node.left, sql)
+            self._check(node.right, sql)
+        elif isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, self.operators):
+                raise ValueError('unsupported operator')
+            # SQL reads -x^2 as (-x)^2, python as -(x^2)
+            if not sql and isinstance(node.operand, ast.BinOp) and isinstance(node.operand.op, ast.Pow):
+                raise ValueError('ambiguous sign of a power')
+            self._check(node.operand, sql)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in self.functions:
+                raise ValueError('unsupported function')
+            if node.keywords or node.starargs or node.kwargs:
+                raise ValueError('unsupported arguments')
+            for arg in node.args:
+                self._check(arg, sql)
+        else:
+            raise ValueError('unsupported expression')
@@ -0,0 +1,74 @@
+import zlib
+
+import numpy as np
+
+# stands in for missing values in quantized slices
+MISSING = np.iinfo('i4').min
+
+def encodeslice(ords, values, precision=None):
+    """
+    Encode a slice of a forecast (the values at a set of grid cells) for the array storage.
+
+    The ords are stored as deltas, which are almost all 1 for a box of the grid, and the values as float32
+    or, with a precision, as integer multiples of it. Both are byte-shuffled (the first byte of every value,
+    then the second, ...) before being compressed with zlib, which lets zlib find the slowly changing high bytes.
+
+    Returns (firstord, lastord, npoints, scale, ords, values), with scale None for float32 values.
+
+    Usage:
+    row = encodeslice(ords, values, precision=0.01)
+    ords, values = decodeslice(*row[2:])
+    """
+
+    ords = np.asarray(ords,dtype='<i4')
+    values = np.asarray(values,dtype='f4')
+
+    order = np.argsort(ords,kind='mergesort')
+    ords = ords[order]
+    values = values[order]
+
+    deltas = np.diff(ords)
+    deltas = np.concatenate([ords[:1],deltas]).astype('<i4')
+
+    if precision == None:
+        scale = None
+        packed = values.astype('<f4')
+    else:
+        scale = float(precision)
+        packed = np.empty(len(values),dtype='<i4')
+        finite = np.isfinite(values)
+        steps = np.round(values[finite]/scale)
+        if len(steps) > 0 and np.max(np.abs(steps)) >= -MISSING:
+            raise Exception('Values too large for a precision of %g' % scale)
+        packed[finite] = steps
+        packed[~finite] = MISSING
+
+    return int(ords[0]), int(ords[-1]), len(ords), scale, _shuffle(deltas), _shuffle(packed)
+
+def decodeslice(npoints, scale, ords, values):
+    """
+    Decode a slice encoded by encodeslice. Returns the ords and the values, as arrays.
+    """
+
+    ords = np.cumsum(_unshuffle(ords,'<i4',npoints)).astype('i4')
+    if scale == None:
+        values = _unshuffle(values,'<f4',npoints).astype('f4')
+    else:
+        packed = _unshuffle(values,'<i4',npoints)
+        values = (packed*scale).astype('f4')
+        values[packed == MISSING] = np.nan
+    return ords, values
+
+def _shuffle(a):
+    """
+    Compress an array with its bytes grouped by position
+    """
+    return zlib.compress(np.ascontiguousarray(a.view('u1').reshape(len(a),a.itemsize).T).tostring(),6)
+
+def _unshuffle(buf,dtype,n):
+    """
+    Reverse _shuffle
+    """
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(bytes(buf)),dtype='u1').reshape(dtype.itemsize,n)
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(n)
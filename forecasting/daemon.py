@@ -7,7 +7,8 @@ import atexit
 import datetime
 from signal import SIGTERM
 
-from model import Model
+from scheduler import Scheduler
+import metrics
 
 # 'nam:\n  database: {database: weather, user: salexander}\n  fields: [tmp2m]\n  geos: {k: 4, lat: 40, lon: -100}\n'
 
@@ -141,74 +142,45 @@ class DaemonParent:
         """
 
 class Daemon(DaemonParent):
+    """
+    Transfers the runs of one or more models as they come out, see Scheduler.
+
+    Usage:
+    d = Daemon('./daemon.pid')
+    d.configs = [yaml.load(open('config/nam.yaml')), yaml.load(open('config/rap.yaml'))]
+    d.start()
+    """
 
     config = None
+    configs = None
 
     def run(self):
         print 'running Daemon'
 
-        # check that it has all of the needed fields
-        if all([i in config for i in ('model','database','fields')]):
-            print 'its got all the needed fields'
+        if self.configs == None:
+            configs = [self.config]
         else:
-            print 'youre missing some important fields... make sure you have model, database, and fields'
-            raise Exception('Config file missing item')
-
-        m = Model(self.config['model'])
-        m.connect(**self.config['database'])
-        latest = m.getlatesttime()
-        args = {}
-        if 'geos' in config:
-            args['geos'] = config['geos']
-        else:
-            args['geos'] = None
-        if 'pressure' in config:
-            args['pressure'] = config['pressure']
-        else:
-            args['pressure'] = None
-
-        if 'calculatedfields' in config:
-            print config
-            for field in config['calculatedfields']:
-                for key, value in field.items():
-                    m.addcalculatedfield(key,value['dependents'],value['calculation'])
-
-        ntries = 0
-        ntriesmax = max(int(config['modelint']/config['poll']*2/3),1)
-        print "We'll try each download up to four times."
-  
-        while True:
-            
-            starttime = time.time()
-
-            url = m._createurl(latest)
-            check = m._checkurl(url)
-            if check:
-                print 'The new data is available! Downloading ...'
-                try:
-                    if ntries < ntriesmax:
-                        ntries = ntries+1
-                        m.transfer(config['fields'],latest,**args)
-                    latest = latest + datetime.timedelta(seconds=self.config['modelint'])
-                    ntries = 0
-                except:
-                    print 'An error occured in downloading the data... it might not actually be available'
-                print 'The next run will happen at %s' % latest
+            configs = self.configs
+
+        # check that it has all of the needed fields
+        for config in configs:
+            if all([i in config for i in ('model','database','fields')]):
+                print 'its got all the needed fields'
             else:
-                print 'No new data. Sad face'
-            endtime = time.time()
-            pausetime = max(
-                            config['poll'] - ( endtime - starttime ),
-                            0
-                            )
-            print 'Pausing for %d seconds' % pausetime
-            time.sleep(pausetime)
+                print 'youre missing some important fields... make sure you have model, database, and fields'
+                raise Exception('Config file missing item')
+
+        # the settings of the scheduler and the metrics come from the first config
+        if 'metrics' in configs[0]:
+            metrics.start(**configs[0]['metrics'])
+        s = Scheduler(configs, **configs[0].get('scheduler', {}))
+        s.run()
 
 
 if __name__ == '__main__':
     # if we're called from the commandline, let's try a couple of things:
     #   no arguments: start up with reasonable defaults
-    #   arguments: check if it's a yaml file with all the cool stuff
+    #   arguments: check if they're yaml files with all the cool stuff, and run them side by side
 
 
     if len(sys.argv) < 2:
@@ -230,37 +202,41 @@ if __name__ == '__main__':
 
         d.config = config
         d.start()
-    elif os.path.isfile(sys.argv[1]) and sys.argv[1].split('.')[-1] == 'yaml':
+    elif all([os.path.isfile(arg) and arg.split('.')[-1] == 'yaml' for arg in sys.argv[1:]]):
         import yaml
-        # treat it as a yaml file
-        try:
-            config = yaml.load(open(sys.argv[1],'r').read())
-        except:
-            raise Exception('Could not load yaml information')
-
-        if all([i in config for i in ['model','fields','modelint','poll']]):
-            if 'pid' in config:
-                pid=os.path.abspath(config['pid'])
-            else:
-                pid = os.path.abspath('./daemon.pid')
+        # treat them as yaml files
+        configs = []
+        for arg in sys.argv[1:]:
+            try:
+                config = yaml.load(open(arg,'r').read())
+            except:
+                raise Exception('Could not load yaml information')
+
+            if not all([i in config for i in ['model','fields','modelint','poll']]):
+                print 'Make sure %s has the model, fields, modelint, and poll fields. Youll often need a database field as well' % arg
+                raise Exception('Badly configured file')
+            configs.append(config)
+
+        # the process settings come from the first file
+        config = configs[0]
+        if 'pid' in config:
+            pid=os.path.abspath(config['pid'])
+        else:
+            pid = os.path.abspath('./daemon.pid')
 
-            startup = {}
-            for i in ['stdin','stdout','stderr']:
-                if i in config:
-                    startup[i] = os.path.abspath(config[i])
+        startup = {}
+        for i in ['stdin','stdout','stderr']:
+            if i in config:
+                startup[i] = os.path.abspath(config[i])
 
-            d = Daemon(pid,**startup)
+        d = Daemon(pid,**startup)
 
-            print 'Starting daemon'
-            d.config = config
-            d.start()
-        else:
-            print 'Make sure you have the model, fields, modelint, and poll fields. Youll often need a database field as well'
-            raise Exception('Badly configured file')
+        print 'Starting daemon'
+        d.configs = configs
+        d.start()
 
     else:
-        print sys.argv[1].split('.')
-        print 'I dont understand what youre saying. I accept a yaml file as an imput on the command line. Make sure it ends in yaml.'
+        print sys.argv[1:]
+        print 'I dont understand what youre saying. I accept one or more yaml files as an imput on the command line. Make sure they end in yaml.'
         print 'Exiting ...'
         raise Exception('Unknown input file')
-
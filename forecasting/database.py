@@ -1,8 +1,14 @@
 import os
+import time
+import hashlib
 import psycopg2 as pg
 import numpy as np
 from io import BytesIO
-from struct import pack
+from struct import pack, unpack
+
+from calculation import Calculation
+from compact import encodeslice, decodeslice
+import metrics
 
 class Database:
     """
@@ -25,6 +31,16 @@ class Database:
     dbversion = None
     dbmodelid = None
 
+    # what to do with rows that are already in the database: 'keep' or 'overwrite'
+    conflict = 'keep'
+
+    # statements prepared on this connection, see _preparecalculation
+    prepared = None
+
+    # how the data is stored: 'rows' (a row per value, in data) or 'arrays' (a compressed array per slice, in dataarrays)
+    storage = 'rows'
+    precision = None
+
     fpath = os.path.dirname(os.path.abspath(__file__))
 
     def _version(self):
@@ -34,7 +50,7 @@ class Database:
         Class dependencies:
             none
         """
-        return '0.5.0'
+        return '0.10.0'
 
     def __init__(self, **connargs):
         """
@@ -55,17 +71,19 @@ class Database:
         """
         self.conn = pg.connect(**connargs)
         self.curs = self.conn.cursor()
+        self.prepared = {}
         print 'Successfully connected to database'
 
         print 'Checking database version'
         try:
             self.curs.execute('select forecastingversion()')
             self.dbversion = self.curs.fetchone()[0]
-            if self.dbversion != self._version():
-                self._migrate(self._version())
         except:
             self.conn.rollback()
-            self._migrate(self._version())
+            self.dbversion = None
+        if self.dbversion != self._version():
+            self._migrate(self._version(),self.dbversion)
+            self.dbversion = self._version()
         print 'Database initialized'
 
     def close(self):
@@ -82,11 +100,13 @@ class Database:
 
         self.conn.close()
 
-    def _migrate(self,version):
+    def _migrate(self,version,current=None):
         """ 
         Migrate the database to the correct version. 
 
-        This sets up all of the internal tables and functions
+        This sets up all of the internal tables and functions. Each version directory in db/ holds the
+        changes from the version before it, so a database at the current version only runs the newer ones,
+        and a new database runs all of them. A database newer than this code is refused rather than used.
 
         Class dependencies:
             self.fpath
@@ -97,15 +117,26 @@ class Database:
 
         # TODO: This method should be moved into a new class
 
-        files = os.listdir(os.path.join(self.fpath,"db/{version}/up".format(version=version)))
-        files.sort()
-        for file in files:
-            if file.endswith('.sql'):
-                filename = os.path.join(self.fpath,"db/{version}/up".format(version=version),file)
-                print 'Running migration: %s' % filename
-                cmd = open(filename,'r').read()
-                print cmd
-                self.curs.execute(cmd)
+        def parse(v):
+            return tuple([int(i) for i in v.split('.')])
+
+        if current != None and parse(current) > parse(version):
+            raise Exception('The database is at version %s, newer than this version of forecasting (%s). Upgrade forecasting to use it.' % (current, version))
+
+        versions = [v for v in os.listdir(os.path.join(self.fpath,"db")) if os.path.isdir(os.path.join(self.fpath,"db",v))]
+        versions.sort(key=parse)
+        for v in versions:
+            if parse(v) > parse(version) or (current != None and parse(v) <= parse(current)):
+                continue
+            files = os.listdir(os.path.join(self.fpath,"db/{version}/up".format(version=v)))
+            files.sort()
+            for file in files:
+                if file.endswith('.sql'):
+                    filename = os.path.join(self.fpath,"db/{version}/up".format(version=v),file)
+                    print 'Running migration: %s' % filename
+                    cmd = open(filename,'r').read()
+                    print cmd
+                    self.curs.execute(cmd)
         self.conn.commit()
 
     def cachemodelid(self, modelname):
@@ -145,6 +176,27 @@ class Database:
         numgridpoints = self.curs.fetchone()[0]
         return numgridpoints
 
+    def gridfingerprint(self):
+        """
+        GRIDFINGERPRINT returns a short string identifying the grid of the model in this database.
+        It changes whenever the grid is rebuilt, and is used to validate the local grid cache.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        fingerprint = d.gridfingerprint()
+
+        Class dependencies:
+            self.conn
+            self.curs
+            self.dbmodelid
+        """
+
+        self.curs.execute("select count(1), min(gridpointid), max(gridpointid), max(ord) from gridpoints where modelid = %d" % self.dbmodelid)
+        count, mingridid, maxgridid, maxord = self.curs.fetchone()
+        key = '%s|%d|%d|%s|%s|%s' % (self.conn.dsn, self.dbmodelid, count, mingridid, maxgridid, maxord)
+        return hashlib.sha1(key).hexdigest()
+
     def setupgrid(self,lat,lon):
         """
         SETUPGRID inserts a set of lat/long lists into the database.
@@ -165,11 +217,27 @@ class Database:
         nlat = len(lat)
         nlon = len(lon)
 
-        for i in range(0,nlat):
-            print 'Loading lat ',i
-            for j in range(0,nlon):
-                order = i*nlon+j
-                self.curs.execute("insert into public.gridpoints (modelid,geom,ord) values(%d, ST_SetSRID(ST_MakePoint(%f, %f), 4326),%d);" % (self.dbmodelid, lon[j], lat[i], order))
+        # build the whole grid at once, in ord order (lat major)
+        grid = np.empty(nlat*nlon,[('lon','f8'),('lat','f8'),('ord','i4')])
+        grid['lon'] = np.tile(np.asarray(lon,dtype='f8'),nlat)
+        grid['lat'] = np.repeat(np.asarray(lat,dtype='f8'),nlon)
+        grid['ord'] = np.arange(nlat*nlon)
+
+        # stream the points into a temporary table and build the geometries server side
+        print 'Loading %d gridpoints' % (nlat*nlon)
+        self.conn.commit()
+        self.curs.execute("create temp table gridstaging (lon double precision, lat double precision, ord int) on commit drop;")
+        self._copybinary(grid, 'gridstaging', commit=False)
+
+        # The indexes are cheaper to build once than to maintain during the load, but only while the table is empty:
+        # rebuilding them locks the grids of the other models and reindexes all of them.
+        self.curs.execute("select not exists (select 1 from gridpoints);")
+        empty = self.curs.fetchone()[0]
+        if empty:
+            self.curs.execute("drop index if exists gridpoints_gist; drop index if exists gridpoints_model; drop index if exists gridpoints_modelord;")
+        self.curs.execute("insert into public.gridpoints (modelid,geom,ord) select %d, ST_SetSRID(ST_MakePoint(lon, lat), 4326), ord from gridstaging order by ord;" % self.dbmodelid)
+        if empty:
+            self.curs.execute("create index gridpoints_gist on gridpoints using gist (geom); create index gridpoints_model on gridpoints using btree (modelid); create index gridpoints_modelord on gridpoints using btree (modelid,ord);")
         self.conn.commit()
         print 'Finished initializing grid'
 
@@ -193,6 +261,27 @@ class Database:
         return fieldid
 
 
+    def getrunid(self,datatime):
+        """
+        GETRUNID accepts the datatime of a run and returns the associated runid. If the run does not exist, it will be created,
+        along with the partition of the data table that holds its data.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        runid = d.getrunid(datatime)
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self.dbmodelid
+        """
+
+        self.curs.execute("select insertrun(%s,%s);", (self.dbmodelid, datatime))
+        runid = self.curs.fetchone()[0]
+        self.conn.commit()
+        return runid
+
     def getforecastid(self,fieldid,datatime,datatimeforecast,lev=None):
         """
         GETFORECASTID accepts information about a forecast and returns the associated forecastid. If the forecast does not exist, it will be created.
@@ -207,7 +296,8 @@ class Database:
             self.curs
             self.conn
         """
-        # Select (or create) the forecastid
+        # Select (or create) the forecastid, one connection at a time for the field and run (see getforecastids)
+        self.curs.execute("select pg_advisory_xact_lock(%s, hashtext(%s::text));", (int(fieldid), str(datatime)))
         if lev == None or np.isnan(lev):
             self.curs.execute("select insertforecast(%d,null,'%s',date_trunc('minute',timestamp '%s' + interval '30 seconds'));" % (fieldid, datatime, datatimeforecast))
         else:
@@ -215,6 +305,85 @@ class Database:
         forecastid = self.curs.fetchone()[0]
         return forecastid
 
+    def getforecastids(self,forecasts):
+        """
+        GETFORECASTIDS is the bulk version of getforecastid. It accepts a list of (fieldid, datatime, datatimeforecast, lev) tuples
+        and returns a numpy array with the associated forecastids, in the same order. Missing forecasts are created.
+        Everything is resolved with a single statement, so it costs one round trip no matter how many forecasts are requested.
+
+        The forecasts table has no unique key, so connections resolving the forecasts of the same field and run at the same time
+        (the workers of a transfer with several geobounds) would each create them. An advisory lock on every (fieldid, datatime)
+        makes them take turns, and the ones that come later find the forecasts created by the first.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        fieldid = d.getfieldid('temperature')
+        forecastids = d.getforecastids([(fieldid, datatime, datatime, None), (fieldid, datatime, datatime + timedelta(hours=1), None)])
+
+        Class dependencies:
+            self.curs
+            self.conn
+        """
+
+        if len(forecasts) == 0:
+            return np.array([],dtype='i4')
+
+        fieldids = []
+        datatimes = []
+        datatimeforecasts = []
+        levs = []
+        for fieldid, datatime, datatimeforecast, lev in forecasts:
+            fieldids.append(int(fieldid))
+            datatimes.append(datatime)
+            datatimeforecasts.append(datatimeforecast)
+            if lev == None or np.isnan(lev):
+                levs.append(None)
+            else:
+                levs.append(float(lev))
+
+        q = """
+        with req as (
+            select idx, fieldid, datatime, date_trunc('minute',datatimeforecast + interval '30 seconds') as datatimeforecast, pressure_mb
+            from unnest(%s::int[], %s::timestamp[], %s::timestamp[], %s::real[]) with ordinality as r(fieldid, datatime, datatimeforecast, pressure_mb, idx)
+        ), existing as (
+            select fc.forecastid, fc.fieldid, fc.pressure_mb, fc.datatime, fc.datatimeforecast
+            from forecasts fc
+            inner join (select distinct fieldid, datatime from req) k on fc.fieldid = k.fieldid and fc.datatime = k.datatime
+        ), missing as (
+            select distinct r.fieldid, r.pressure_mb, r.datatime, r.datatimeforecast
+            from req r
+            where not exists (
+                select 1 from existing e
+                where e.fieldid = r.fieldid and e.pressure_mb is not distinct from r.pressure_mb and e.datatime = r.datatime and e.datatimeforecast = r.datatimeforecast
+            )
+        ), ins as (
+            insert into forecasts (fieldid, pressure_mb, datatime, datatimeforecast, runid)
+            select m.fieldid, m.pressure_mb, m.datatime, m.datatimeforecast, insertrun(fl.modelid, m.datatime)
+            from missing m inner join fields fl on m.fieldid = fl.fieldid
+            returning forecastid, fieldid, pressure_mb, datatime, datatimeforecast
+        ), allforecasts as (
+            select * from existing
+            union all
+            select * from ins
+        )
+        select distinct on (r.idx) r.idx, f.forecastid
+        from req r
+        inner join allforecasts f on f.fieldid = r.fieldid and f.pressure_mb is not distinct from r.pressure_mb and f.datatime = r.datatime and f.datatimeforecast = r.datatimeforecast
+        order by r.idx, f.forecastid;
+        """
+        with metrics.histogram('forecasting_forecastids_seconds', 'Time taken to resolve the forecastids of a field').time():
+            # the locks are held until the commit, and taken in the same order everywhere so connections can't deadlock
+            self.conn.commit()
+            keys = sorted(set([(fieldid, str(datatime)) for fieldid, datatime in zip(fieldids, datatimes)]))
+            for fieldid, datatime in keys:
+                self.curs.execute("select pg_advisory_xact_lock(%s, hashtext(%s::text));", (fieldid, datatime))
+            self.curs.execute(q, (fieldids, datatimes, datatimeforecasts, levs))
+            rows = self.curs.fetchall()
+            self.conn.commit()
+        forecastids = np.array([row[1] for row in rows],dtype='i4')
+        return forecastids
+
     def getknn(self,lat,lon,k,nlon):
         """
         GETKNN accepts a location and returns a set of the k nearest neighbors.
@@ -265,24 +434,396 @@ class Database:
         gridids = np.reshape(gridids,np.size(gridids))
         return gridids
 
-    def _copybinary(self,dat, table,columns=''):
+    def getrun(self,datatime=None):
         """
-        COPYBINARY inserts binary data into the provided table
+        GETRUN returns the (runid, datatime) of the run of the model with the given datatime, or of the latest run in the
+        database if no datatime is given. Returns None if there is no such run. Unlike getrunid, nothing is created.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        runid, datatime = d.getrun()
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self.dbmodelid
         """
 
-        cpy = self._preparebinary(dat)
-        cpy.seek(0)
-        self.curs.copy_expert('COPY ' + table + ' FROM STDIN WITH BINARY', cpy)
+        self.conn.commit()
+        if datatime == None:
+            self.curs.execute("select runid, datatime from runs where modelid = %s order by datatime desc limit 1;", (self.dbmodelid,))
+        else:
+            self.curs.execute("select runid, datatime from runs where modelid = %s and datatime = %s;", (self.dbmodelid, datatime))
+        row = self.curs.fetchone()
+        if row == None:
+            return None
+        return row[0], row[1]
+
+    def gettimeseries(self,fieldnames,runid,gridpointids,ords=None):
+        """
+        GETTIMESERIES returns the stored values of a set of fields, for one run, at a set of gridpoints.
+        Rows come back as (fieldname, pressure_mb, datatimeforecast, gridpointid, value), ordered by field, valid time, pressure and gridpoint.
+
+        Only the partition of the run is read, and the rows are found through the primary key of the data table,
+        so the cost depends on the number of points asked for rather than the size of the grid.
+
+        The array storage finds the gridpoints by their ords, given in the same order as the gridpointids. It has to read
+        (and decompress) every slice of the run that covers one of the points.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        runid, datatime = d.getrun()
+        rows = d.gettimeseries(['tmp2m'], runid, [1234, 1235])
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self.dbmodelid
+        """
+
+        if self.storage == 'arrays':
+            return self._arraytimeseries(fieldnames,runid,gridpointids,ords)
+
+        gridpointids = [int(g) for g in np.unique(gridpointids)]
+        q = """
+        select fl.name, fc.pressure_mb, fc.datatimeforecast, d.gridpointid, d.value
+        from fields fl
+        inner join forecasts fc on fc.fieldid = fl.fieldid
+        inner join data d on d.forecastid = fc.forecastid
+        where fl.modelid = %s and fl.name = any(%s) and fc.runid = %s and d.runid = %s and d.gridpointid = any(%s)
+        order by fl.name, fc.datatimeforecast, fc.pressure_mb, d.gridpointid;
+        """
+        self.curs.execute(q, (self.dbmodelid, list(fieldnames), runid, runid, gridpointids))
+        rows = self.curs.fetchall()
+        self.conn.commit()
+        return rows
+
+    def _arraytimeseries(self,fieldnames,runid,gridpointids,ords):
+        """
+        ARRAYTIMESERIES is gettimeseries for the array storage
+        """
+
+        if ords is None:
+            raise Exception('The array storage needs the ords of the gridpoints')
+        ords = np.asarray(ords)
+        gridpointids = np.asarray(gridpointids)
+        order = np.argsort(ords)
+        ords = ords[order]
+        gridpointids = gridpointids[order]
+
+        q = """
+        select fl.name, fc.pressure_mb, fc.datatimeforecast, a.npoints, a.scale, a.ords, a.vals
+        from fields fl
+        inner join forecasts fc on fc.fieldid = fl.fieldid
+        inner join dataarrays a on a.forecastid = fc.forecastid
+        where fl.modelid = %s and fl.name = any(%s) and fc.runid = %s and a.runid = %s and a.firstord <= %s and a.lastord >= %s
+        order by a.forecastid, a.firstord, a.lastord, a.npoints;
+        """
+        self.curs.execute(q, (self.dbmodelid, list(fieldnames), runid, runid, int(ords[-1]), int(ords[0])))
+        arrays = self.curs.fetchall()
+        self.conn.commit()
+
+        # cells in more than one (overlapping) slice come from the first one
+        rows = []
+        seen = set()
+        for name, lev, datatimeforecast, npoints, scale, sliceords, slicevals in arrays:
+            sliceords, slicevals = decodeslice(npoints, scale, sliceords, slicevals)
+            pos = np.minimum(np.searchsorted(sliceords, ords), len(sliceords)-1)
+            for i in np.nonzero(sliceords[pos] == ords)[0]:
+                key = (name, lev, datatimeforecast, int(gridpointids[i]))
+                if key not in seen:
+                    seen.add(key)
+                    rows.append(key + (float(slicevals[pos[i]]),))
+        rows.sort(key=lambda row: (row[0], row[2], row[1], row[3]))
+        return rows
+
+    def readarrays(self,forecastids,runid,ords=None):
+        """
+        READARRAYS is readdata for the array storage. It returns the stored values of a list of forecasts of one run,
+        optionally only at a set of ords, as a numpy named array with the columns idx (the 1-based position of the
+        forecast in forecastids), ord and value, ordered by idx and ord. Missing values come back as nan. A cell held by
+        more than one (overlapping) slice comes back once.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        d.setstorage('arrays')
+        rows = d.readarrays([forecastid1, forecastid2], runid)
+
+        Class dependencies:
+            self.curs
+            self.conn
+        """
+
+        crop = ''
+        args = [[int(f) for f in forecastids], runid]
+        if ords is not None:
+            ords = np.unique(ords)
+            crop = 'and a.firstord <= %s and a.lastord >= %s'
+            args += [int(ords[-1]), int(ords[0])]
+        q = """
+        select r.idx, a.npoints, a.scale, a.ords, a.vals
+        from unnest(%s::int[]) with ordinality as r(forecastid, idx)
+        inner join dataarrays a on a.forecastid = r.forecastid
+        where a.runid = %s {crop}
+        order by r.idx, a.firstord, a.lastord, a.npoints;
+        """.format(crop=crop)
+        self.curs.execute(q, args)
+        arrays = self.curs.fetchall()
+        self.conn.commit()
+
+        parts = []
+        for idx, npoints, scale, sliceords, slicevals in arrays:
+            sliceords, slicevals = decodeslice(npoints, scale, sliceords, slicevals)
+            if ords is not None:
+                keep = np.in1d(sliceords, ords)
+                sliceords = sliceords[keep]
+                slicevals = slicevals[keep]
+            part = np.empty(len(sliceords), [('idx','i4'), ('ord','i4'), ('value','f4')])
+            part['idx'] = idx
+            part['ord'] = sliceords
+            part['value'] = slicevals
+            parts.append(part)
+        if len(parts) == 0:
+            return np.empty(0, [('idx','i4'), ('ord','i4'), ('value','f4')])
+        rows = np.concatenate(parts)
+
+        # one value per cell, from the first slice holding it
+        key = rows['idx'].astype('i8')*(2**32) + rows['ord']
+        first = np.unique(key, return_index=True)[1]
+        return rows[first]
+
+    def getforecasts(self,fieldname,runid):
+        """
+        GETFORECASTS returns the forecasts of a field in a run, as (forecastid, pressure_mb, datatimeforecast) rows
+        ordered by valid time and pressure.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        runid, datatime = d.getrun()
+        forecasts = d.getforecasts('tmp2m', runid)
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self.dbmodelid
+        """
+
+        q = """
+        select fc.forecastid, fc.pressure_mb, fc.datatimeforecast
+        from fields fl inner join forecasts fc on fc.fieldid = fl.fieldid
+        where fl.modelid = %s and fl.name = %s and fc.runid = %s
+        order by fc.datatimeforecast, fc.pressure_mb;
+        """
+        self.curs.execute(q, (self.dbmodelid, fieldname, runid))
+        rows = self.curs.fetchall()
+        self.conn.commit()
+        return rows
+
+    def readdata(self,forecastids,runid,gridpointids=None):
+        """
+        READDATA returns the stored values of a list of forecasts of one run, optionally only at a set of gridpoints.
+
+        The rows are streamed out with a binary COPY and read straight into a numpy named array with the columns
+        idx (the 1-based position of the forecast in forecastids), gridpointid and value, so no python object is
+        made per row. Missing values come back as nan.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        rows = d.readdata([forecastid1, forecastid2], runid)
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self._parsebinary()
+        """
+
+        crop = ''
+        args = [[int(f) for f in forecastids], runid]
+        if gridpointids is not None:
+            crop = 'and d.gridpointid = any(%s)'
+            args.append([int(g) for g in gridpointids])
+        q = """
+        select r.idx::int, d.gridpointid, coalesce(d.value,'NaN'::real)
+        from unnest(%s::int[]) with ordinality as r(forecastid, idx)
+        inner join data d on d.forecastid = r.forecastid
+        where d.runid = %s {crop}
+        """.format(crop=crop)
+        q = self.curs.mogrify(q, args)
+
+        cpy = BytesIO()
+        self.conn.commit()
+        self.curs.copy_expert('COPY (' + q + ') TO STDOUT WITH BINARY', cpy)
+        self.conn.commit()
+        return self._parsebinary(cpy.getvalue(), [('idx','>i4'), ('gridpointid','>i4'), ('value','>f4')])
+
+    def _parsebinary(self,buf,columns):
+        """
+        PARSEBINARY reads the output of COPY ... TO STDOUT WITH BINARY into a numpy named array, the reverse of
+        _preparebinary. Every column has to be fixed width and not null.
+        """
+
+        if buf[:11] != b'PGCOPY\n\377\r\n\0':
+            raise Exception('Not a binary COPY stream')
+        flags, extension = unpack('!ii', buf[11:19])
+        offset = 19 + extension
+
+        pgcopy_dtype = [('num_fields','>i2')]
+        for field, dtype in columns:
+            pgcopy_dtype += [(field + '_length', '>i4'), (field, dtype)]
+        pgcopy_dtype = np.dtype(pgcopy_dtype)
+
+        # everything between the header and the trailer is rows
+        nrows = (len(buf) - offset - 2) // pgcopy_dtype.itemsize
+        pgcopy = np.frombuffer(buf, pgcopy_dtype, nrows, offset)
+        if len(buf) != offset + nrows*pgcopy_dtype.itemsize + 2 or np.any(pgcopy['num_fields'] != len(columns)):
+            raise Exception('Unexpected row layout in binary COPY stream')
+
+        dat = np.empty(nrows, [(field, dtype.replace('>', '=')) for field, dtype in columns])
+        for field, dtype in columns:
+            dat[field] = pgcopy[field]
+        return dat
+
+    def dropruns(self,days):
+        """
+        DROPRUNS removes every run of the model older than the given number of days. Each run lives in its own partition
+        of the data table, which is detached and dropped, so no rows are deleted from data one by one.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        d.dropruns(7)
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self.dbmodelid
+        """
+
+        self.conn.commit()
+        self.curs.execute("select runid, datatime from runs where modelid = %s and datatime < (now() at time zone 'utc') - %s * interval '1 day' order by datatime;", (self.dbmodelid, days))
+        rows = self.curs.fetchall()
+        for runid, datatime in rows:
+            print 'Dropping run %s' % datatime
+            for table in ('data','dataarrays'):
+                self.curs.execute("select to_regclass('%s_r%d') is not null;" % (table, runid))
+                if self.curs.fetchone()[0]:
+                    self.curs.execute("alter table %s detach partition %s_r%d;" % (table, table, runid))
+                    self.curs.execute("drop table %s_r%d;" % (table, runid))
+            self.curs.execute("delete from forecasts where runid = %d;" % runid)
+            self.curs.execute("delete from checkpoints where runid = %d;" % runid)
+            self.curs.execute("delete from completedslices where runid = %d;" % runid)
+            self.curs.execute("delete from runs where runid = %d;" % runid)
+            self.conn.commit()
+        return len(rows)
+
+    def getcheckpoints(self,scope,start,end):
+        """
+        GETCHECKPOINTS returns the set of (datatime, field) units completed for the given scope, for the runs of the model
+        between start and end (inclusive).
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        done = d.getcheckpoints(scope, datetime(2014,2,1), datetime(2014,2,14,18))
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self.dbmodelid
+        """
+
+        self.conn.commit()
+        self.curs.execute("select r.datatime, c.field from checkpoints c inner join runs r on c.runid = r.runid where r.modelid = %s and c.scope = %s and r.datatime between %s and %s;", (self.dbmodelid, scope, start, end))
+        return set([(datatime, field) for datatime, field in self.curs.fetchall()])
+
+    def setcheckpoint(self,datatime,fields,scope):
+        """
+        SETCHECKPOINT records that the given fields of the run at datatime have been completely transferred for the given scope.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        d.setcheckpoint(datatime, ['ugrd10m','vgrd10m'], scope)
+
+        Class dependencies:
+            self.curs
+            self.conn
+            self.getrunid()
+        """
+
+        runid = self.getrunid(datatime)
+        self.curs.execute("insert into checkpoints (runid, field, scope) select %s, unnest(%s::varchar[]), %s on conflict (runid, field, scope) do update set completed = excluded.completed;", (runid, list(fields), scope))
         self.conn.commit()
 
-    def senddata(self,data):
+    def getcompleted(self,runid):
+        """
+        GETCOMPLETED returns the set of (forecastid, scope) slices of a run whose values have all been written,
+        see setcompleted.
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        done = d.getcompleted(runid)
+
+        Class dependencies:
+            self.curs
+            self.conn
+        """
+
+        self.conn.commit()
+        self.curs.execute("select forecastid, scope from completedslices where runid = %s;", (runid,))
+        return set([(forecastid, scope) for forecastid, scope in self.curs.fetchall()])
+
+    def setcompleted(self,runid,forecastids,scope):
+        """
+        SETCOMPLETED records that the values of the given forecasts of a run have all been written for the given scope
+        (the part of the grid they cover).
+
+        Usage:
+        d = Database(database='weather',user='chef')
+        d.cachemodelid('nam')
+        d.senddata(data)
+        d.setcompleted(runid, forecastids, scope)
+
+        Class dependencies:
+            self.curs
+            self.conn
+        """
+
+        self.curs.execute("insert into completedslices (runid, forecastid, scope) select %s, unnest(%s::int[]), %s on conflict do nothing;", (runid, [int(f) for f in forecastids], scope))
+        self.conn.commit()
+
+    def _copybinary(self,dat, table,columns='',commit=True):
+        """
+        COPYBINARY inserts binary data into the provided table. The columns of dat must match the
+        columns of the table, or the optional list of columns (ie '(forecastid,gridpointid,value)').
+        dat is either a numpy named array or a buffer already prepared by _preparebinary.
+        """
+
+        if isinstance(dat, BytesIO):
+            cpy = dat
+        else:
+            cpy = self._preparebinary(dat)
+        cpy.seek(0)
+        self.curs.copy_expert('COPY ' + table + columns + ' FROM STDIN WITH BINARY', cpy)
+        if commit:
+            self.conn.commit()
+
+    def senddata(self,data,ords=None):
         """
         SENDDATA sends the data to the database using the fastest method available.
 
         Usage:
         d.senddata(data)
 
-        where data is a numpy named array with columns of gridpointid, forecastid, and value
+        where data is a numpy named array with columns of forecastid, gridpointid, value and (optionally) runid,
+        or the same array already encoded with encodedata(). If runid is left out, it is looked up from the forecasts.
+        The array storage also needs the ord of each row, see setstorage.
 
         Class dependencies:
             self.conn
@@ -290,17 +831,195 @@ class Database:
             self._copybinary()
         """
 
+        # every row needs the run it belongs to, to land in the right partition
+        if not isinstance(data, (BytesIO, list)) and 'runid' not in data.dtype.names:
+            data = self._withrunid(data)
+
+        starttime = time.time()
+        if self.storage == 'arrays':
+            if not isinstance(data, list):
+                data = self.encodedata(data, ords)
+            self._sendarrays(data)
+            self._countsent(data, time.time() - starttime)
+            return
+
         try:
             # this will fail if there are duplicates, but it's way faster
             self.conn.commit()
             self._copybinary(data, 'data')
         except:
             # try to insert more safely
+            metrics.counter('forecasting_staging_fallbacks_total', 'COPYs that hit existing rows and went through the staging table').inc()
             self.conn.rollback()
-            self._copybinary(data, 'stagingdata')
-            self.curs.execute('select applystagingdata();')
+            self._createstaging()
+            self._copybinary(data, 'stagingsession', commit=False)
+            self._applystaging()
             self.conn.commit()
+        self._countsent(data, time.time() - starttime)
+
+    def _countsent(self,data,seconds):
+        """
+        COUNTSENT records the rows (values) written by senddata and the time it took
+        """
+
+        if isinstance(data, list):
+            nrows = sum([s[4] for s in data])
+        elif isinstance(data, BytesIO):
+            nrows = getattr(data, 'nrows', 0)
+        else:
+            nrows = len(data)
+        metrics.counter('forecasting_rows_sent_total', 'Values written to the database').inc(nrows, storage=self.storage)
+        metrics.histogram('forecasting_send_seconds', 'Time taken to write a batch of values to the database').observe(seconds, storage=self.storage)
+
+    def setconflict(self,conflict):
+        """
+        SETCONFLICT chooses what happens when data is sent for a forecast and gridpoint that are already in the database:
+        'keep' leaves the existing value alone (the default), 'overwrite' replaces it.
+
+        Usage:
+        d.setconflict('overwrite')
+
+        Class dependencies:
+            self.conflict
+        """
+
+        if conflict not in ('keep','overwrite'):
+            raise Exception('Unknown conflict mode %s, use keep or overwrite' % conflict)
+        self.conflict = conflict
+
+    def setstorage(self,storage,precision=None):
+        """
+        SETSTORAGE chooses how data is stored. 'rows' (the default) keeps a row per value in the data table. 'arrays' keeps
+        each slice of a forecast as one row of dataarrays, holding compressed arrays of the ords and the values, which
+        is many times smaller. With a precision, the values of the array storage are rounded to multiples of it,
+        which compresses better still.
+
+        Reads have to use the same storage as the writes. Calculated fields that can't be computed on the way in
+        (see Model.addcalculatedfield) need the rows storage.
 
+        Usage:
+        d.setstorage('arrays', precision=0.01)
+
+        Class dependencies:
+            self.storage
+            self.precision
+        """
+
+        if storage not in ('rows','arrays'):
+            raise Exception('Unknown storage %s, use rows or arrays' % storage)
+        self.storage = storage
+        self.precision = precision
+
+    def _withrunid(self,data):
+        """
+        WITHRUNID returns a copy of data with the runid of each row's forecast added as a column
+        """
+
+        forecastids = np.unique(data['forecastid'])
+        self.curs.execute("select forecastid, runid from forecasts where forecastid = any(%s);", ([int(f) for f in forecastids],))
+        runids = dict(self.curs.fetchall())
+        if len(runids) != len(forecastids):
+            raise Exception('Data sent for forecasts that do not exist')
+
+        dtype = [(name, data.dtype[name].str) for name in data.dtype.names] + [('runid','i4')]
+        withrunid = np.empty(data.shape,dtype)
+        for name in data.dtype.names:
+            withrunid[name] = data[name]
+        lookup = np.array([runids[f] for f in forecastids])
+        withrunid['runid'] = lookup[np.searchsorted(forecastids,data['forecastid'])]
+        return withrunid
+
+    def _createstaging(self):
+        """
+        CREATESTAGING makes sure the staging table of this session exists. It's a temporary table,
+        so concurrent loaders never see each other's rows, and it empties itself on commit.
+        """
+
+        self.curs.execute('create temp table if not exists stagingsession (like data) on commit delete rows;')
+
+    def _applystaging(self):
+        """
+        APPLYSTAGING moves the staged rows into data with a single upsert, keeping or overwriting existing
+        rows according to self.conflict. Duplicates within the staged rows are collapsed first.
+        """
+
+        if self.conflict == 'overwrite':
+            action = 'do update set value = excluded.value'
+        else:
+            action = 'do nothing'
+        self.curs.execute("""
+        insert into data (forecastid, gridpointid, value, runid)
+        select distinct on (forecastid, gridpointid) forecastid, gridpointid, value, runid
+        from stagingsession
+        order by forecastid, gridpointid
+        on conflict (forecastid, gridpointid, runid) {action};
+        truncate stagingsession;
+        """.format(action=action))
+
+
+    def encodedata(self,data,ords=None):
+        """
+        ENCODEDATA prepares a numpy named array for senddata. Encoding doesn't touch the database connection,
+        so it can be done on another thread while the previous batch is being sent. The array needs all four
+        columns of data, in order: forecastid, gridpointid, value and runid. The array storage also needs the ord of each row.
+
+        Usage:
+        cpy = d.encodedata(data)
+        d.senddata(cpy)
+
+        Class dependencies:
+            self._preparebinary()
+        """
+
+        if 'runid' not in data.dtype.names:
+            raise Exception('Encoded data needs a runid column, see getrunid')
+        with metrics.histogram('forecasting_encode_seconds', 'Time taken to encode a batch of values for the database').time(storage=self.storage):
+            if self.storage == 'arrays':
+                return self._encodearrays(data,ords)
+            return self._preparebinary(data)
+
+    def _encodearrays(self,data,ords):
+        """
+        ENCODEARRAYS turns the rows of data into a list of compressed slices for dataarrays, one per forecast.
+        Missing values are kept (as nan) so the ords of a slice stay contiguous.
+        """
+
+        if ords is None:
+            raise Exception('The array storage needs the ord of each row')
+        ords = np.asarray(ords)
+
+        slices = []
+        forecastids = np.unique(data['forecastid'])
+        for forecastid in forecastids:
+            rows = data['forecastid'] == forecastid
+            values = np.array(data['value'][rows], dtype='f4')
+            values[~(values < 1e10)] = np.nan
+            runid = data['runid'][rows][0]
+            slices.append((int(forecastid), int(runid)) + encodeslice(ords[rows], values, self.precision))
+        return slices
+
+    def _sendarrays(self,slices):
+        """
+        SENDARRAYS writes encoded slices into dataarrays with a single statement. A slice that is already stored
+        (the same forecast, first and last ord and number of cells) is kept or overwritten according to self.conflict.
+        Other slices are stored alongside, even where they overlap; the readers keep one value per cell.
+        """
+
+        if len(slices) == 0:
+            return
+        if self.conflict == 'overwrite':
+            action = 'do update set scale = excluded.scale, ords = excluded.ords, vals = excluded.vals'
+        else:
+            action = 'do nothing'
+        columns = zip(*slices)
+        q = """
+        insert into dataarrays (forecastid, runid, firstord, lastord, npoints, scale, ords, vals)
+        select * from unnest(%s::int[], %s::int[], %s::int[], %s::int[], %s::int[], %s::float8[], %s::bytea[], %s::bytea[])
+        on conflict (forecastid, firstord, lastord, npoints, runid) {action};
+        """.format(action=action)
+        self.conn.commit()
+        self.curs.execute(q, [list(c) for c in columns[:6]] + [[pg.Binary(b) for b in c] for c in columns[6:]])
+        self.conn.commit()
 
     def _preparebinary(self,dat):
         # found here: http://stackoverflow.com/questions/8144002/use-binary-copy-table-from-with-psycopg2
@@ -318,69 +1037,128 @@ class Database:
         cpy.write(pack('!11sii', b'PGCOPY\n\377\r\n\0', 0, 0))
         cpy.write(pgcopy.tostring())  # all rows
         cpy.write(pack('!h', -1))  # file trailer
+        cpy.nrows = len(dat)
         return(cpy)
 
-    def calculatefield(self,calcname,fieldnames,calculation, datatime):
+    def calculatefield(self,calcname,fieldnames,calculation,datatime,parameters=None):
         """
         CALCULATEFIELD runs a calculation based upon existing data and inserts it into the database
 
+        Every forecast of the run is calculated at once: the forecasts of the calculated field are created in bulk,
+        and a single insert joins the data of the dependents. The statement is prepared once per connection and
+        calculation, and run with the forecasts of each run as parameters, so the plan is reused from run to run.
+
+        Constants of the calculation can be passed as parameters, written as %(name)s in the calculation. The calculation
+        is checked first (see Calculation.validate): only arithmetic on the fieldnames, numbers and a handful of functions
+        make it into the statement.
+
         Usage:
-        d.calculatefield(self,calcname,fieldnames,calculation, datatime):
+        d.calculatefield('wnd10m', ['ugrd10m','vgrd10m'], 'sqrt(ugrd10m^2+vgrd10m^2)', datatime)
+        d.calculatefield('rhosfc', ['pressfc','tmpsfc'], 'pressfc/(tmpsfc*%(r)s)', datatime, {'r': 287.058})
 
         Class dependencies:
             self.dbmodelid
             self.conn
             self.curs
             self.getfieldid()
-            self.getforecastid()
+            self.getrunid()
+            self.getforecastids()
+            self._preparecalculation()
+            Calculation.validate()
         """
 
-        ## Grab all of the forecast datatimes
-        grps = ', '.join(map((lambda name: "min(CASE WHEN fld.name = '{name}' THEN forecastid else NULL end) as {name}".format(name=name)),fieldnames))
-        lst  = ', '.join(map((lambda name: "'{name}'".format(name=name)),fieldnames))
+        if self.storage != 'rows':
+            raise Exception('Calculated fields are only computed in the database with the rows storage')
+        if parameters == None:
+            parameters = {}
+        Calculation(calcname, fieldnames, calculation, parameters).validate()
 
-        ## returns datatime, datatimeforecast, forecastid1, forecastid2, ...
+        ## Grab the forecastids of every dependent, for each datatimeforecast and pressure
+        ## returns datatimeforecast, pressure_mb, forecastid1, forecastid2, ...
+        grps = ', '.join(['min(fcst.forecastid) filter (where fld.name = %s)'] * len(fieldnames))
         q = """
-        select datatime, datatimeforecast, pressure_mb, {grps}
+        select fcst.datatimeforecast, fcst.pressure_mb, {grps}
         from forecasts fcst
         inner join fields fld on fcst.fieldid = fld.fieldid
-        where fld.modelid = {modelid} and fld.name in ({lst}) and datatime = '{datatime}'
-        group by datatime, datatimeforecast, pressure_mb;
-        """.format(grps=grps, modelid=self.dbmodelid, lst=lst, datatime=datatime )
-        self.curs.execute(q)
+        where fld.modelid = %s and fld.name = any(%s) and fcst.datatime = %s
+        group by fcst.datatimeforecast, fcst.pressure_mb;
+        """.format(grps=grps)
+        self.curs.execute(q, list(fieldnames) + [self.dbmodelid, list(fieldnames), datatime])
         rows = self.curs.fetchall()
+        if any([None in row[2:] for row in rows]):
+            raise Exception('One or more fieldnames not present in database')
+        if len(rows) == 0:
+            return
 
-        ## create the calculated field for each forecast
+        ## create the forecasts of the calculated field in one go
         fieldid = self.getfieldid(calcname)
-        for row in rows:
-            datatime = row[0]
-            datatimeforecast = row[1]
-            pressure_mb = row[2]
-            forecastids = row[3:]
-            if any(map(lambda x: x==None,forecastids)): # if any are None
-                raise Exception('One or more fieldnames not present in database')
-            zipped = zip(forecastids, fieldnames)
-            grps = ', '.join(map((lambda x: "min(CASE WHEN forecastid = '{id}' THEN value else NULL end) as {name}".format(id=x[0],name=x[1])),zipped))
-            lst  = ', '.join(map((lambda x: "'{id}'".format(id=x[0])),zipped))
-            forecastid = self.getforecastid(fieldid,datatime,datatimeforecast, pressure_mb)
-            q = """
-            insert into stagingdata (gridpointid, forecastid, value) (
-                select gridpointid, {forecastid}, ({calculation}) as value
-                from (
-                    select gridpointid, {grps}
-                    from data
-                    where forecastid in ({lst})
-                    group by gridpointid
-                ) as foo
-            );
-            """.format(grps=grps, lst=lst, forecastid=forecastid, calculation=calculation)
-            try:
-                self.curs.execute(q, datatime)
-            except:
-                raise Exception('Bad Calculation')
-            self.curs.execute('select applystagingdata();')
+        runid = self.getrunid(datatime)
+        targets = self.getforecastids([(fieldid, datatime, row[0], row[1]) for row in rows])
+
+        ## and calculate all of them with a single statement
+        name, names = self._preparecalculation(fieldnames, calculation, sorted(parameters.keys()))
+        args = [[int(t) for t in targets]]
+        args += [[row[2+i] for row in rows] for i in range(len(fieldnames))]
+        args += [runid]
+        args += [float(parameters[n]) for n in names]
+        try:
+            self.curs.execute('execute %s (%s);' % (name, ', '.join(['%s'] * len(args))), args)
+        except pg.Error:
+            self.conn.rollback()
+            raise Exception('Bad Calculation')
         self.conn.commit()
 
+    def _preparecalculation(self,fieldnames,calculation,names):
+        """
+        PREPARECALCULATION prepares the statement behind calculatefield, unless it has been prepared on this connection before.
+        Returns the name of the statement and the order of the parameters of the calculation.
+
+        The statement takes the forecastids of the calculated field, then those of each dependent, as arrays in the
+        same order, then the runid and finally the parameters of the calculation.
+        """
+
+        key = (tuple(fieldnames), calculation, tuple(names), self.conflict)
+        if key in self.prepared:
+            return self.prepared[key], names
+
+        n = len(fieldnames)
+        expression = calculation
+        for i, parameter in enumerate(names):
+            expression = expression.replace('%%(%s)s' % parameter, '$%d::float8' % (n+3+i))
+
+        arrays = ', '.join(['$%d::int[]' % (i+1) for i in range(n+1)])
+        columns = ', '.join(['d%d.value as %s' % (i, f) for i, f in enumerate(fieldnames)])
+        fcols = ', '.join(['f%d' % i for i in range(n)])
+        joins = 'inner join data d0 on d0.forecastid = m.f0 and d0.runid = $%d' % (n+2)
+        for i in range(1, n):
+            joins += '\n            inner join data d{i} on d{i}.forecastid = m.f{i} and d{i}.runid = ${r} and d{i}.gridpointid = d0.gridpointid'.format(i=i, r=n+2)
+
+        if self.conflict == 'overwrite':
+            action = 'do update set value = excluded.value'
+        else:
+            action = 'do nothing'
+
+        name = 'calculation%d' % len(self.prepared)
+        q = """
+        prepare {name} as
+        insert into data (forecastid, gridpointid, value, runid)
+        select target, gridpointid, ({expression}), ${runid}
+        from (
+            select m.target, d0.gridpointid, {columns}
+            from unnest({arrays}) as m(target, {fcols})
+            {joins}
+        ) as dependents
+        on conflict (forecastid, gridpointid, runid) {action};
+        """.format(name=name, expression=expression, runid=n+2, columns=columns, arrays=arrays, fcols=fcols, joins=joins, action=action)
+        try:
+            self.curs.execute(q)
+            self.conn.commit()
+        except pg.Error:
+            self.conn.rollback()
+            raise Exception('Bad Calculation')
+        self.prepared[key] = name
+        return name, names
+
 
 
 
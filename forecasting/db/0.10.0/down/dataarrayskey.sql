@@ -0,0 +1,4 @@
+-- Table: dataarrays
+
+ALTER TABLE dataarrays DROP CONSTRAINT dataarrays_pkey;
+ALTER TABLE dataarrays ADD PRIMARY KEY (forecastid, firstord, runid);
@@ -0,0 +1,7 @@
+-- Table: dataarrays
+--
+-- Key the slices on their whole extent (first and last ord, and number of cells), so a slice that starts at
+-- the same cell as a stored one but covers other cells is stored next to it instead of being taken for it.
+
+ALTER TABLE dataarrays DROP CONSTRAINT dataarrays_pkey;
+ALTER TABLE dataarrays ADD PRIMARY KEY (forecastid, firstord, lastord, npoints, runid);
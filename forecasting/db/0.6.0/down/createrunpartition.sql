@@ -0,0 +1,4 @@
+-- Function: createrunpartition(integer)
+
+DROP FUNCTION createrunpartition(integer);
+
@@ -0,0 +1,4 @@
+-- Function: insertrun(integer, timestamp without time zone)
+
+DROP FUNCTION insertrun(integer, timestamp without time zone);
+
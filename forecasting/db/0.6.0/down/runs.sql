@@ -0,0 +1,4 @@
+-- Table: runs
+
+DROP TABLE runs;
+
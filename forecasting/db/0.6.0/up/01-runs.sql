@@ -0,0 +1,19 @@
+CREATE TABLE runs
+(
+  runid serial primary key,
+  modelid int not null,
+  datatime timestamp without time zone not null,
+  unique (modelid, datatime)
+);
+
+-- every existing forecast belongs to a run
+insert into runs (modelid, datatime)
+  select distinct fl.modelid, fc.datatime
+  from forecasts fc inner join fields fl on fc.fieldid = fl.fieldid;
+
+alter table forecasts add column runid int;
+update forecasts fc set runid = r.runid
+  from fields fl, runs r
+  where fc.fieldid = fl.fieldid and r.modelid = fl.modelid and r.datatime = fc.datatime;
+
+create index forecasts_idx_runid on forecasts using btree (runid);
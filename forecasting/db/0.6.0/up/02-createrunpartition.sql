@@ -0,0 +1,11 @@
+CREATE OR REPLACE FUNCTION createrunpartition(rid integer)
+  RETURNS void AS
+$BODY$
+BEGIN
+IF to_regclass('data_r' || rid) IS NULL THEN
+  EXECUTE format('CREATE TABLE data_r%s PARTITION OF data FOR VALUES IN (%s)', rid, rid);
+END IF;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 100;
@@ -0,0 +1,23 @@
+-- Table: data
+--
+-- data is partitioned by run: each (model, datatime) gets its own partition, data_r{runid},
+-- so old runs are removed by dropping their partition instead of deleting rows.
+
+ALTER TABLE data RENAME TO data_0_5_0;
+
+CREATE TABLE data
+(
+  forecastid int NOT NULL,
+  gridpointid int NOT NULL,
+  value real,
+  runid int NOT NULL,
+  PRIMARY KEY (forecastid, gridpointid, runid)
+) PARTITION BY LIST (runid);
+
+SELECT createrunpartition(runid) FROM runs;
+
+INSERT INTO data (forecastid, gridpointid, value, runid)
+  SELECT d.forecastid, d.gridpointid, d.value, fc.runid
+  FROM data_0_5_0 d INNER JOIN forecasts fc ON d.forecastid = fc.forecastid;
+
+DROP TABLE data_0_5_0;
@@ -0,0 +1,21 @@
+CREATE OR REPLACE FUNCTION insertrun(mid integer, tdatatime timestamp without time zone)
+  RETURNS integer AS
+$BODY$
+DECLARE
+  rval int;
+BEGIN
+select INTO rval runid from runs where runs.modelid = mid and runs.datatime = tdatatime;
+IF rval IS NULL THEN
+  -- loaders running side by side may create the same run, so take turns per model
+  PERFORM pg_advisory_xact_lock(mid);
+  select INTO rval runid from runs where runs.modelid = mid and runs.datatime = tdatatime;
+  IF rval IS NULL THEN
+    INSERT into runs (modelid, datatime) values (mid, tdatatime) returning runid into rval;
+    PERFORM createrunpartition(rval);
+  END IF;
+END IF;
+return rval;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 100;
@@ -0,0 +1,7 @@
+CREATE OR REPLACE FUNCTION applystagingdata() RETURNS void AS 
+'insert into data (forecastid, gridpointid, value, runid)
+select distinct on (s.forecastid, s.gridpointid) s.forecastid, s.gridpointid, s.value, fc.runid
+from stagingdata s inner join forecasts fc on s.forecastid = fc.forecastid
+order by s.forecastid, s.gridpointid
+on conflict (forecastid, gridpointid, runid) do nothing;
+delete from stagingdata;' language sql;
@@ -0,0 +1,3 @@
+-- Table: dataarrays
+
+DROP TABLE dataarrays;
@@ -0,0 +1,19 @@
+-- Table: dataarrays
+--
+-- The compact storage: one row per slice of a forecast (usually every requested cell of a geobound),
+-- instead of one row per cell. ords and vals are compressed arrays, see compact.py. A slice with a
+-- scale holds its values as integer multiples of the scale, otherwise as float32.
+-- Like data, the table is partitioned by run.
+
+CREATE TABLE dataarrays
+(
+  forecastid int NOT NULL,
+  runid int NOT NULL,
+  firstord int NOT NULL,
+  lastord int NOT NULL,
+  npoints int NOT NULL,
+  scale double precision,
+  ords bytea NOT NULL,
+  vals bytea NOT NULL,
+  PRIMARY KEY (forecastid, firstord, runid)
+) PARTITION BY LIST (runid);
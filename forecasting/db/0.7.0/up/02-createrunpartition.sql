@@ -0,0 +1,16 @@
+CREATE OR REPLACE FUNCTION createrunpartition(rid integer)
+  RETURNS void AS
+$BODY$
+BEGIN
+IF to_regclass('data_r' || rid) IS NULL THEN
+  EXECUTE format('CREATE TABLE data_r%s PARTITION OF data FOR VALUES IN (%s)', rid, rid);
+END IF;
+IF to_regclass('dataarrays_r' || rid) IS NULL THEN
+  EXECUTE format('CREATE TABLE dataarrays_r%s PARTITION OF dataarrays FOR VALUES IN (%s)', rid, rid);
+END IF;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 100;
+
+SELECT createrunpartition(runid) FROM runs;
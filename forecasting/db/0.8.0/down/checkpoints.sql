@@ -0,0 +1,3 @@
+-- Table: checkpoints
+
+DROP TABLE checkpoints;
@@ -0,0 +1,13 @@
+-- Table: checkpoints
+--
+-- The (run, field) units a backfill has completed, so a restarted backfill only does the remaining ones.
+-- scope tells transfers of the same field apart when they cover different geos or pressure levels.
+
+CREATE TABLE checkpoints
+(
+  runid int NOT NULL,
+  field varchar(50) NOT NULL,
+  scope varchar(40) NOT NULL,
+  completed timestamp without time zone NOT NULL DEFAULT (now() at time zone 'utc'),
+  PRIMARY KEY (runid, field, scope)
+);
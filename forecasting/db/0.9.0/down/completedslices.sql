@@ -0,0 +1,3 @@
+-- Table: completedslices
+
+DROP TABLE completedslices;
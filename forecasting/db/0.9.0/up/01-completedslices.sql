@@ -0,0 +1,13 @@
+-- Table: completedslices
+--
+-- The forecasts (one field, forecast time and level) whose values have all been written for a geobound,
+-- so a transfer that is retried or overlaps an earlier one only downloads the missing slices.
+-- scope tells the geobounds of the same forecast apart.
+
+CREATE TABLE completedslices
+(
+  runid int NOT NULL,
+  forecastid int NOT NULL,
+  scope varchar(40) NOT NULL,
+  PRIMARY KEY (runid, forecastid, scope)
+);
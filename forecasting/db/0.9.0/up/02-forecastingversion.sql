@@ -0,0 +1,12 @@
+CREATE OR REPLACE FUNCTION forecastingversion()
+  RETURNS varchar(10) AS
+$BODY$
+declare
+  rval varchar(10);
+begin
+  select into rval'0.9.0';
+  return rval;
+end
+$BODY$
+  LANGUAGE plpgsql VOLATILE
+  COST 100;
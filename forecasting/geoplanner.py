@@ -0,0 +1,101 @@
+import numpy as np
+
+class GeoPlanner:
+    """
+    GEOPLANNER turns a scattered set of requested grid cells into a few rectangles to download.
+
+    Every point geo (and each of its nearest neighbors) asks for a single cell. Fetching those one
+    at a time means a remote request per cell, per field. The planner merges nearby cells into
+    covering rectangles, as long as the share of unrequested cells in a rectangle stays under
+    maxwaste. Each rectangle comes back as a geobound with the ords of the cells that were actually
+    requested, so the extra cells can be dropped before they reach the database.
+
+    Usage:
+    p = GeoPlanner(nlat, nlon, maxwaste=0.5)
+    geobounds = p.plan([(ilat1, ilon1), (ilat2, ilon2), ...])
+
+    Each geobound looks like [[ilat start, ilat end, 1], [ilon start, ilon end, 1], ords]
+    """
+
+    nlat = None
+    nlon = None
+
+    # largest fraction of a rectangle that may be made of unrequested cells
+    maxwaste = 0.5
+
+    def __init__(self, nlat, nlon, maxwaste=None):
+        self.nlat = nlat
+        self.nlon = nlon
+        if maxwaste != None:
+            self.maxwaste = maxwaste
+
+    def plan(self, cells):
+        """
+        PLAN returns the list of geobounds covering the cells, a list of (ilat, ilon) pairs.
+        Every cell is assigned to exactly one geobound, so nothing is sent to the database twice.
+        """
+
+        cells = np.array(cells, dtype='i8').reshape(-1, 2)
+        if len(cells) == 0:
+            return []
+
+        # only the unique cells matter
+        ords = np.unique(cells[:,0]*self.nlon + cells[:,1])
+        ilat = ords // self.nlon
+        ilon = ords % self.nlon
+
+        # summed area table over the bounding box, to count requested cells in any rectangle
+        lat0 = ilat.min()
+        lon0 = ilon.min()
+        mask = np.zeros((ilat.max()-lat0+1, ilon.max()-lon0+1), dtype='i4')
+        mask[ilat-lat0, ilon-lon0] = 1
+        table = np.zeros((mask.shape[0]+1, mask.shape[1]+1), dtype='i4')
+        table[1:,1:] = mask.cumsum(0).cumsum(1)
+
+        # rectangles as [lat start, lat end, lon start, lon end], ends exclusive, relative to the bounding box
+        rects = np.empty((len(ords), 4), dtype='i8')
+        rects[:,0] = ilat - lat0
+        rects[:,1] = ilat - lat0 + 1
+        rects[:,2] = ilon - lon0
+        rects[:,3] = ilon - lon0 + 1
+
+        # greedily merge each rectangle with the partner that wastes the least, until nothing merges
+        merged = True
+        while merged:
+            merged = False
+            i = 0
+            while i < len(rects):
+                others = np.delete(np.arange(len(rects)), i)
+                if len(others) == 0:
+                    break
+                union = np.empty((len(others), 4), dtype='i8')
+                union[:,0] = np.minimum(rects[i,0], rects[others,0])
+                union[:,1] = np.maximum(rects[i,1], rects[others,1])
+                union[:,2] = np.minimum(rects[i,2], rects[others,2])
+                union[:,3] = np.maximum(rects[i,3], rects[others,3])
+                area = (union[:,1]-union[:,0])*(union[:,3]-union[:,2])
+                wanted = table[union[:,1],union[:,3]] - table[union[:,0],union[:,3]] - table[union[:,1],union[:,2]] + table[union[:,0],union[:,2]]
+                waste = area - wanted
+                ok = waste <= self.maxwaste*area
+                if np.any(ok):
+                    best = np.lexsort((area[ok], waste[ok]))[0]
+                    j = others[ok][best]
+                    rects[i] = union[np.nonzero(ok)[0][best]]
+                    rects = np.delete(rects, j, axis=0)
+                    if j < i:
+                        i -= 1
+                    merged = True
+                else:
+                    i += 1
+
+        # hand out each requested cell to the first rectangle containing it
+        assigned = np.zeros(len(ords), dtype=bool)
+        geobounds = []
+        for s, n, w, e in rects:
+            inside = ~assigned & (ilat-lat0 >= s) & (ilat-lat0 < n) & (ilon-lon0 >= w) & (ilon-lon0 < e)
+            if not np.any(inside):
+                continue
+            assigned |= inside
+            geobounds.append([[int(s+lat0), int(n+lat0), 1], [int(w+lon0), int(e+lon0), 1], ords[inside]])
+
+        return geobounds
@@ -0,0 +1,537 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import Queue
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import util
+
+# pygrib decodes every packing; without it only simple packing (template 5.0) can be read
+try:
+    import pygrib
+except ImportError:
+    pygrib = None
+
+# the value of missing data, as the OPeNDAP server sends it
+MISSING = 9.999e20
+
+# the fields of the NOMADS OPeNDAP datasets, as the (variable, level) of the GRIB2 inventories.
+# A level of 'mb' stands for every pressure level.
+FIELDS = {
+    'tmp2m': ('TMP', '2 m above ground'),
+    'rh2m': ('RH', '2 m above ground'),
+    'ugrd10m': ('UGRD', '10 m above ground'),
+    'vgrd10m': ('VGRD', '10 m above ground'),
+    'tmpsfc': ('TMP', 'surface'),
+    'pressfc': ('PRES', 'surface'),
+    'hgtsfc': ('HGT', 'surface'),
+    'hpblsfc': ('HPBL', 'surface'),
+    'apcpsfc': ('APCP', 'surface'),
+    'tcdcclm': ('TCDC', 'entire atmosphere'),
+    'prmslmsl': ('PRMSL', 'mean sea level'),
+    'tmpprs': ('TMP', 'mb'),
+    'hgtprs': ('HGT', 'mb'),
+    'rhprs': ('RH', 'mb'),
+    'ugrdprs': ('UGRD', 'mb'),
+    'vgrdprs': ('VGRD', 'mb'),
+    'vvelprs': ('VVEL', 'mb'),
+    'tkeprs': ('TKE', 'mb'),
+}
+
+def parseinventory(text, size=None):
+    """
+    Parse a GRIB2 inventory (a .idx file, as written by wgrib2 -s) into a list of messages, in the order of the file.
+    Each message is a dictionary with its variable, level, forecast, the datatime of the run and its byte range
+    [start, end) in the file. The last message ends at size, or at None if the size of the file isn't known.
+
+    Usage:
+    messages = parseinventory(open('gfs.t00z.pgrb2.0p25.f006.idx').read())
+    messages[0]  # {'variable': 'PRMSL', 'level': 'mean sea level', 'start': 0, 'end': 1003285, ...}
+    """
+
+    messages = []
+    for line in text.splitlines():
+        parts = line.split(':')
+        if len(parts) < 6:
+            continue
+        date = re.match('d=(\d{10})', parts[2])
+        messages.append({'number': parts[0],
+                         'start': int(parts[1]),
+                         'end': None,
+                         'datatime': datetime.strptime(date.group(1), '%Y%m%d%H') if date else None,
+                         'variable': parts[3],
+                         'level': parts[4],
+                         'forecast': parts[5]})
+
+    # a message ends where the next one (leaving out the submessages of the same message) starts
+    starts = sorted(set([m['start'] for m in messages]))
+    for m in messages:
+        later = starts[np.searchsorted(starts, m['start'], side='right'):]
+        m['end'] = later[0] if len(later) > 0 else size
+    return messages
+
+def select(messages, variable, level):
+    """
+    SELECT the messages of a field. Returns a list of (lev, message) pairs: a single pair with lev None for a field
+    on one level, or a pair per pressure level (in mb, highest pressure first) for a level of 'mb'.
+    The first message of each level is taken, so a field listed twice (like two accumulations) isn't read twice.
+    """
+
+    found = {}
+    for m in messages:
+        if m['variable'] != variable:
+            continue
+        if level == 'mb':
+            match = re.match('^(\d+(?:\.\d+)?) mb$', m['level'])
+            if match and float(match.group(1)) not in found:
+                found[float(match.group(1))] = m
+        elif m['level'] == level and None not in found:
+            found[None] = m
+    return [(lev, found[lev]) for lev in sorted(found, reverse=True)]
+
+def mergeranges(ranges, gap=0):
+    """
+    MERGERANGES merges [start, end) byte ranges that touch, overlap or are at most gap bytes apart, so they can be
+    read in as few requests as possible. An end of None runs to the end of the file. Returns the merged ranges, sorted.
+
+    Usage:
+    mergeranges([(0, 100), (100, 250), (400, None)])  # [(0, 250), (400, None)]
+    """
+
+    merged = []
+    for start, end in sorted(ranges, key=lambda r: r[0]):
+        if len(merged) > 0 and (merged[-1][1] == None or start <= merged[-1][1] + gap):
+            if merged[-1][1] != None:
+                merged[-1][1] = None if end == None else max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+def parallel(calls, connections):
+    """
+    PARALLEL runs a list of functions on up to connections threads, and returns their results in order.
+    If any of them fails, the first error is raised once they're all done.
+    """
+
+    if connections <= 1 or len(calls) <= 1:
+        return [call() for call in calls]
+
+    tasks = Queue.Queue()
+    for i, call in enumerate(calls):
+        tasks.put((i, call))
+    results = [None]*len(calls)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                i, call = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = call()
+            except Exception, e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in range(min(connections, len(calls)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+def decode(data):
+    """
+    DECODE a GRIB2 message on a regular lat/lon grid. Returns (values, lat, lon), with values as [lat, lon],
+    the latitudes ascending and missing values set to MISSING.
+
+    pygrib is used when it's installed. Without it, messages packed with simple packing (template 5.0) on a
+    lat/lon grid (template 3.0) are decoded here; other packings (like the complex packing of the NOMADS files)
+    need pygrib.
+    """
+
+    if pygrib != None:
+        grb = pygrib.fromstring(str(data))
+        values = grb.values
+        if np.ma.isMaskedArray(values):
+            values = values.filled(MISSING)
+        lats, lons = grb.latlons()
+        lat = lats[:,0]
+        lon = lons[0,:]
+    else:
+        values, lat, lon = _decodesimple(data)
+
+    values = np.asarray(values, dtype='f4')
+    if len(lat) > 1 and lat[0] > lat[-1]:
+        values = values[::-1]
+        lat = lat[::-1]
+    return values, np.asarray(lat, dtype='f8'), np.asarray(lon, dtype='f8')
+
+def _signed(value, nbytes):
+    # GRIB2 keeps the sign in the highest bit
+    sign = 1 << (8*nbytes - 1)
+    if value & sign:
+        return -(value & (sign - 1))
+    return value
+
+def _decodesimple(data):
+    """
+    Decode a message with a lat/lon grid and simple packing, without pygrib
+    """
+
+    if data[0:4] != 'GRIB' or ord(data[7]) != 2:
+        raise Exception('Not a GRIB2 message')
+
+    # the sections, by number
+    sections = {}
+    offset = 16
+    while offset < len(data) and data[offset:offset+4] != '7777':
+        length = struct.unpack_from('>I', data, offset)[0]
+        sections[ord(data[offset+4])] = data[offset:offset+length]
+        offset += length
+
+    grid = sections[3]
+    if struct.unpack_from('>H', grid, 12)[0] != 0:
+        raise Exception('Decoding this grid needs pygrib')
+    ni, nj = struct.unpack_from('>II', grid, 30)
+    la1, lo1 = [_signed(v, 4)*1e-6 for v in struct.unpack_from('>II', grid, 46)]
+    la2, lo2 = [_signed(v, 4)*1e-6 for v in struct.unpack_from('>II', grid, 55)]
+    scanning = ord(grid[71])
+
+    packing = sections[5]
+    if struct.unpack_from('>H', packing, 9)[0] != 0:
+        raise Exception('Decoding this packing needs pygrib')
+    npoints = struct.unpack_from('>I', sections[5], 5)[0]
+    r = struct.unpack_from('>f', packing, 11)[0]
+    e = _signed(struct.unpack_from('>H', packing, 15)[0], 2)
+    d = _signed(struct.unpack_from('>H', packing, 17)[0], 2)
+    nbits = ord(packing[19])
+
+    # unpack the nbits integers
+    if nbits == 0:
+        packed = np.zeros(npoints)
+    else:
+        bits = np.unpackbits(np.frombuffer(sections[7][5:], dtype='u1'))[:npoints*nbits]
+        packed = np.dot(np.reshape(bits, (npoints, nbits)).astype('i8'), 2**np.arange(nbits - 1, -1, -1, dtype='i8'))
+    decoded = (r + packed*2.**e)/10.**d
+
+    # points left out by the bitmap are missing
+    bitmap = sections.get(6)
+    if bitmap != None and ord(bitmap[5]) == 0:
+        present = np.unpackbits(np.frombuffer(bitmap[6:], dtype='u1'))[:ni*nj].astype(bool)
+        values = np.empty(ni*nj)
+        values.fill(MISSING)
+        values[present] = decoded[:np.count_nonzero(present)]
+    else:
+        values = decoded
+
+    # rows go along i (west to east unless flagged), and north to south unless flagged
+    values = np.reshape(values, (nj, ni))
+    lat = np.linspace(la1, la2, nj)
+    if lo2 < lo1 and not scanning & 0x80:
+        lo2 += 360.
+    lon = np.linspace(lo1, lo2, ni)
+    if scanning & 0x80:
+        values = values[:,::-1]
+        lon = lon[::-1]
+    return values, lat, lon
+
+class LocalFile:
+    """
+    LOCALFILE is a GRIB2 file on local disk, with its inventory alongside it (path + '.idx'). The file is
+    memory-mapped, so reading a message only touches its own pages.
+    """
+
+    path = ''
+
+    # bytes between messages that are read anyway, rather than splitting the read
+    gap = 0
+
+    # reads are views of the memory map, not copies
+    mapped = True
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isfile(path + '.idx'):
+            raise Exception('No inventory for %s, write one with wgrib2 -s %s > %s.idx' % (path, path, path))
+        self.messages = parseinventory(open(path + '.idx').read(), os.path.getsize(path))
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def fetch(self, start, end):
+        """
+        FETCH a view of the bytes of the [start, end) range
+        """
+        if end == None:
+            end = len(self.map)
+        return buffer(self.map, start, end - start)
+
+class RemoteFile:
+    """
+    REMOTEFILE is a GRIB2 file on an http server, with its inventory alongside it (url + '.idx'), like the files on
+    NOMADS. Messages are downloaded with Range requests, through the shared connections of util.request, so only
+    the fields that are transferred are downloaded.
+    """
+
+    url = ''
+
+    # bytes between messages that are downloaded anyway, rather than making another request
+    gap = 64*1024
+
+    mapped = False
+
+    def __init__(self, url, inventory=None):
+        """
+        Initialize the file with its url. The inventory is downloaded, unless its text is given.
+        """
+        self.url = url
+        if inventory == None:
+            resp, inventory = util.request(url + '.idx')
+            if resp.status != 200:
+                raise Exception('Could not read the inventory of %s: %s' % (url, resp.status))
+        self.messages = parseinventory(inventory)
+
+    def fetch(self, start, end):
+        """
+        FETCH the bytes of the [start, end) range; an end of None runs to the end of the file
+        """
+        byterange = 'bytes=%d-%s' % (start, '' if end == None else end - 1)
+        resp, data = util.request(self.url, {'range': byterange})
+        if resp.status == 206:
+            return data
+        if resp.status == 200:
+            # the server sent the whole file
+            return data[start:end]
+        raise Exception('Could not download %s of %s: %s' % (byterange, self.url, resp.status))
+
+class Field:
+    """
+    FIELD puts a field of the GRIB2 files of a run (one file per forecast hour) together into something that
+    looks like a grid of an OPeNDAP dataset: its array is sliced as [time, lev, lat, lon] (or [time, lat, lon]),
+    and it has the time, lev, lat and lon axes. The messages are read and decoded when the array is sliced.
+    """
+
+    name = ''
+    dimensions = ()
+    shape = ()
+
+    def __init__(self, name, dataset, variable, level):
+        self.name = name
+        self.dataset = dataset
+
+        # the messages of each forecast hour, by level
+        self.messages = []
+        for fhour, f in dataset.files:
+            self.messages.append(dict(select(f.messages, variable, level)))
+        levs = sorted(set(sum([m.keys() for m in self.messages], [])), reverse=True)
+        if len(levs) == 0:
+            raise Exception('%s is not in the inventory' % name)
+        if level == 'mb':
+            # every pressure field shares the same levels, the ones a field lacks are missing
+            levs = dataset.levels()
+
+        runs = [m['datatime'] for messages in self.messages for m in messages.values() if m['datatime'] != None]
+        run = runs[0] if len(runs) > 0 else datetime(1, 1, 1)
+        # days since 0001-01-01 (plus one), as the OPeNDAP server sends them
+        self.time = np.array([ordinal(run + timedelta(hours=fhour)) for fhour, f in dataset.files])
+
+        self.levs = levs
+        self.lat, self.lon = dataset.grid(self)
+        if levs == [None]:
+            self.lev = np.array([])
+            self.dimensions = ('time', 'lat', 'lon')
+            self.shape = (len(self.time), len(self.lat), len(self.lon))
+        else:
+            self.lev = np.array(levs)
+            self.dimensions = ('time', 'lev', 'lat', 'lon')
+            self.shape = (len(self.time), len(self.lev), len(self.lat), len(self.lon))
+        self.array = _Array(self)
+
+    def first(self):
+        """
+        FIRST returns the file and the first message of the field
+        """
+        for (fhour, f), messages in zip(self.dataset.files, self.messages):
+            for lev in self.levs:
+                if lev in messages:
+                    return f, messages[lev]
+
+class _Array:
+    def __init__(self, field):
+        self.field = field
+        self.shape = field.shape
+
+    def __getitem__(self, index):
+        field = self.field
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),)*(len(field.shape) - len(index))
+
+        # integers pick a single item, and take away the axis
+        squeeze = tuple([i for i, s in enumerate(index) if not isinstance(s, slice)])
+        index = tuple([s if isinstance(s, slice) else slice(s, s + 1 if s != -1 else None) for s in index])
+        itimes = np.arange(field.shape[0])[index[0]]
+        levs = field.levs if len(field.shape) == 3 else list(np.array(field.levs)[index[1]])
+
+        # read the messages of each forecast hour together
+        requests = []
+        for it in itimes:
+            f = field.dataset.files[it][1]
+            requests.append((f, [field.messages[it].get(lev) for lev in levs]))
+        datas = field.dataset.read(requests)
+
+        values = np.empty((len(itimes), len(levs), len(np.arange(field.shape[-2])[index[-2]]), len(np.arange(field.shape[-1])[index[-1]])), dtype='f4')
+        values.fill(MISSING)
+        for i, data in enumerate(datas):
+            for j, message in enumerate(data):
+                if message != None:
+                    values[i,j] = decode(message)[0][index[-2],index[-1]]
+
+        if len(field.shape) == 3:
+            values = values[:,0]
+        if len(squeeze) > 0:
+            values = values.squeeze(axis=squeeze)
+        return values
+
+class Dataset:
+    """
+    DATASET holds the GRIB2 files of a run, one per forecast hour, and hands out its fields as they are asked for.
+    Fields are named as on the OPeNDAP server, and looked up in the inventories by the (variable, level) of FIELDS,
+    or of the fields given.
+
+    Only regular lat/lon grids are supported; the grid is read from the first message asked for. The fields on
+    pressure levels share one lev axis, every level of any of them (see levels), so they line up level by level like
+    on the OPeNDAP server.
+
+    The messages of a slice are read together: the ranges of each file are merged (see mergeranges), and the
+    reads are spread over connections threads. The messages downloaded from a server are kept, up to maxcache bytes
+    (the least recently used go first), so the slices of the other geobounds of a field come from memory. Local files
+    are read straight from their memory maps, and aren't kept.
+
+    Usage:
+    ds = Dataset([(0, LocalFile('gfs.t00z.pgrb2.0p25.f000')), (3, LocalFile('gfs.t00z.pgrb2.0p25.f003'))])
+    ds['tmp2m'].array[:, 10:20, 10:20]
+    """
+
+    # reads made at the same time
+    connections = 1
+
+    # bytes of downloaded messages kept
+    maxcache = 256*1024*1024
+
+    def __init__(self, files, fields=None, connections=None, maxcache=None):
+        self.files = sorted(files, key=lambda f: f[0])
+        self.fields = dict(FIELDS)
+        if fields != None:
+            self.fields.update(fields)
+        if connections != None:
+            self.connections = connections
+        if maxcache != None:
+            self.maxcache = maxcache
+        self.axes = None
+        self.pressure = None
+        self.cache = {}
+        # the bytes of the messages downloaded, by (file, start), least recently used first
+        self.data = OrderedDict()
+        self.databytes = 0
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            if name not in self.fields:
+                raise Exception('Unknown GRIB2 field %s, give its variable and level' % name)
+            variable, level = self.fields[name]
+            self.cache[name] = Field(name, self, variable, level)
+        return self.cache[name]
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def grid(self, field):
+        """
+        GRID returns the lat and lon axes, read from the first message of a field the first time around
+        """
+        if self.axes == None:
+            f, message = field.first()
+            values, lat, lon = decode(self.read([(f, [message])])[0][0])
+            self.axes = (lat, lon)
+        return self.axes
+
+    def levels(self):
+        """
+        LEVELS returns the pressure levels (in mb, highest pressure first) of every field on pressure levels in the files
+        """
+        if self.pressure == None:
+            levs = set()
+            for variable, level in set(self.fields.values()):
+                if level != 'mb':
+                    continue
+                for fhour, f in self.files:
+                    levs.update([lev for lev, m in select(f.messages, variable, level)])
+            self.pressure = sorted(levs, reverse=True)
+        return self.pressure
+
+    def read(self, requests):
+        """
+        READ the messages of a list of (file, messages) requests. Returns the bytes of each message, None for
+        messages that are None.
+        """
+
+        # the messages downloaded before
+        found = {}
+        for f, messages in requests:
+            for m in messages:
+                key = (f, m['start']) if m != None else None
+                if key in self.data:
+                    found[key] = self.data.pop(key)
+                    self.data[key] = found[key]
+
+        # the merged ranges of every file that are left, read all at once
+        fetches = []
+        for f, messages in requests:
+            ranges = [(m['start'], m['end']) for m in messages if m != None and (f, m['start']) not in found]
+            for start, end in mergeranges(ranges, f.gap):
+                fetches.append((f, start, end))
+        datas = parallel([lambda f=f, start=start, end=end: f.fetch(start, end) for f, start, end in fetches], self.connections)
+
+        # cut the messages back out, as views of the memory maps of local files
+        for f, messages in requests:
+            for m in messages:
+                if m == None or (f, m['start']) in found:
+                    continue
+                for (g, start, end), fetched in zip(fetches, datas):
+                    if g is f and start <= m['start'] and (end == None or (m['end'] != None and m['end'] <= end)):
+                        size = (m['end'] if m['end'] != None else start + len(fetched)) - m['start']
+                        if f.mapped:
+                            found[(f, m['start'])] = buffer(fetched, m['start'] - start, size)
+                        else:
+                            found[(f, m['start'])] = fetched[m['start']-start:m['start']-start+size]
+                            self._keep((f, m['start']), found[(f, m['start'])])
+                        break
+
+        return [[None if m == None else found[(f, m['start'])] for m in messages] for f, messages in requests]
+
+    def _keep(self, key, data):
+        """
+        Keep the bytes of a downloaded message, dropping the least recently used ones beyond maxcache bytes
+        """
+        self.data[key] = data
+        self.databytes += len(data)
+        while self.databytes > self.maxcache and len(self.data) > 0:
+            dropped = self.data.popitem(last=False)[1]
+            self.databytes -= len(dropped)
+
+def ordinal(datatime):
+    """
+    The days since 0001-01-01 (plus one) of a datetime, as the OPeNDAP server gives its times
+    """
+    return datatime.toordinal() + 1 + (datatime - datetime(datatime.year, datatime.month, datatime.day)).total_seconds()/86400.
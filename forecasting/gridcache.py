@@ -0,0 +1,108 @@
+import json
+import os
+
+import numpy as np
+
+class GridCache:
+    """
+    GRIDCACHE keeps the grid metadata of a model (lat, lon, lev and gridpointids) on local disk.
+
+    Rebuilding the grid metadata means asking the remote server for the latest run, opening it
+    to read the axes and pulling every gridpointid back out of the database. The cache stores
+    those arrays as .npy files which are memory-mapped on load, alongside a small json file
+    with the grid shape and the fingerprint of the database grid they were built against.
+
+    Usage:
+    c = GridCache('nam')
+    grid = c.load(fingerprint)
+    if grid == None:
+        c.save(fingerprint, lat, lon, lev, gridpointids)
+    """
+
+    # where the caches live, one directory per model
+    directory = '/tmp/forecasting-cache/'
+    modelname = ''
+
+    # the arrays kept for each model
+    arrays = ['lat','lon','lev','gridpointids']
+
+    def __init__(self, modelname, directory=None):
+        """
+        Initialize the cache for a model. The directory defaults to /tmp/forecasting-cache/
+        """
+        self.modelname = modelname
+        if directory != None:
+            self.directory = directory
+
+    def path(self, name):
+        """
+        Path of a file in the model's cache directory
+        """
+        return os.path.join(self.directory, self.modelname, name)
+
+    def load(self, fingerprint):
+        """
+        LOAD returns a dictionary with lat, lon, lev, gridpointids, nlat, nlon and nlev if a cache
+        built against the given fingerprint exists. Otherwise, returns None.
+
+        The arrays are opened read-only with np.load(mmap_mode='r').
+        """
+
+        try:
+            meta = json.load(open(self.path('grid.json'),'r'))
+        except (IOError, ValueError):
+            return None
+
+        if meta.get('fingerprint') != fingerprint:
+            return None
+
+        grid = {}
+        try:
+            for name in self.arrays:
+                grid[name] = np.load(self.path(name + '.npy'), mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+
+        grid['nlat'] = meta['nlat']
+        grid['nlon'] = meta['nlon']
+        grid['nlev'] = meta['nlev']
+        if len(grid['gridpointids']) != grid['nlat']*grid['nlon']:
+            return None
+        return grid
+
+    def save(self, fingerprint, lat, lon, lev, gridpointids):
+        """
+        SAVE writes the grid arrays to disk. Each file is written to a temporary name and renamed
+        into place, with the json metadata last, so a reader never sees a half written cache.
+        """
+
+        directory = self.path('')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # invalidate whatever is there before touching the arrays
+        if os.path.exists(self.path('grid.json')):
+            os.remove(self.path('grid.json'))
+
+        values = {'lat': lat, 'lon': lon, 'lev': lev, 'gridpointids': gridpointids}
+        for name in self.arrays:
+            filename = self.path(name + '.npy')
+            f = open(filename + '.tmp','wb')
+            np.save(f, np.asarray(values[name]))
+            f.close()
+            os.rename(filename + '.tmp', filename)
+
+        meta = {'fingerprint': fingerprint, 'nlat': len(lat), 'nlon': len(lon), 'nlev': len(lev)}
+        f = open(self.path('grid.json.tmp'),'w')
+        json.dump(meta, f)
+        f.close()
+        os.rename(self.path('grid.json.tmp'), self.path('grid.json'))
+
+    def clear(self):
+        """
+        CLEAR removes the cache for the model
+        """
+
+        for name in ['grid.json'] + [name + '.npy' for name in self.arrays]:
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
@@ -0,0 +1,250 @@
+import os
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+# Buckets (upper bounds, in seconds) of the histograms of durations
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600)
+
+class Metric:
+    """
+    METRIC is the base of the counters and histograms: a named value for each combination of labels.
+    """
+
+    kind = ''
+    name = ''
+    help = ''
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def _labels(self, key, extra=()):
+        pairs = list(key) + list(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for k, v in pairs])
+
+    def exposition(self):
+        """
+        EXPOSITION returns the metric in the Prometheus text format
+        """
+
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            for key in sorted(self.values):
+                lines.extend(self._samples(key, self.values[key]))
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    """
+    COUNTER counts things that only go up, like bytes downloaded.
+
+    Usage:
+    c = counter('forecasting_http_bytes_total', 'Bytes downloaded')
+    c.inc(len(body), host='nomads.ncep.noaa.gov')
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """
+        GET returns the count for a set of labels
+        """
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+    def _samples(self, key, value):
+        return ['%s%s %s' % (self.name, self._labels(key), repr(float(value)))]
+
+class Histogram(Metric):
+    """
+    HISTOGRAM keeps the distribution of measurements, like the time taken by a query, as counts in buckets.
+
+    Usage:
+    h = histogram('forecasting_copy_seconds', 'Time taken by a COPY')
+    with h.time():
+        copy()
+    """
+
+    kind = 'histogram'
+    buckets = BUCKETS
+
+    def __init__(self, name, help='', buckets=None):
+        Metric.__init__(self, name, help)
+        if buckets != None:
+            self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0]*len(self.buckets), 0., 0]
+            counts = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, **labels):
+        """
+        TIME returns a context manager that observes the time taken by its block
+        """
+        return _Timer(self, labels)
+
+    def get(self, **labels):
+        """
+        GET returns the (count, sum) for a set of labels
+        """
+        with self.lock:
+            counts = self.values.get(self._key(labels))
+            if counts == None:
+                return 0, 0.
+            return counts[2], counts[1]
+
+    def _samples(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts[0]):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, self._labels(key, [('le', repr(float(bound)))]), cumulative))
+        lines.append('%s_bucket%s %d' % (self.name, self._labels(key, [('le', '+Inf')]), counts[2]))
+        lines.append('%s_sum%s %s' % (self.name, self._labels(key), repr(float(counts[1]))))
+        lines.append('%s_count%s %d' % (self.name, self._labels(key), counts[2]))
+        return lines
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+# every metric of the process, by name
+_registry = {}
+_registrylock = threading.Lock()
+
+def counter(name, help=''):
+    """
+    The counter of a given name, created on first use
+    """
+    return _register(Counter, name, help)
+
+def histogram(name, help='', buckets=None):
+    """
+    The histogram of a given name, created on first use
+    """
+    return _register(Histogram, name, help, buckets)
+
+def _register(cls, name, help, *args):
+    with _registrylock:
+        if name not in _registry:
+            _registry[name] = cls(name, help, *args)
+        metric = _registry[name]
+    if not isinstance(metric, cls):
+        raise Exception('Metric %s is already a %s' % (name, metric.kind))
+    return metric
+
+def exposition():
+    """
+    EXPOSITION returns every metric in the Prometheus text format
+    """
+    with _registrylock:
+        metrics = [_registry[name] for name in sorted(_registry)]
+    return ''.join([metric.exposition() for metric in metrics])
+
+def reset():
+    """
+    Forget every metric
+    """
+    with _registrylock:
+        _registry.clear()
+
+def write(path):
+    """
+    Write every metric to a file in the Prometheus text format (as read by node_exporter's textfile collector).
+    The file is written under a temporary name and renamed into place, so readers never see half of it.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    f = os.fdopen(fd, 'w')
+    try:
+        f.write(exposition())
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(port, host='127.0.0.1'):
+    """
+    Serve the metrics at http://host:port/metrics from a background thread. Returns the server; call shutdown() to stop it.
+
+    Usage:
+    metrics.serve(9108)
+    """
+
+    server = _Server((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def start(port=None, host='127.0.0.1', file=None, interval=60):
+    """
+    Expose the metrics as set in the metrics section of a config: over http on a port, and/or in a file rewritten
+    every interval seconds.
+    """
+
+    if port != None:
+        serve(port, host)
+    if file != None:
+        def rewrite():
+            while True:
+                try:
+                    write(file)
+                except (IOError, OSError), e:
+                    print 'Could not write the metrics to %s: %s' % (file, e)
+                time.sleep(interval)
+        thread = threading.Thread(target=rewrite)
+        thread.daemon = True
+        thread.start()
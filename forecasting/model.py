@@ -1,19 +1,25 @@
 # built-in libraries
 from datetime import date, datetime, timedelta
 import glob
+import hashlib
+import json
 import os
-import re
-import urllib2
+import Queue
+import threading
+import time
 
 # third party libraries
 import numpy as np
-from pydap.client import open_url
-import pydap.lib
-pydap.lib.CACHE = "/tmp/pydap-cache/"
 
 # local libraries
+import metrics
+from calculation import Calculation
 from database import Database
-import util
+from geoplanner import GeoPlanner
+from gridcache import GridCache
+from pipeline import Pipeline
+from slabcache import SlabCache
+from sources import OpendapSource
 
 class Model:
     """
@@ -50,10 +56,41 @@ class Model:
 
     # database
     database = None
+    connargs = {}
+    conflict = 'keep'
+
+    # number of fields transferred at the same time
+    workers = 1
+
+    # local cache of the grid metadata, and whether the grid came from it
+    gridcache = None
+    gridcached = False
+
+    # local cache of the downloaded hyperslabs, see setslabcache
+    slabcache = None
+
+    # where the runs are read from (see setserver and setsource), and the runs available there
+    source = None
+    runs = None
+
+    # largest fraction of unrequested cells when merging point geos into rectangles, see _plangeos
+    geowaste = 0.5
 
     # calculated fields
     calcfields = []
 
+    # chunking of the downloads, see setchunking
+    chunktimes = None
+    chunklevs = None
+    maxmemory = None
+
+    # slices waiting between the download, encoding and copy stages
+    pipelinedepth = 2
+
+    # how the data is stored, see setstorage
+    storage = 'rows'
+    precision = None
+
     # misc
     fpath = os.path.dirname(os.path.abspath(__file__))
 
@@ -67,8 +104,9 @@ class Model:
         Initilize the model with a modelname and set the url for the datafeed
         """
         self.modelname = modelname
-        self.baseurl = 'http://nomads.ncep.noaa.gov:9090/dods/{model}/{model}{date}/{model}_{hour}z'.format(model=modelname,date='{date}',hour='{hour}')
-        self.timeurl = 'http://nomads.ncep.noaa.gov:9090/dods/{model}'.format(model=modelname)
+        self.calcfields = []
+        self.setserver('http://nomads.ncep.noaa.gov:9090/dods')
+        self.gridcache = GridCache(modelname)
 
     def connect(self, **connargs):
         """
@@ -84,7 +122,146 @@ class Model:
         pg.connect(PUT_ARGUMENTS_HERE)
         """
 
-        self.database = Database(**connargs)
+        self.connargs = connargs
+        self.database = self._newdatabase()
+
+    def setconflict(self, conflict):
+        """
+        Choose what happens to data that is transferred again for a forecast that is already in the database:
+        'keep' leaves the stored values alone (the default), 'overwrite' replaces them.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.connect(database='weather')
+        m.setconflict('overwrite')
+        """
+
+        if self.database != None:
+            self.database.setconflict(conflict)
+        self.conflict = conflict
+
+    def setserver(self, url):
+        """
+        Set the OPeNDAP server the runs are downloaded from, laid out like NOMADS: url/{model} lists the days,
+        url/{model}/{model}{date} the runs of a day and url/{model}/{model}{date}/{model}_{hour}z is a run.
+        The default is http://nomads.ncep.noaa.gov:9090/dods
+
+        Usage:
+        m = forecasting.model('nam')
+        m.setserver('http://localhost:8001/dods')
+        """
+
+        self.setsource(OpendapSource(self.modelname, url))
+
+    def setsource(self, source):
+        """
+        Set where the runs are read from: an OpendapSource (the default, see setserver), a FileSource to load runs
+        that are already on local disk, as NetCDF or GRIB2 files, or a GribSource to download only the GRIB2 messages
+        of the transferred fields from a file server. Transfers work the same way whatever the source.
+
+        Usage:
+        m = forecasting.model('gfs')
+        m.setsource(FileSource('gfs', '/data/gfs/gfs.{date}/{hour}/gfs.t{hour}z.pgrb2.0p25.f{fhour}'))
+        """
+
+        self.source = source
+        self.baseurl = source.baseurl
+        self.timeurl = source.timeurl
+        self.runs = source.runs
+
+    def setgridcache(self, directory):
+        """
+        Set the directory used to cache the grid metadata (lat, lon, lev and gridpointids) between transfers.
+        The default is /tmp/forecasting-cache/. Passing None disables the cache.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.setgridcache('/var/cache/forecasting')
+        """
+
+        if directory == None:
+            self.gridcache = None
+        else:
+            self.gridcache = GridCache(self.modelname, directory)
+
+    def setslabcache(self, directory, maxbytes=None):
+        """
+        Keep the data downloaded from the remote server in a local cache, so a transfer that is repeated (after a
+        failure, or to load a recent run again) reads it from disk. The least recently used data is evicted once
+        the cache grows past maxbytes (10GB by default). Passing None turns the cache off, which is the default.
+
+        It pays off with a slow or throttled OPeNDAP server and transfers that are retried. With a FileSource the data
+        is on local disk already, and the cache only copies it. Only the data is kept, not the axes like time, which
+        are read from the run every time.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.setslabcache('/var/cache/forecasting-slabs', maxbytes=20*1024**3)
+        """
+
+        if directory == None:
+            self.slabcache = None
+        else:
+            self.slabcache = SlabCache(directory, maxbytes)
+
+    def setworkers(self, workers):
+        """
+        Set the number of fields transferred at the same time. Each worker opens its own connection
+        to the remote server and to the database, so keep this small enough to be kind to the server.
+        Defaults to 1, which transfers one field after another.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.connect(database='weather')
+        m.setworkers(4)
+        """
+
+        self.workers = max(int(workers),1)
+
+    def setchunking(self, times=None, levs=None, maxmemory=None):
+        """
+        Fetch each field from the server in chunks instead of all at once. Each chunk is written to the
+        database as soon as it arrives, so memory use is bounded by the chunk size (a chunk is being
+        written while the next one downloads, so count on about two chunks in memory).
+
+        Usage:
+        m = forecasting.model('nam')
+        m.setchunking(times=1)                # one forecast hour at a time
+        m.setchunking(levs=5)                 # blocks of five pressure levels
+        m.setchunking(maxmemory=200*1024**2)  # pick the chunk size to stay under ~200MB
+
+        Arguments:
+          * times: the number of timesteps per chunk. Defaults to every timestep.
+            levs: the number of pressure levels per chunk. Defaults to every level.
+            maxmemory: a ceiling in bytes for a single chunk. Chunks are made smaller as needed to fit.
+
+        Calling setchunking() with no arguments goes back to fetching each field at once.
+        """
+
+        self.chunktimes = times
+        self.chunklevs = levs
+        self.maxmemory = maxmemory
+
+    def setstorage(self, layout, precision=None):
+        """
+        Choose how the data is stored in the database. 'rows' (the default) stores a row per value. 'arrays' stores each
+        slice of a forecast as a single row holding compressed arrays, which takes many times less space and loads faster,
+        at the cost of decompressing whole slices to read single points. With a precision, values are rounded to
+        multiples of it, which compresses better still.
+
+        Reads (timeseries, readfield) use the same setting, so pick one storage per model and stick to it.
+        Calculated fields that can't be computed during the transfer need the rows storage.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.connect(database='weather')
+        m.setstorage('arrays', precision=0.01)
+        """
+
+        if self.database != None:
+            self.database.setstorage(layout, precision)
+        self.storage = layout
+        self.precision = precision
 
     def info(self):
         """
@@ -97,6 +274,7 @@ class Model:
         """
 
         self._setup()
+        self.daterange = self.getdaterange()
 
         print '----------------------'
         print '-- Model Name: %s' % self.modelname
@@ -130,12 +308,8 @@ class Model:
         m.getdaterange()
         """
 
-        regex = re.compile("%s(\d{8})" % self.modelname)
-        f = urllib2.urlopen(self.timeurl)
-
-        results = regex.findall(f.read())
-        numdates = [int(i) for i in results]
-        return [np.min(numdates), np.max(numdates)]
+        days = self.runs.days()
+        return [np.min(days), np.max(days)]
 
     def getlatesttime(self):
         """
@@ -149,28 +323,25 @@ class Model:
 
         print 'Getting the latest time'
 
-        # refresh the daterange
-        self.daterange = self.getdaterange()
-        lastday = self.daterange[1]
-
-        # search for the largest hour which is true using the bisection method
-        result = None
-        range = [0,24]
-        while (range[1]-range[0]) > 0:
-            print range
-            hour = (range[1]+range[0])/2 # nb: this will round down
-            datatime = datetime.strptime('%s%02d' % (lastday, hour), '%Y%m%d%H')
-            url = self._createurl(datatime)
-            res = self._checkurl(url)
-            if res == True:
-                result = datatime
-                if range[0] == hour:
-                    range[0] = hour+1
-                else:
-                    range[0] = hour
-            else:
-                range[1] = hour
-        return result
+        latest = self.latestruns(1)
+        if len(latest) == 0:
+            return None
+        return latest[0]
+
+    def latestruns(self, n=1):
+        """
+        Get the datatimes of the n latest runs available, newest first. The listings behind this are
+        cached for a couple of minutes, so calling it repeatedly is cheap.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.latestruns(4)
+        """
+
+        latest = self.runs.latestruns(n)
+        if len(latest) > 0:
+            self.daterange = [np.min(self.runs.days()), int(datetime.strftime(latest[0],'%Y%m%d'))]
+        return latest
 
 
     def transfer(self, fields, datatime=None, geos=None, pressure=None):
@@ -208,6 +379,9 @@ class Model:
                 'k':8 # (optional) nearest neighbors defaults to 1 (ie only itself).
             }]
 
+        Cells requested by points are merged into a few rectangles before downloading (see geowaste),
+        and only the requested cells are written to the database.
+
         Pressure format
         ------------- 
         pressure = {'min': 25,   # * required, minimum pressure in mb
@@ -217,14 +391,44 @@ class Model:
         Eventually, there will also be a geo dictionary that can be used to specify a prefered
         lat/lon boundary (ie only grab a subset of available data), but at the moment, it's all or nothing.
 
+        Incremental transfers
+        -------------
+        Every slice (field, forecast time and level) that has been written completely is recorded in the database.
+        With the 'keep' conflict setting, the slices of the run already recorded for the same geos are not downloaded
+        again, so retrying a transfer that died halfway, or transferring a run that overlaps an earlier one, only
+        costs the missing slices.
+
         """
 
+        starttime = time.time()
+
         # check for proper grid, set up if not present, and cache gridids
         self._setup()
 
         if datatime == None:
             datatime = self.getlatesttime()
 
+        # create the url for the datatime
+        url = self._createurl(datatime)
+
+        # check the url
+        check = self._checkurl(url)
+        if check == True:
+            print 'Datatime is available on the remote server'
+            self.url = url
+        else:
+            print 'Datatime is not available on the remote server'
+            raise Exception('Datatime is not available on the remote server')
+
+        # Open the run, nothing but the metadata is read until the fields are sliced
+        self.modelconn = self.source.open(self.url)
+
+        # a grid from the grid cache has to match the run, since its levels pick the pressure levels
+        if self.gridcached and not self._gridmatches(self.modelconn):
+            print 'The cached grid does not match the run, reading it again'
+            self.gridcache.clear()
+            self._setup()
+            self.modelconn = self.source.open(self.url)
 
         if geos == None:
             geobounds=[[[0,self.nlat,1],[0,self.nlon,1]]]
@@ -232,7 +436,7 @@ class Model:
             print '-----------------------------'
             print '-- parsing geos information:'
             print '-----------------------------'
-            geobounds = self._parsegeos(geos)
+            geobounds = self._plangeos(self._parsegeos(geos))
 
         if pressure == None:
             levbounds = [0,self.nlev,4]
@@ -248,41 +452,46 @@ class Model:
             levbounds = [ilevs, ileve, ilevi]
 
 
-        # create the url for the datatime
-        url = self._createurl(datatime)
+        # Calculated fields whose dependents are all part of this transfer are computed on the way in,
+        # the others are calculated in the database afterwards
+        calcs, later = self._plancalculations(fields)
 
-        # check the url
-        check = self._checkurl(url)
-        if check == True:
-            print 'Datatime is available on the remote server'
-            self.url = url
+        # Look up the slices of the run that are already complete, once for every field. Overwriting
+        # transfers start from nothing, but still record what they write.
+        if self.conflict == 'keep':
+            completed = self.database.getcompleted(self.database.getrunid(datatime))
         else:
-            print 'Datatime is not available on the remote server'
-            raise Exception('Datatime is not available on the remote server')
+            completed = set()
 
-        # Connect using pydap to the opendap server
-        self.modelconn = open_url(self.url)
-
-        # Process each field
-        for field in fields:
-            for geobound in geobounds:
-                self._processfield(field,datatime,geobound,levbounds)
-
-        # calculate any calculated fields
-        for calc in self.calcfields:
-            for f, p in calc.items():
-                print '------------------------'
-                print '-- Calculating %s' % f
-                print '------------------------'
-                try:
-                    self.database.calculatefield(f,p['dependents'],p['calculation'],datatime)
-                except:
-                    print 'Error calculating field for %s' % f
-
-    def addcalculatedfield(self,fieldname,dependents,calculation):
+        # Process each field, with the dependents of a calculated field together
+        units = [(group,groupcalcs,geobound) for group, groupcalcs in self._groupfields(fields,calcs) for geobound in geobounds]
+        if self.workers > 1 and len(units) > 1:
+            self._processparallel(units,datatime,levbounds,completed)
+        else:
+            for group, groupcalcs, geobound in units:
+                self._processfield(group,datatime,geobound,levbounds,calcs=groupcalcs,completed=completed)
+
+        # calculate the remaining calculated fields
+        for calc in later:
+            print '------------------------'
+            print '-- Calculating %s' % calc.name
+            print '------------------------'
+            try:
+                self.database.calculatefield(calc.name,calc.dependents,calc.calculation,datatime,calc.parameters)
+            except Exception, e:
+                print 'Error calculating field for %s: %s' % (calc.name, e)
+
+        metrics.histogram('forecasting_transfer_seconds', 'Time taken to transfer a run').observe(time.time() - starttime, model=self.modelname)
+
+    def addcalculatedfield(self,fieldname,dependents,calculation,parameters=None):
         """
         Add a calculated field to the database. Each time new model data is added into the database, the calculated field will be run.
 
+        When every dependent is transferred at the same time, the calculation is done in numpy as the data comes in
+        and written along with it. Otherwise (or if the calculation reads differently in python than in SQL, like -x^2,
+        see Calculation), it is run in the database once the transfer is done. Either way, only arithmetic on the
+        dependents, numbers and simple functions is accepted.
+
 
         Usage:
         m = forecasting.model('nam')
@@ -293,9 +502,255 @@ class Model:
         calculation = 'sqrt(uvelocity^2 + vvelocity^2)'
 
         m.addcalculatedfield(fieldname, dependents, calculation)
+
+        Constants can be passed as parameters, and are written as %(name)s in the calculation:
+        m.addcalculatedfield('rhosfc', ['pressfc','tmpsfc'], 'pressfc/(tmpsfc*%(r)s)', {'r': 287.058})
         """
 
-        self.calcfields.append({fieldname:{'dependents': dependents, 'calculation': calculation}})
+        self.calcfields.append({fieldname:{'dependents': dependents, 'calculation': calculation, 'parameters': parameters}})
+
+    def dropruns(self, days):
+        """
+        Remove the runs of this model older than the given number of days from the database.
+        Each run is stored in its own partition, which is dropped as a whole.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.connect(database='weather')
+        m.dropruns(7)
+        """
+
+        self.database.cachemodelid(self.modelname)
+        return self.database.dropruns(days)
+
+    def timeseries(self, lat, lon, fields, run=None, method='nearest'):
+        """
+        Read the forecast of a set of fields at one or more points back out of the database.
+
+        The cells around each point are found from the lat/lon axes of the grid (no spatial query), and only
+        the values of those cells are read, so this is cheap even on large grids.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.connect(database='weather')
+        ts = m.timeseries(39.97, -105.14, ['tmp2m','tmpprs'])
+        ts['tmp2m']['times']   # valid times, as datetime64
+        ts['tmp2m']['values']  # one value per valid time
+        ts['tmpprs']['values'] # one row per valid time, one column per pressure level in ts['tmpprs']['pressure']
+
+        ts = m.timeseries([39.97, 40.01], [-105.14, -105.27], ['tmp2m'], method='bilinear')
+        ts['tmp2m']['values']  # one row per point
+
+        Arguments:
+          * lat, lon: the location of the point, or lists of locations
+          * fields: a list of fields to read
+            run: the datatime of the run to read. Defaults to the latest run in the database.
+            method: 'nearest' takes the value of the closest grid cell, 'bilinear' interpolates between the four surrounding cells.
+
+        Returns a dictionary with an entry per field, holding:
+            run: the datatime of the run
+            times: the valid times
+            pressure: the pressure levels, or None for fields without levels
+            values: the values as [point, time, level], without the point axis for a single point and without the level axis
+                    for fields without levels. Values missing from the database are nan.
+        """
+
+        if self.nlat == None:
+            self._setup()
+
+        single = np.ndim(lat) == 0 and np.ndim(lon) == 0
+        lat = np.atleast_1d(np.asarray(lat,dtype='f8'))
+        lon = np.atleast_1d(np.asarray(lon,dtype='f8'))
+        if lat.shape != lon.shape:
+            raise Exception('lat and lon need the same number of points')
+
+        found = self.database.getrun(run)
+        if found == None:
+            raise Exception('Run is not in the database')
+        runid, run = found
+
+        ords, weights = self._pointweights(lat,lon,method)
+        gridpointids = np.asarray(self.gridpointids)[ords]
+        cells, first = np.unique(gridpointids,return_index=True)
+        icells = np.searchsorted(cells,gridpointids)
+
+        rows = self.database.gettimeseries(fields,runid,cells,ords.ravel()[first])
+
+        results = {}
+        for field in fields:
+            fieldrows = [row for row in rows if row[0] == field]
+            times = sorted(set([row[2] for row in fieldrows]))
+            levs = sorted(set([row[1] for row in fieldrows if row[1] != None]))
+
+            # the values of every cell, as [time, level, cell]
+            cellvalues = np.empty((len(times),max(len(levs),1),len(cells)))
+            cellvalues.fill(np.nan)
+            itimes = dict([(t,i) for i, t in enumerate(times)])
+            ilevs = dict([(l,i) for i, l in enumerate(levs)])
+            for name, lev, datatimeforecast, gridpointid, value in fieldrows:
+                cellvalues[itimes[datatimeforecast],ilevs.get(lev,0),np.searchsorted(cells,gridpointid)] = value
+
+            # weigh the cells around each point, leaving out cells that don't count at all
+            weighted = np.where(weights[np.newaxis,np.newaxis,:,:] > 0, weights[np.newaxis,np.newaxis,:,:]*cellvalues[:,:,icells], 0.)
+            values = np.transpose(np.sum(weighted,axis=3),(2,0,1))
+
+            if len(levs) == 0:
+                values = values[:,:,0]
+            if single:
+                values = values[0]
+
+            results[field] = {'run': run,
+                              'times': np.array(times,dtype='datetime64[s]'),
+                              'pressure': np.array(levs) if len(levs) > 0 else None,
+                              'values': values}
+
+        return results
+
+    def readfield(self, field, hours=None, run=None, bounds=None):
+        """
+        Read a whole field (or a part of it) of a run back out of the database, as a numpy array on the model grid.
+
+        The values are streamed out of the database in binary and placed straight into the array, so reading
+        a full grid takes seconds rather than minutes.
+
+        Usage:
+        m = forecasting.model('nam')
+        m.connect(database='weather')
+        f = m.readfield('tmp2m', hours=6)
+        f['values']  # [time, lat, lon]
+
+        f = m.readfield('tmpprs', bounds={'n': 41., 's': 39., 'e': -99., 'w': -101.})
+        f['values']  # [time, level, lat, lon], levels in f['pressure']
+
+        Arguments:
+          * field: the field to read
+            hours: a forecast hour (hours since the run), or a list of them. Defaults to every hour in the database.
+            run: the datatime of the run to read. Defaults to the latest run in the database.
+            bounds: a dictionary with n, s, e and w, as in the geos of transfer, to read only part of the grid.
+
+        Returns a dictionary holding:
+            run: the datatime of the run
+            times: the valid times
+            pressure: the pressure levels, or None for fields without levels
+            lat, lon: the axes of the grid that was read
+            values: the values as [time, level, lat, lon], without the level axis for fields without levels.
+                    Values missing from the database are nan.
+        """
+
+        if self.nlat == None:
+            self._setup()
+
+        found = self.database.getrun(run)
+        if found == None:
+            raise Exception('Run is not in the database')
+        runid, run = found
+
+        forecasts = self.database.getforecasts(field,runid)
+        if hours is not None:
+            hours = np.atleast_1d(hours)
+            forecasts = [f for f in forecasts if np.any(np.abs((f[2]-run).total_seconds()/3600. - hours) < 1e-3)]
+        times = sorted(set([f[2] for f in forecasts]))
+        levs = sorted(set([f[1] for f in forecasts if f[1] != None]))
+
+        # one slot per valid time and level
+        itimes = dict([(t,i) for i, t in enumerate(times)])
+        ilevs = dict([(l,i) for i, l in enumerate(levs)])
+        nlev = max(len(levs),1)
+        forecastids = np.zeros(len(times)*nlev,dtype='i4')
+        for forecastid, lev, datatimeforecast in forecasts:
+            forecastids[itimes[datatimeforecast]*nlev + ilevs.get(lev,0)] = forecastid
+
+        # the part of the grid to read
+        lat = np.asarray(self.lat)
+        lon = np.asarray(self.lon)
+        if bounds == None:
+            ilat = np.arange(self.nlat)
+            ilon = np.arange(self.nlon)
+        else:
+            if not all([k in bounds for k in ('n','s','e','w')]):
+                raise Exception('Bounds require n, s, e and w')
+            ilat = np.nonzero((lat >= bounds['s']) & (lat <= bounds['n']))[0]
+            ilon = np.nonzero((lon >= bounds['w']) & (lon <= bounds['e']))[0]
+        ords = np.reshape(ilat[:,np.newaxis]*self.nlon + ilon[np.newaxis,:],len(ilat)*len(ilon))
+        gridpointids = np.asarray(self.gridpointids)[ords]
+
+        values = np.empty((len(forecastids),len(ords)),dtype='f4')
+        values.fill(np.nan)
+        if len(forecastids) > 0 and len(ords) > 0 and self.storage == 'arrays':
+            rows = self.database.readarrays(forecastids,runid,None if bounds == None else ords)
+
+            # the ords of the grid that is read are in ascending order
+            values[rows['idx']-1,np.searchsorted(ords,rows['ord'])] = rows['value']
+        elif len(forecastids) > 0 and len(ords) > 0:
+            if bounds == None:
+                rows = self.database.readdata(forecastids,runid)
+            else:
+                rows = self.database.readdata(forecastids,runid,gridpointids)
+
+            # scatter the rows into place through the cached gridpointid ordering
+            sorter = np.argsort(gridpointids)
+            pos = np.searchsorted(gridpointids,rows['gridpointid'],sorter=sorter)
+            values[rows['idx']-1,sorter[np.minimum(pos,len(sorter)-1)]] = rows['value']
+
+        values = np.reshape(values,(len(times),nlev,len(ilat),len(ilon)))
+        if len(levs) == 0:
+            values = values[:,0]
+
+        return {'run': run,
+                'times': np.array(times,dtype='datetime64[s]'),
+                'pressure': np.array(levs) if len(levs) > 0 else None,
+                'lat': lat[ilat],
+                'lon': lon[ilon],
+                'values': values}
+
+    def _newdatabase(self):
+        """
+        Open a new database connection with the settings of this model
+        """
+
+        database = Database(**self.connargs)
+        database.setconflict(self.conflict)
+        database.setstorage(self.storage, self.precision)
+        return database
+
+    def _plancalculations(self,fields):
+        """
+        Split the calculated fields into the ones computed while the fields are transferred and the ones left for the database.
+        A calculation is done on the way in if numpy can evaluate it and its dependents are all among the transferred fields,
+        with the same dimensions.
+        """
+
+        calcs = []
+        later = []
+        for calcfield in self.calcfields:
+            for name, p in calcfield.items():
+                calc = Calculation(name,p['dependents'],p['calculation'],p.get('parameters'))
+                if not calc.supported():
+                    reason = calc.reason
+                elif not all([d in fields for d in calc.dependents]):
+                    reason = 'not every dependent is transferred'
+                elif len(set([tuple(self.modelconn[d].dimensions) for d in calc.dependents])) > 1:
+                    reason = 'the dependents have different dimensions'
+                else:
+                    calcs.append(calc)
+                    continue
+                print 'Calculating %s in the database: %s' % (name, reason)
+                later.append(calc)
+        return calcs, later
+
+    def _groupfields(self,fields,calcs):
+        """
+        Group the fields so the dependents of each calculation are fetched together. Returns a list of
+        (fields, calculations) pairs, in the order of the fields.
+        """
+
+        groups = [[field] for field in fields]
+        for calc in calcs:
+            merged = [group for group in groups if any([f in calc.dependents for f in group])]
+            if len(merged) > 1:
+                groups[groups.index(merged[0])] = sum(merged,[])
+                groups = [group for group in groups if group not in merged[1:]]
+        return [(group,[calc for calc in calcs if all([d in group for d in calc.dependents])]) for group in groups]
 
     def _indexf(self,l,f):
         """
@@ -308,25 +763,17 @@ class Model:
 
     def _createurl(self,datatime):
         """
-        create appropriate url
+        create appropriate url (or path, for local files)
         """
 
-        date = datetime.strftime(datatime, '%Y%m%d')
-        hour = datetime.strftime(datatime, '%H')
-        return self.baseurl.format(date=date,hour=hour)
+        return self.source.location(datatime)
 
     def _checkurl(self,url):
         """
-        We have to check the das file for an error
+        Check that the run is available from the source
         """
 
-        try:
-            util.request(url+'.dds')
-            return True
-        except KeyboardInterrupt:
-            raise KeyboardInterrupt
-        except:
-            return False
+        return self.source.available(url)
 
 
 
@@ -334,20 +781,37 @@ class Model:
     def _setup(self):
         """
         Setup the grid and cache the gridpoints
+
+        If the grid cache holds a grid matching the database, nothing is fetched from the remote server.
         """
 
         self.database.cachemodelid(self.modelname)
 
-
         # Get the time range
         self.daterange = self.getdaterange()
 
+        # try the local grid cache first
+        self.gridcached = False
+        if self.gridcache != None:
+            grid = self.gridcache.load(self._gridfingerprint())
+            if grid != None:
+                print 'Loaded grid from cache'
+                self.nlat = grid['nlat']
+                self.nlon = grid['nlon']
+                self.nlev = grid['nlev']
+                self.lat = grid['lat']
+                self.lon = grid['lon']
+                self.lev = grid['lev']
+                self.gridpointids = grid['gridpointids']
+                self.gridcached = True
+                return
+
         ## Check to see if grid has correct number of entries, and cache gridids locally
         # grab the shape of the lat lon points
         field = 'tmpprs'
         datatime = self.getlatesttime()
         url = self._createurl(datatime)
-        self.modelconn = open_url(url)
+        self.modelconn = self.source.open(url)
         dat = self.modelconn[field]
         shp = dat.shape
         nlat = shp[2]
@@ -371,21 +835,115 @@ class Model:
         # cache the gridpoints
         self.gridpointids = self.database.retrievegridids()
 
+        if self.gridcache != None:
+            self.gridcache.save(self._gridfingerprint(),self.lat,self.lon,self.lev,self.gridpointids)
+
+    def _gridfingerprint(self):
+        """
+        Identify the grid for the grid cache: the grid in the database, and the source its axes were read from
+        (the levels of a model differ from one source to the other)
+        """
+
+        source = '%s|%s' % (self.source.__class__.__name__, self.source.baseurl)
+        return hashlib.sha1('%s|%s' % (self.database.gridfingerprint(), source)).hexdigest()
+
+    def _gridmatches(self, modelconn):
+        """
+        Check the grid against an opened run: the shape of the lat/lon grid and the pressure levels of tmpprs
+        """
+
+        try:
+            dat = modelconn['tmpprs']
+        except Exception:
+            return True
+        lev = np.asarray(dat.lev[:])
+        return tuple(dat.shape[2:]) == (self.nlat, self.nlon) and len(lev) == len(self.lev) and np.allclose(lev, self.lev)
 
 
-    def _processfield(self, field, datatime, geobound,levbound):
+
+    def _processparallel(self, units, datatime, levbound, completed=None):
+        """
+        Process (fields, calculations, geobound) units on a pool of worker threads. Each worker opens its own
+        connection to the remote server and to the database. A unit that fails does not stop the
+        others; the failures are raised together once every unit has been tried.
+        """
+
+        tasks = Queue.Queue()
+        for unit in units:
+            tasks.put(unit)
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                database = self._newdatabase()
+                database.cachemodelid(self.modelname)
+                modelconn = self.source.open(self.url)
+            except Exception, e:
+                with lock:
+                    errors.append(('worker setup', e))
+                return
+
+            try:
+                while True:
+                    try:
+                        fields, calcs, geobound = tasks.get_nowait()
+                    except Queue.Empty:
+                        break
+                    try:
+                        self._processfield(fields,datatime,geobound,levbound,modelconn,database,calcs,completed)
+                    except Exception, e:
+                        database.conn.rollback()
+                        print 'Error processing %s: %s' % (', '.join(fields), e)
+                        with lock:
+                            errors.append((', '.join(fields), e))
+            finally:
+                database.close()
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.workers,len(units)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # anything left over never found a working worker
+        while not tasks.empty():
+            fields, calcs, geobound = tasks.get_nowait()
+            errors.append((', '.join(fields), Exception('No worker available')))
+
+        if len(errors) > 0:
+            raise Exception('Failed to transfer %d of %d fields: %s' % (len(errors), len(units), ', '.join(['%s (%s)' % (f, e) for f, e in errors])))
+
+    def _processfield(self, fields, datatime, geobound,levbound,modelconn=None,database=None,calcs=[],completed=None):
+        """
+        Transfer one or more fields (which share their dimensions) for a geobound. The fields are fetched chunk by chunk
+        side by side, so the calculated fields in calcs can be computed from the slices in memory and written with them.
+
+        completed is the set of (forecastid, scope) slices already in the database (see Database.getcompleted). When given,
+        the timesteps and levels complete for every field are not fetched, and the slices written are recorded as complete.
+        """
+
+        if isinstance(fields, basestring):
+            fields = [fields]
 
         print '------------------------'
-        print '-- Processing %s' % field
+        print '-- Processing %s' % ', '.join(fields)
         print '------------------------'
 
-        # Tell pydap which field we're interested in
-        fieldconn = self.modelconn[field]
+        # workers bring their own connections
+        if modelconn == None:
+            modelconn = self.modelconn
+        if database == None:
+            database = self.database
+
+        # Tell pydap which fields we're interested in
+        fieldconns = [modelconn[field] for field in fields]
+        fieldconn = fieldconns[0]
 
-        fieldid = self.database.getfieldid(field)
+        runid = database.getrunid(datatime)
 
         # prepare a data structure for database entry
-        dtype = ([('forecastid','i4'), ('gridpointid','i4'), ('value','f4')])
+        dtype = ([('forecastid','i4'), ('gridpointid','i4'), ('value','f4'), ('runid','i4')])
 
         # fetch shape information about the data
         fullshape = fieldconn.shape
@@ -404,6 +962,8 @@ class Model:
         iloni = geobound[1][2]
         latrange = np.arange(ilats,ilate,ilati)
         lonrange = np.arange(ilons,ilone,iloni)
+        nlat = len(latrange)
+        nlon = len(lonrange)
 
         # set the pressure bounds
         ilevs = levbound[0]
@@ -414,83 +974,278 @@ class Model:
 
         if len(fullshape) == 3 and dim[0] == 'time':
             print 'field has three components: time, lat, lon'
-
-            # grab the data container
-            dat = fieldconn[:,ilats:ilate:ilati,ilons:ilone:iloni]
-
-            # grab information about the container shape
-            shp = dat.shape
-            ntime = shp[0]
-            nlat = shp[1]
-            nlon = shp[2]
-
-            # create iterates to loop over
-            iterates = np.empty([ntime,2])
-            iterates[:,0] = np.arange(0,ntime)
-            iterates[:,1] = None
+            levrange = [None]
             itercase = TIMEONLY
         elif len(fullshape) == 4 and dim[0] == 'time' and dim[1] == 'lev':
             print 'field has four components: time, lev, lat, lon'
-
-            # grab the data container
-            dat = fieldconn[:,ilevs:ileve:ilevi, ilats:ilate:ilati,ilons:ilone:iloni]
-
-            # grab information about the container shape
-            shp = dat.shape
-            ntime = shp[0]
-            nlev = shp[1]
-            nlat = shp[2]
-            nlon = shp[3]
-
-            # create iterates to loop over
-            iterates = np.empty([ntime*nlev,2])
-            iterates[:,0] = np.repeat(np.arange(0,ntime),nlev)
-            iterates[:,1] = np.tile(np.arange(0,nlev),ntime)
+            levrange = list(np.arange(ilevs,ileve,ilevi))
             itercase = TIMEANDLEV
         else:
             print 'unkown shape! quitting!'
             print dim
             raise Exception('Unknown Data Shape')
 
+        # the time axis is small, so grab it up front
+        times = np.asarray(self._fetchslab(fields[0],fieldconn,'time',slice(None)))
+        ntime = len(times)
+        nlev = len(levrange)
+
+        # Select (or create) the forecastids for every field, calculated field, timestep and level in one go
+        names = fields + [calc.name for calc in calcs]
+        forecasts = []
+        for name in names:
+            fieldid = database.getfieldid(name)
+            for it in range(ntime):
+                # calculate the forecast datatime
+                datatimeforecast = datetime.fromordinal(int(times[it])) + timedelta(hours=24*(times[it]%1), days=-1)
+                for idxlev in levrange:
+                    if idxlev == None:
+                        lev = None
+                    else:
+                        lev = self.lev[idxlev]
+                    forecasts.append((fieldid,datatime,datatimeforecast,lev))
+        forecastids = np.reshape(database.getforecastids(forecasts),(len(names),ntime,nlev))
+
+        # find the timesteps and levels that are already complete for every field of the group
+        scope = self._geoscope(geobound)
+        done = np.zeros((ntime,nlev),dtype=bool)
+        if completed != None:
+            for it in range(ntime):
+                for ilev in range(nlev):
+                    done[it,ilev] = all([(forecastid,scope) in completed for forecastid in forecastids[:,it,ilev]])
+            metrics.counter('forecasting_slices_skipped_total', 'Slices left out of a transfer because they were already complete').inc(int(np.count_nonzero(done))*len(names), model=self.modelname)
+        if np.all(done):
+            print 'Already complete'
+            return
+
+        # set up the grid point holder, in the order the data comes back
+        tord = np.reshape(latrange[:,np.newaxis]*self.nlon + lonrange[np.newaxis,:],nlat*nlon)
+
+        # planned geobounds only want some of the cells they cover
+        if len(geobound) > 2:
+            keep = np.in1d(tord,geobound[2])
+        else:
+            keep = slice(None)
+        tord = tord[keep]
+        gridpointids = self.gridpointids[tord]
+
+        # The download, the encoding and the copy into the database each run on their own thread,
+        # connected by small queues, so the next slice downloads while the current one is written.
+        def fetch():
+            # fetch the data a chunk at a time, every field of the group for the same chunk
+            for its, ite, ils, ile in self._missingchunks(self._chunks(ntime,nlev,nlat*nlon*len(fields)),done):
+                chunks = []
+                for field, fieldconn in zip(fields,fieldconns):
+                    if itercase == TIMEONLY:
+                        print 'Fetching %s times %d-%d' % (field,its,ite-1)
+                        chunk = self._fetchslab(field,fieldconn,'array',(slice(its,ite),slice(ilats,ilate,ilati),slice(ilons,ilone,iloni)))
+                        chunk = np.reshape(chunk,(ite-its,1,nlat,nlon))
+                    elif itercase == TIMEANDLEV:
+                        print 'Fetching %s times %d-%d, levels %d-%d' % (field,its,ite-1,ils,ile-1)
+                        chunk = self._fetchslab(field,fieldconn,'array',(slice(its,ite),slice(levrange[ils],levrange[ile-1]+1,ilevi),slice(ilats,ilate,ilati),slice(ilons,ilone,iloni)))
+                        chunk = np.reshape(chunk,(ite-its,ile-ils,nlat,nlon))
+                    chunks.append(chunk)
+
+                # hand over each timestep and level that is missing
+                for it in range(its,ite):
+                    for ilev in range(ils,ile):
+                        if not done[it,ilev]:
+                            yield it, ilev, [chunk[it-its,ilev-ils,:,:] for chunk in chunks]
+
+        def encode(item):
+            it, ilev, slices = item
+
+            # the values of each field at the requested cells
+            values = [np.reshape(v,nlat*nlon)[keep] for v in slices]
+
+            # compute the calculated fields from the slices in memory, leaving out cells with bad inputs
+            if len(calcs) > 0:
+                inputs = dict(zip(fields,values))
+                bad = np.zeros(len(tord),dtype=bool)
+                for v in values:
+                    bad |= ~(v < 1e10)
+                for calc in calcs:
+                    result = calc.evaluate(inputs)
+                    result[bad] = np.nan
+                    values.append(result)
+
+            # fill up the data structure from the data containers
+            data = np.empty(len(tord)*len(names),dtype)
+            for i in range(len(names)):
+                part = data[i*len(tord):(i+1)*len(tord)]
+                part['value'] = values[i]
+                part['gridpointid'] = gridpointids
+                part['forecastid'] = forecastids[i,it,ilev]
+            data['runid'] = runid
+
+            # the array storage keeps bad data as nan, so the slices stay contiguous
+            if database.storage == 'arrays':
+                return it, ilev, database.encodedata(data,np.tile(tord,len(names)))
 
-        # loop over each timestemp and level
-        for it,ilev in iterates:
+            # Remove bad data
+            data = data[data['value'] < 1e10]
+
+            return it, ilev, database.encodedata(data)
+
+        def copy(item):
+            it, ilev, cpy = item
             print 'IT: %d' % it
 
-            # calculate the forecast datatime
-            datatimeforecast = datetime.fromordinal(int(dat.time[it])) + timedelta(hours=24*(dat.time[it]%1), days=-1)
+            # Send to database
+            database.senddata(cpy)
+            if completed != None:
+                database.setcompleted(runid,forecastids[:,it,ilev],scope)
+
+        pipeline = Pipeline([('fetch',fetch()),('encode',encode),('copy',copy)],self.pipelinedepth)
+        pipeline.run()
+        pipeline.report()
+        for stat in pipeline.stats:
+            metrics.counter('forecasting_stage_seconds_total', 'Time spent busy in each stage of the transfers').inc(stat['busy'], model=self.modelname, stage=stat['name'])
+
+    def _fetchslab(self, field, fieldconn, variable, index):
+        """
+        Fetch a hyperslab of a variable of a field (the 'array' or an axis like 'time'), from the slab cache if it's there.
+        The axes are small and always read from the run.
+        """
+
+        cache = self.slabcache if variable == 'array' else None
+        if cache != None:
+            slab = cache.load(self.url,field,variable,index)
+            if slab is not None:
+                metrics.counter('forecasting_slabs_total', 'Hyperslabs fetched').inc(model=self.modelname, source='cache')
+                return slab
+
+        with metrics.histogram('forecasting_slab_seconds', 'Time taken to download a hyperslab').time(model=self.modelname):
+            slab = np.asarray(getattr(fieldconn,variable)[index])
+        metrics.counter('forecasting_slabs_total', 'Hyperslabs fetched').inc(model=self.modelname, source='server')
+        if cache != None:
+            cache.save(self.url,field,variable,index,slab)
+        return slab
+
+    def _chunks(self, ntime, nlev, npoints):
+        """
+        Split a field of ntime timesteps and nlev levels into the chunks that are fetched from the server.
+        Returns a list of [itime start, itime end, ilev start, ilev end]
+
+        Chunk sizes come from setchunking. With a memory ceiling, the number of timesteps per chunk is cut
+        down first, then the number of levels, so that a chunk stays below maxmemory bytes.
+        """
+
+        ntimechunk = ntime
+        nlevchunk = nlev
+        if self.chunktimes != None:
+            ntimechunk = min(self.chunktimes,ntime)
+        if self.chunklevs != None:
+            nlevchunk = min(self.chunklevs,nlev)
+
+        if self.maxmemory != None:
+            # the server sends 4 byte floats
+            nslices = max(int(self.maxmemory/(npoints*4)),1)
+            if ntimechunk*nlevchunk > nslices:
+                ntimechunk = max(int(nslices/nlevchunk),1)
+            if ntimechunk*nlevchunk > nslices:
+                nlevchunk = nslices
+
+        chunks = []
+        for its in range(0,ntime,ntimechunk):
+            for ils in range(0,nlev,nlevchunk):
+                chunks.append([its,min(its+ntimechunk,ntime),ils,min(ils+nlevchunk,nlev)])
+        return chunks
+
+    def _missingchunks(self, chunks, done):
+        """
+        Cut the chunks down to the timesteps and levels that are not done (a boolean array [time, lev]).
+        Each chunk becomes one chunk per run of consecutive timesteps with something missing, over the
+        levels missing in them; chunks with nothing missing are left out.
+        """
+
+        missing = []
+        for its, ite, ils, ile in chunks:
+            todo = ~done[its:ite,ils:ile]
+            times = list(np.nonzero(np.any(todo,axis=1))[0])
+            while len(times) > 0:
+                # the run of consecutive timesteps at the start
+                n = 1
+                while n < len(times) and times[n] == times[0] + n:
+                    n += 1
+                levs = np.nonzero(np.any(todo[times[0]:times[0]+n],axis=0))[0]
+                missing.append([its+times[0],its+times[0]+n,ils+levs[0],ils+levs[-1]+1])
+                times = times[n:]
+        return missing
+
+    def _geoscope(self, geobound):
+        """
+        Name a geobound for the slices recorded as complete (see transfer)
+        """
+
+        return hashlib.sha1(json.dumps([[int(i) for i in part] for part in geobound])).hexdigest()
 
-            # Select (or create) the forecastid
-            if np.isnan(ilev):
-                lev = None
+    def _plangeos(self,geobounds):
+        """
+        Merge the single cells asked for by point geos into a few rectangles, so each field needs a handful
+        of remote requests instead of one per cell. Bounding boxes are left alone.
+        """
+
+        cells = []
+        boxes = []
+        for geobound in geobounds:
+            if geobound[0][1]-geobound[0][0] == 1 and geobound[1][1]-geobound[1][0] == 1:
+                cells.append((geobound[0][0],geobound[1][0]))
             else:
-                idxlev = ilevs + ilev*ilevi
-                lev = self.lev[idxlev]
-            forecastid = self.database.getforecastid(fieldid,datatime,datatimeforecast,lev)
-
-
-            # set up the grid point holder
-            tord = []
-            for i in latrange:
-                for j in lonrange:
-                    tord.append(i*self.nlon + j)
-
-            # fill up the data structure from the data container
-            data = np.empty(nlat*nlon,dtype)
-            if itercase == TIMEONLY:
-                data['value'] = np.reshape(dat.array[it,:,:],nlat*nlon)
-            elif itercase == TIMEANDLEV:
-                data['value'] = np.reshape(dat.array[it,ilev,:,:],nlat*nlon)
-            data['gridpointid'] = self.gridpointids[tord]
-            data['forecastid'] = np.ones(nlat*nlon)*forecastid
+                boxes.append(geobound)
 
-            # Remove bad data
-            data = data[data['value'] < 1e10]
+        if len(cells) == 0:
+            return boxes
 
-            # Send to database
-            self.database.senddata(data)
+        planned = GeoPlanner(self.nlat,self.nlon,self.geowaste).plan(cells)
+        print 'Planned %d requested cells into %d requests' % (len(cells),len(planned))
+        return boxes + planned
+
+    def _pointweights(self,lat,lon,method):
+        """
+        Find the grid cells around each point, and how much each of them counts towards the value at the point.
+        Returns the ords and the weights of the cells as [point, cell] arrays, with one cell per point for 'nearest'
+        and four for 'bilinear'.
+        """
+
+        ilat, wlat = self._axisposition(self.lat,lat,False)
+        ilon, wlon = self._axisposition(self.lon,lon,True)
+
+        if method == 'nearest':
+            ilat = ilat + (wlat >= 0.5)
+            ilon = (ilon + (wlon >= 0.5)) % self.nlon
+            ords = (ilat*self.nlon + ilon)[:,np.newaxis]
+            weights = np.ones(ords.shape)
+        elif method == 'bilinear':
+            ilat1 = ilat + 1
+            ilon1 = (ilon + 1) % self.nlon
+            ords = np.column_stack([ilat*self.nlon + ilon, ilat*self.nlon + ilon1, ilat1*self.nlon + ilon, ilat1*self.nlon + ilon1])
+            weights = np.column_stack([(1-wlat)*(1-wlon), (1-wlat)*wlon, wlat*(1-wlon), wlat*wlon])
+        else:
+            raise Exception('Unknown interpolation method: %s' % method)
 
+        return ords, weights
+
+    def _axisposition(self,axis,x,periodic):
+        """
+        Locate the values x on an ascending grid axis. Returns the index of the grid value at or below each x,
+        and how far x is towards the next one (0 to 1). Longitudes are periodic: they are wrapped onto the axis,
+        and on a global grid the last column connects back to the first.
+        """
 
+        axis = np.asarray(axis,dtype='f8')
+        if periodic and len(axis) > 1:
+            step = (axis[-1]-axis[0])/(len(axis)-1)
+            x = axis[0] + np.mod(x-axis[0],360.)
+            if abs(axis[-1]+step-axis[0]-360.) < step/2:
+                axis = np.append(axis,axis[0]+360.)
+
+        i = np.clip(np.searchsorted(axis,x,side='right')-1,0,len(axis)-2)
+        w = (x-axis[i])/(axis[i+1]-axis[i])
+        outside = (w < -1e-6) | (w > 1+1e-6)
+        if np.any(outside):
+            raise Exception('Point outside of the model grid: %f' % x[outside][0])
+        return i, np.clip(w,0.,1.)
 
     def _parsegeos(self,geo):
         # parse the goes list or dictionary
@@ -0,0 +1,171 @@
+import mmap
+import struct
+
+import numpy as np
+
+# tags of the header lists
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+# nc_type of the classic format, as big-endian numpy dtypes
+TYPES = {1: '>i1', 2: 'S1', 3: '>i2', 4: '>i4', 5: '>f4', 6: '>f8'}
+
+# numrecs of a file that is still being written
+STREAMING = 0xFFFFFFFF
+
+class Variable:
+    """
+    VARIABLE is a variable of a NetCDF file, read straight from the memory-mapped file when it's sliced.
+    It has the dimensions, shape, ncattrs() and getncattr() of a netCDF4 variable, without the automatic
+    masking and scaling.
+    """
+
+    name = ''
+    dimensions = ()
+    shape = ()
+
+    def __init__(self, name, dimensions, attributes, data):
+        self.name = name
+        self.dimensions = tuple(dimensions)
+        self.attributes = attributes
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        # copy the slice out of the map, in native byte order
+        return np.array(self.data[index], dtype=self.dtype.newbyteorder('='))
+
+    def ncattrs(self):
+        return self.attributes.keys()
+
+    def getncattr(self, name):
+        return self.attributes[name]
+
+class Dataset:
+    """
+    DATASET reads a NetCDF file in the classic format (CDF-1, or CDF-2 with 64-bit offsets), such as the files
+    written by wgrib2 -netcdf, without any library besides numpy.
+
+    Only the header is parsed when the file is opened. The file is memory-mapped, and each variable is a view
+    of it, so a slice only reads the pages it covers from disk.
+
+    NetCDF-4 files are HDF5 files underneath, and need the netCDF4 library instead.
+
+    Usage:
+    ds = Dataset('/data/nam/nam20140222_18z.nc')
+    ds.variables['tmp2m'].dimensions  # ('time', 'lat', 'lon')
+    ds.variables['tmp2m'][0,:10,:10]
+    """
+
+    path = ''
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.offset = 0
+
+        magic = self.map[0:4]
+        if magic[0:3] != 'CDF' or magic[3] not in ('\x01', '\x02'):
+            raise Exception('%s is not a classic NetCDF file' % path)
+        self.offset = 4
+        self.version = ord(magic[3])
+
+        numrecs = self._int()
+
+        self.dimensions = []
+        for name, length in self._list(NC_DIMENSION, self._dimension):
+            self.dimensions.append((name, length))
+        self.attributes = dict(self._list(NC_ATTRIBUTE, self._attribute))
+        header = self._list(NC_VARIABLE, self._variable)
+
+        # the record variables are interleaved, one record of each after the other
+        records = [v for v in header if len(v[1]) > 0 and self.dimensions[v[1][0]][1] == 0]
+        if len(records) == 1:
+            recsize = np.dtype(TYPES[records[0][3]]).itemsize*int(np.prod([self.dimensions[d][1] for d in records[0][1][1:]]))
+        else:
+            recsize = sum([v[4] for v in records])
+        if numrecs == STREAMING:
+            if len(records) > 0 and recsize > 0:
+                numrecs = (len(self.map) - min([v[5] for v in records]))//recsize
+            else:
+                numrecs = 0
+
+        self.variables = {}
+        for name, dimids, attributes, nctype, vsize, begin in header:
+            dtype = np.dtype(TYPES[nctype])
+            shape = [self.dimensions[d][1] for d in dimids]
+            strides = [dtype.itemsize*int(np.prod(shape[i+1:])) for i in range(len(shape))]
+            if len(dimids) > 0 and shape[0] == 0:
+                shape[0] = numrecs
+                strides[0] = recsize
+            data = np.ndarray(tuple(shape), dtype=dtype, buffer=self.map, offset=begin, strides=tuple(strides))
+            self.variables[name] = Variable(name, [self.dimensions[d][0] for d in dimids], attributes, data)
+
+    def close(self):
+        """
+        CLOSE lets go of the variables. The map itself is closed once no slice of it is left.
+        """
+        self.variables = {}
+        self.map = None
+
+    def _int(self):
+        value = struct.unpack_from('>i', self.map, self.offset)[0]
+        self.offset += 4
+        return value
+
+    def _name(self):
+        n = self._int()
+        name = self.map[self.offset:self.offset+n]
+        self.offset += (n + 3)//4*4
+        return name
+
+    def _list(self, tag, item):
+        found = self._int()
+        n = self._int()
+        if found == 0 and n == 0:
+            return []
+        if found != tag:
+            raise Exception('%s has a corrupt header at byte %d' % (self.path, self.offset - 8))
+        return [item() for i in range(n)]
+
+    def _dimension(self):
+        name = self._name()
+        return name, self._int()
+
+    def _attribute(self):
+        name = self._name()
+        nctype = self._int()
+        n = self._int()
+        dtype = np.dtype(TYPES[nctype])
+        raw = self.map[self.offset:self.offset+n*dtype.itemsize]
+        self.offset += (n*dtype.itemsize + 3)//4*4
+        if nctype == 2:
+            return name, raw.rstrip('\x00')
+        values = np.frombuffer(raw, dtype=dtype).astype(dtype.newbyteorder('='))
+        if n == 1:
+            return name, values[0]
+        return name, values
+
+    def _variable(self):
+        name = self._name()
+        dimids = [self._int() for i in range(self._int())]
+        attributes = dict(self._list(NC_ATTRIBUTE, self._attribute))
+        nctype = self._int()
+        vsize = struct.unpack_from('>I', self.map, self.offset)[0]
+        self.offset += 4
+        if self.version == 1:
+            begin = struct.unpack_from('>I', self.map, self.offset)[0]
+            self.offset += 4
+        else:
+            begin = struct.unpack_from('>Q', self.map, self.offset)[0]
+            self.offset += 8
+        return name, dimids, attributes, nctype, vsize, begin
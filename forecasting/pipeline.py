@@ -0,0 +1,163 @@
+import sys
+import threading
+import time
+import Queue
+
+class Pipeline:
+    """
+    PIPELINE runs a chain of stages on their own threads, connected by bounded queues.
+
+    The first stage is an iterable (usually a generator doing the downloads), every later stage is a
+    function taking the output of the stage before it. All stages but the last run on worker threads;
+    the last one runs on the calling thread, so it can safely own something like a database connection.
+    While the last stage works on item N, the earlier stages are already working on N+1, N+2, ...
+
+    The pipeline keeps track of how the time of each stage was spent, so it's easy to see which stage
+    is the bottleneck: the slow stage is busy most of the time, the others mostly wait on it.
+
+    Usage:
+    p = Pipeline([('fetch', slices), ('encode', encode), ('copy', copy)], depth=2)
+    p.run()
+    p.report()
+    """
+
+    # marks the end of the stream
+    END = object()
+
+    # how often (in seconds) blocked stages check if the pipeline has been stopped
+    interval = 0.1
+
+    def __init__(self, stages, depth=2):
+        """
+        Initialize the pipeline with a list of (name, iterable or function) stages and the maximum
+        number of items waiting between two stages.
+        """
+        self.stages = stages
+        self.depth = max(int(depth),1)
+        self.queues = [Queue.Queue(self.depth) for i in range(len(stages)-1)]
+        self.stats = [{'name': name, 'items': 0, 'busy': 0., 'waitin': 0., 'waitout': 0., 'queued': 0} for name, f in stages]
+        self.error = None
+        self.stopped = threading.Event()
+        self.elapsed = 0.
+
+    def run(self):
+        """
+        RUN pushes every item through the pipeline and returns once the last stage is done.
+        If any stage raises, the pipeline is stopped and the exception is raised again here.
+        """
+
+        starttime = time.time()
+        threads = []
+        for i in range(len(self.stages)-1):
+            thread = threading.Thread(target=self._guard, args=(i,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        self._guard(len(self.stages)-1)
+
+        self.stopped.set()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - starttime
+
+        if self.error != None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def report(self):
+        """
+        REPORT prints how each stage spent its time, and returns the same information as a list of dictionaries
+        with the fraction of the wall time spent busy, waiting on input and waiting on output, and the average
+        number of items already waiting in the output queue when the stage handed over a new one.
+        """
+
+        results = []
+        elapsed = max(self.elapsed, 1e-9)
+        print 'Pipeline stage occupancy (%.1fs):' % self.elapsed
+        for stat in self.stats:
+            result = {'name': stat['name'],
+                      'items': stat['items'],
+                      'busy': stat['busy']/elapsed,
+                      'waitin': stat['waitin']/elapsed,
+                      'waitout': stat['waitout']/elapsed}
+            if stat['items'] > 0:
+                result['queued'] = float(stat['queued'])/stat['items']
+            else:
+                result['queued'] = 0.
+            print '  %-8s busy %5.1f%%  waiting on input %5.1f%%  waiting on output %5.1f%%  queued %.1f  items %d' % (
+                    stat['name'], 100*result['busy'], 100*result['waitin'], 100*result['waitout'], result['queued'], stat['items'])
+            results.append(result)
+        return results
+
+    def _guard(self, i):
+        """
+        Run stage i, stopping the whole pipeline if it fails
+        """
+
+        try:
+            self._stage(i)
+        except:
+            if self.error == None:
+                self.error = sys.exc_info()
+            self.stopped.set()
+
+    def _stage(self, i):
+        name, f = self.stages[i]
+        stat = self.stats[i]
+        last = i == len(self.stages)-1
+
+        if i == 0:
+            items = iter(f)
+
+        while not self.stopped.is_set():
+            # grab the next item
+            t = time.time()
+            if i == 0:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    item = self.END
+                stat['busy'] += time.time() - t
+            else:
+                item = self._get(self.queues[i-1])
+                stat['waitin'] += time.time() - t
+
+            if item is self.END:
+                if not last:
+                    self._put(self.queues[i], item, stat)
+                return
+
+            # do the work
+            if i != 0:
+                t = time.time()
+                item = f(item)
+                stat['busy'] += time.time() - t
+            stat['items'] += 1
+
+            if not last:
+                stat['queued'] += self.queues[i].qsize()
+                self._put(self.queues[i], item, stat)
+
+    def _get(self, queue):
+        """
+        Block on the queue until an item arrives or the pipeline is stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                return queue.get(True, self.interval)
+            except Queue.Empty:
+                pass
+        return self.END
+
+    def _put(self, queue, item, stat):
+        """
+        Block on the queue until there is room or the pipeline is stopped
+        """
+        t = time.time()
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, True, self.interval)
+                break
+            except Queue.Full:
+                pass
+        stat['waitout'] += time.time() - t
@@ -0,0 +1,108 @@
+import re
+import time
+from datetime import datetime, timedelta
+
+import util
+
+class RunDiscovery:
+    """
+    RUNDISCOVERY finds the runs (cycles) of a model that are available on the server.
+
+    The server lists the days of a model at http://.../dods/{model}, and the runs of a day at
+    http://.../dods/{model}/{model}{date}. Both listings are cached for a short while, so asking
+    again for the latest runs usually costs a single request for the listing of the latest day,
+    or none at all.
+
+    Usage:
+    r = RunDiscovery('nam', 'http://nomads.ncep.noaa.gov:9090/dods/nam')
+    r.latestruns(2)  # [datetime(2014, 2, 22, 18), datetime(2014, 2, 22, 12)]
+    """
+
+    modelname = ''
+    timeurl = ''
+
+    # seconds the listing of a day's runs is trusted
+    ttl = 120
+
+    # seconds the listing of days is trusted. New days are picked up sooner, see days()
+    daysttl = 3600
+
+    def __init__(self, modelname, timeurl, ttl=None):
+        self.modelname = modelname
+        self.timeurl = timeurl
+        if ttl != None:
+            self.ttl = ttl
+        self.listings = {}
+
+    def refresh(self):
+        """
+        REFRESH forgets the cached listings
+        """
+        self.listings = {}
+
+    def days(self):
+        """
+        DAYS returns the sorted list of days (as yyyymmdd integers) with data on the server.
+
+        Days after the last listed one, up to today (UTC), are probed directly, so a new day shows
+        up without waiting for the listing of days to expire.
+        """
+
+        body = self._listing(self.timeurl, self.daysttl)
+        days = sorted(set([int(day) for day in re.findall('%s(\d{8})' % self.modelname, body)]))
+        if len(days) == 0:
+            return days
+
+        day = datetime.strptime(str(days[-1]), '%Y%m%d') + timedelta(days=1)
+        while day.date() <= datetime.utcnow().date():
+            if len(self.runs(int(day.strftime('%Y%m%d')))) == 0:
+                break
+            days.append(int(day.strftime('%Y%m%d')))
+            day = day + timedelta(days=1)
+        return days
+
+    def runs(self, day):
+        """
+        RUNS returns the sorted list of hours of the runs available on a given day (a yyyymmdd integer)
+        """
+
+        url = '%s/%s%d' % (self.timeurl, self.modelname, day)
+        try:
+            body = self._listing(url, self.ttl)
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except:
+            # remember missing days too, so they aren't asked for on every call
+            self.listings[url] = (time.time(), '')
+            return []
+        hours = re.findall('(?<![A-Za-z0-9_])%s_(\d\d)z(?![A-Za-z0-9_])' % self.modelname, body)
+        return sorted(set([int(hour) for hour in hours]))
+
+    def latestruns(self, n=1):
+        """
+        LATESTRUNS returns the datatimes of the n latest runs, newest first. The latest day and the
+        day before it are enough for most models; older days are only read if they're needed.
+        """
+
+        results = []
+        for day in reversed(self.days()):
+            for hour in reversed(self.runs(day)):
+                results.append(datetime.strptime('%d%02d' % (day, hour), '%Y%m%d%H'))
+                if len(results) >= n:
+                    return results
+        return results
+
+    def _listing(self, url, ttl):
+        """
+        Fetch a listing, or reuse the cached one if it's younger than ttl seconds
+        """
+
+        now = time.time()
+        if url in self.listings and now - self.listings[url][0] < ttl:
+            return self.listings[url][1]
+
+        resp, body = util.request(url)
+        if resp.status != 200:
+            raise Exception('Could not read %s: %s' % (url, resp.status))
+        self.listings[url] = (now, body)
+        return body
@@ -0,0 +1,132 @@
+import json
+import os
+import tempfile
+from datetime import timedelta
+
+import numpy as np
+
+class Schedule:
+    """
+    SCHEDULE learns when the runs of a model are published, and plans the polls around it.
+
+    The delay between the datatime of a run and the moment it was first seen on the server is recorded for each
+    cycle hour (00z, 06z, ...). The next run is expected after the shortest of the recent delays of its cycle hour.
+    Until shortly (lead seconds) before that, there's no point in asking the server; from then on it's asked every
+    minpoll seconds, backing off to half the time since the polls started (up to maxpoll) if the run is late.
+    Without observations for the cycle hour, every poll is maxpoll apart, as before.
+
+    Runs are seen late sometimes (a poll that fails, a daemon that was stopped), so the delays are only an upper bound
+    on the real ones; taking the shortest keeps the schedule from drifting later, and a run that is out at the first
+    poll of its window pulls the schedule earlier for the next time.
+
+    The observations are kept in a json file, so they survive a restart.
+
+    Usage:
+    s = Schedule('nam', maxpoll=600)
+    due = s.nextpoll(datatime, datetime.utcnow())
+    ...
+    s.observe(datatime, seen)
+    """
+
+    # where the observations live, one directory per model
+    directory = '/tmp/forecasting-cache/'
+    modelname = ''
+
+    # seconds before the expected publication to start polling
+    lead = 300
+
+    # seconds between the polls once the run is expected, and the most they back off to
+    minpoll = 30
+    maxpoll = 600
+
+    # observations kept for each cycle hour
+    history = 10
+
+    def __init__(self, modelname, directory=None, lead=None, minpoll=None, maxpoll=None, history=None):
+        self.modelname = modelname
+        if directory != None:
+            self.directory = directory
+        if lead != None:
+            self.lead = lead
+        if minpoll != None:
+            self.minpoll = minpoll
+        if maxpoll != None:
+            self.maxpoll = maxpoll
+        if history != None:
+            self.history = history
+        self.delays = self.load()
+
+    def path(self):
+        """
+        Path of the file with the observations
+        """
+        return os.path.join(self.directory, self.modelname, 'schedule.json')
+
+    def observe(self, datatime, seen):
+        """
+        OBSERVE records that the run at datatime was first seen on the server at seen (both UTC datetimes)
+        """
+
+        delay = (seen - datatime).total_seconds()
+        if delay < 0:
+            return
+        key = '%02d' % datatime.hour
+        self.delays[key] = (self.delays.get(key, []) + [delay])[-self.history:]
+        self.save()
+
+    def expected(self, datatime):
+        """
+        EXPECTED returns when the run at datatime should be published, or None if there are no observations for its cycle hour
+        """
+
+        delays = self.delays.get('%02d' % datatime.hour, [])
+        if len(delays) == 0:
+            return None
+        return datatime + timedelta(seconds=np.min(delays))
+
+    def nextpoll(self, datatime, now):
+        """
+        NEXTPOLL returns when to poll for the run at datatime next, given the time now (a UTC datetime)
+        """
+
+        expected = self.expected(datatime)
+        if expected == None:
+            return now + timedelta(seconds=self.maxpoll)
+
+        start = expected - timedelta(seconds=self.lead)
+        if now < start:
+            return start
+        wait = min(max((now - start).total_seconds()/2, self.minpoll), self.maxpoll)
+        return now + timedelta(seconds=wait)
+
+    def load(self):
+        """
+        LOAD the observations, or start without any
+        """
+
+        try:
+            delays = json.load(open(self.path(),'r'))
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(delays, dict):
+            return {}
+        return delays
+
+    def save(self):
+        """
+        SAVE the observations, written to a temporary file and renamed into place
+        """
+
+        directory = os.path.dirname(self.path())
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            f = os.fdopen(fd, 'w')
+            try:
+                json.dump(self.delays, f)
+            finally:
+                f.close()
+            os.rename(tmp, self.path())
+        except (IOError, OSError), e:
+            print 'Could not save the schedule of %s: %s' % (self.modelname, e)
@@ -0,0 +1,326 @@
+import heapq
+import threading
+import time
+import datetime
+import Queue
+from urlparse import urlsplit
+
+from model import Model
+from schedule import Schedule
+from sources import FileSource, GribSource
+import metrics
+import util
+
+def loadmodel(config):
+    """
+    Create and connect the model described by a config (see config/nam.yaml), with its calculated fields and settings.
+    Returns the model and the keyword arguments (geos and pressure) to pass to its transfers.
+
+    Usage:
+    m, args = loadmodel(yaml.load(open('config/nam.yaml')))
+    m.transfer(config['fields'], datatime, **args)
+    """
+
+    if 'http' in config:
+        util.configure(**config['http'])
+
+    m = Model(config['model'])
+    if 'server' in config:
+        m.setserver(config['server'])
+    if 'files' in config:
+        m.setsource(FileSource(config['model'], **config['files']))
+    if 'grib' in config:
+        m.setsource(GribSource(config['model'], **config['grib']))
+    if 'gridcache' in config:
+        m.setgridcache(config['gridcache'])
+    m.connect(**config['database'])
+    args = {}
+    if 'geos' in config:
+        args['geos'] = config['geos']
+    else:
+        args['geos'] = None
+    if 'pressure' in config:
+        args['pressure'] = config['pressure']
+    else:
+        args['pressure'] = None
+
+    if 'conflict' in config:
+        m.setconflict(config['conflict'])
+    if 'workers' in config:
+        m.setworkers(config['workers'])
+    if 'geowaste' in config:
+        m.geowaste = config['geowaste']
+    if 'chunking' in config:
+        m.setchunking(**config['chunking'])
+    if 'storage' in config:
+        m.setstorage(**config['storage'])
+    if 'slabcache' in config:
+        m.setslabcache(**config['slabcache'])
+
+    if 'calculatedfields' in config:
+        for field in config['calculatedfields']:
+            for key, value in field.items():
+                m.addcalculatedfield(key,value['dependents'],value['calculation'],value.get('parameters'))
+    return m, args
+
+class ModelTask:
+    """
+    MODELTASK is the poll loop of one model in the scheduler: it keeps track of the next run to transfer, and of when
+    the model should be polled again.
+
+    Every poll asks the run listings whether the next run is out. When it isn't, the next poll is planned by the
+    Schedule of the model, from when its runs were published before. When it is, the scheduler hands the transfer to
+    its worker threads and doesn't poll the model again until the transfer is over. A run that fails is tried again at the
+    next polls, up to two thirds of the model interval's worth of polls, and then skipped.
+
+    Usage:
+    t = ModelTask(yaml.load(open('config/nam.yaml')))
+    if t.poll():
+        t.transfer()
+    """
+
+    config = None
+    name = ''
+    model = None
+    args = {}
+
+    # next run to transfer
+    latest = None
+
+    # attempts at the current run
+    ntries = 0
+    ntriesmax = 1
+
+    # when to poll the model next, in seconds since the epoch
+    due = 0
+
+    # whether a transfer is queued or running
+    busy = False
+
+    # when the runs are published, see Schedule
+    schedule = None
+
+    # whether a poll found the next run missing, so the time it shows up says when it was published
+    waiting = False
+
+    def __init__(self, config, model=None, args=None):
+        """
+        Initialize the task with a config (see config/nam.yaml). The model is loaded from the config, unless one is given.
+        """
+
+        if not all([i in config for i in ('model','fields','modelint','poll')]):
+            raise Exception('Make sure the config has the model, fields, modelint, and poll fields')
+        self.config = config
+        self.name = config.get('name', config['model'])
+        if model == None:
+            model, args = loadmodel(config)
+        self.model = model
+        self.args = args if args != None else {}
+        self.ntriesmax = max(int(config['modelint']/config['poll']*2/3),1)
+        self.schedule = Schedule(config['model'], maxpoll=config['poll'], **config.get('schedule', {}))
+        self.latest = self.model.getlatesttime()
+        self.due = time.time()
+
+    def host(self):
+        """
+        HOST returns the server the model downloads from
+        """
+
+        return urlsplit(self.model.baseurl).netloc
+
+    def poll(self):
+        """
+        POLL checks whether the next run is available, and returns True if it should be transferred now.
+        The time of the next poll is set as if there is nothing to do; a transfer reschedules it when it's over.
+        While the next run isn't out, the next poll is planned around when it's expected to be published.
+        """
+
+        self.due = time.time() + self.config['poll']
+
+        # the run listings tell us when the next run is out, without probing for it
+        now = datetime.datetime.utcnow()
+        available = self.model.latestruns(4)
+        if self.latest == None:
+            if len(available) == 0:
+                print '%s: no runs on the server' % self.name
+                return False
+            self.latest = available[0]
+        if len(available) == 0 or self.latest > available[0]:
+            metrics.counter('forecasting_polls_total', 'Polls of the run listings').inc(model=self.name, result='missing')
+            self.waiting = True
+            due = self.schedule.nextpoll(self.latest, now)
+            self.due = time.time() + (due - now).total_seconds()
+            print '%s: no new data, the next run is %s, looking again at %s' % (self.name, self.latest, due.strftime('%H:%M:%S'))
+            return False
+
+        metrics.counter('forecasting_polls_total', 'Polls of the run listings').inc(model=self.name, result='available')
+        if self.waiting:
+            self.schedule.observe(self.latest, now)
+            metrics.histogram('forecasting_run_detection_seconds', 'Time from the datatime of a run to its detection on the server',
+                              buckets=[1800*i for i in range(1,13)]).observe((now - self.latest).total_seconds(), model=self.name)
+            self.waiting = False
+
+        if self.ntries >= self.ntriesmax:
+            print '%s: giving up on %s after %d tries' % (self.name, self.latest, self.ntries)
+            self.advance()
+            return False
+        return True
+
+    def transfer(self):
+        """
+        TRANSFER loads the next run into the database. Returns None on success, or the error.
+        """
+
+        print '%s: the new data is available! Downloading %s ...' % (self.name, self.latest)
+        self.ntries = self.ntries + 1
+        try:
+            self.model.transfer(self.config['fields'],self.latest,**self.args)
+            if 'retention' in self.config:
+                self.model.dropruns(self.config['retention'])
+        except Exception, e:
+            print '%s: an error occured in downloading %s, it might not actually be available: %s' % (self.name, self.latest, e)
+            metrics.counter('forecasting_transfers_total', 'Transfers of a run').inc(model=self.name, result='failed')
+            return e
+        metrics.counter('forecasting_transfers_total', 'Transfers of a run').inc(model=self.name, result='done')
+        self.advance()
+        # there may be more runs waiting, so look again right away
+        self.due = time.time()
+        return None
+
+    def advance(self):
+        """
+        ADVANCE moves on to the run after the current one
+        """
+
+        self.latest = self.latest + datetime.timedelta(seconds=self.config['modelint'])
+        self.ntries = 0
+        self.waiting = False
+        print '%s: the next run will happen at %s' % (self.name, self.latest)
+
+class Scheduler:
+    """
+    SCHEDULER runs the poll loops of several models in a single process.
+
+    The models are polled from one loop, each when it's due. Transfers are handed to a shared pool of worker threads,
+    so at most maxtransfers runs are transferred at the same time over all the models, and at most perhost from the
+    same server. Each model keeps its own database connection; its polls and transfers never overlap.
+
+    Usage:
+    s = Scheduler([yaml.load(open('config/nam.yaml')), yaml.load(open('config/rap.yaml'))], maxtransfers=2)
+    s.run()
+    """
+
+    # runs transferred at the same time, over all the models
+    maxtransfers = 2
+
+    # runs transferred from the same server at the same time
+    perhost = 2
+
+    # longest sleep of the loop, in seconds
+    maxsleep = 60
+
+    def __init__(self, configs=[], maxtransfers=None, perhost=None):
+        if maxtransfers != None:
+            self.maxtransfers = maxtransfers
+        if perhost != None:
+            self.perhost = perhost
+        self.tasks = []
+        self.queue = Queue.Queue()
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.threads = []
+        for config in configs:
+            self.add(ModelTask(config))
+
+    def add(self, task):
+        """
+        ADD schedules a ModelTask
+        """
+
+        with self.lock:
+            self.tasks.append(task)
+            if task.host() not in self.semaphores:
+                self.semaphores[task.host()] = threading.BoundedSemaphore(self.perhost)
+        self.wakeup.set()
+
+    def start(self):
+        """
+        START the worker threads
+        """
+
+        for i in range(self.maxtransfers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        """
+        RUN polls the models as they come due, until stop() is called
+        """
+
+        self.start()
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            wait = self.step()
+            self.wakeup.wait(min(wait, self.maxsleep))
+        for i in range(len(self.threads)):
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self):
+        """
+        STOP the loop and the workers, once the transfers under way are done
+        """
+
+        self.stopped.set()
+        self.wakeup.set()
+
+    def step(self):
+        """
+        STEP polls every model that is due, queues the transfers of the new runs, and returns the number of
+        seconds until the next model is due
+        """
+
+        with self.lock:
+            due = [(task.due, i, task) for i, task in enumerate(self.tasks) if not task.busy]
+        heapq.heapify(due)
+        while len(due) > 0 and due[0][0] <= time.time():
+            when, i, task = heapq.heappop(due)
+            try:
+                ready = task.poll()
+            except Exception, e:
+                print '%s: could not poll: %s' % (task.name, e)
+                continue
+            if ready:
+                task.busy = True
+                self.queue.put(task)
+
+        with self.lock:
+            waiting = [task.due for task in self.tasks if not task.busy]
+        if len(waiting) == 0:
+            return self.maxsleep
+        return max(min(waiting) - time.time(), 0)
+
+    def _worker(self):
+        """
+        Transfer the queued runs, one at a time
+        """
+
+        while True:
+            task = self.queue.get()
+            if task == None:
+                return
+            semaphore = self.semaphores[task.host()]
+            semaphore.acquire()
+            try:
+                task.transfer()
+            except Exception, e:
+                print '%s: transfer failed: %s' % (task.name, e)
+            finally:
+                semaphore.release()
+                task.busy = False
+                self.wakeup.set()
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+class SlabCache:
+    """
+    SLABCACHE keeps the hyperslabs downloaded from the remote server on local disk.
+
+    Each slab is stored as a .npy file named after a hash of the run url, the field, the variable and the
+    hyperslab, and is memory-mapped when it's read back. A transfer that is repeated (after a failure, a
+    schema change or for a backfill of a recent run) then reads the slabs from disk instead of the server.
+
+    The cache is kept under maxbytes by evicting the least recently used slabs; a slab counts as used when
+    it's written or read.
+
+    Usage:
+    c = SlabCache('/var/cache/forecasting-slabs', maxbytes=20*1024**3)
+    slab = c.load(url, 'tmp2m', 'array', index)
+    if slab is None:
+        slab = np.asarray(fieldconn.array[index])
+        c.save(url, 'tmp2m', 'array', index, slab)
+    """
+
+    directory = '/tmp/forecasting-slabs/'
+
+    # largest size of the cache in bytes
+    maxbytes = 10*1024**3
+
+    # evictions go down to this fraction of maxbytes, so they don't happen on every save
+    lowwater = 0.9
+
+    def __init__(self, directory=None, maxbytes=None):
+        if directory != None:
+            self.directory = directory
+        if maxbytes != None:
+            self.maxbytes = maxbytes
+        self.used = None
+        self.lock = threading.Lock()
+
+    def key(self, url, field, variable, index):
+        """
+        KEY returns the name of the file holding a slab. index is a slice or a tuple of slices, as passed to pydap.
+        """
+
+        if not isinstance(index, tuple):
+            index = (index,)
+        parts = []
+        for s in index:
+            if isinstance(s, slice):
+                parts.append('%s:%s:%s' % (s.start, s.stop, s.step))
+            else:
+                parts.append(str(s))
+        return hashlib.sha1('|'.join([url, field, variable] + parts)).hexdigest() + '.npy'
+
+    def load(self, url, field, variable, index):
+        """
+        LOAD returns the memory-mapped slab, or None if it isn't in the cache
+        """
+
+        path = os.path.join(self.directory, self.key(url, field, variable, index))
+        try:
+            slab = np.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+        # mark the slab as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return slab
+
+    def save(self, url, field, variable, index, slab):
+        """
+        SAVE writes a slab to the cache, evicting the least recently used slabs if the cache grows too large.
+        The file is written under a temporary name and renamed into place, so readers never see half a slab.
+        """
+
+        slab = np.asarray(slab)
+        if slab.nbytes > self.maxbytes:
+            return
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+
+        path = os.path.join(self.directory, self.key(url, field, variable, index))
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        try:
+            np.save(f, slab)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+        with self.lock:
+            if self.used == None:
+                self.used = self.size()
+            else:
+                self.used += os.path.getsize(path)
+            if self.used > self.maxbytes:
+                self.used = self.evict(int(self.maxbytes*self.lowwater))
+
+    def size(self):
+        """
+        SIZE returns the number of bytes used by the cache
+        """
+
+        return sum([size for mtime, size, path in self._entries()])
+
+    def evict(self, target):
+        """
+        EVICT removes the least recently used slabs until the cache is at most target bytes.
+        Returns the size of the cache afterwards.
+        """
+
+        entries = sorted(self._entries())
+        used = sum([size for mtime, size, path in entries])
+        for mtime, size, path in entries:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except OSError:
+                pass
+        return used
+
+    def clear(self):
+        """
+        CLEAR removes every slab
+        """
+
+        with self.lock:
+            self.evict(0)
+            self.used = 0
+
+    def _entries(self):
+        """
+        (last used, size, path) of every slab in the cache
+        """
+
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
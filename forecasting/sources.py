@@ -0,0 +1,470 @@
+import glob
+import os
+import re
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from pydap.client import open_url
+import pydap.lib
+pydap.lib.CACHE = "/tmp/pydap-cache/"
+
+import grib
+import netcdf
+import util
+from runs import RunDiscovery
+
+# netCDF4 reads NetCDF-4 (HDF5) files too; without it only the classic format can be read
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+# names the axes go by in NetCDF files, and the name they're given here
+AXES = {'time': 'time', 'lev': 'lev', 'level': 'lev', 'plev': 'lev', 'isobaric': 'lev', 'pressure': 'lev',
+        'lat': 'lat', 'latitude': 'lat', 'lon': 'lon', 'longitude': 'lon'}
+
+class OpendapSource:
+    """
+    OPENDAPSOURCE reads the runs of a model from an OPeNDAP server laid out like NOMADS: url/{model} lists the days,
+    url/{model}/{model}{date} the runs of a day and url/{model}/{model}{date}/{model}_{hour}z is a run.
+
+    A source gives the location of the run at a datatime, whether it's available, and opens it as a dataset of
+    grids (dataset['tmp2m'].array[time, lat, lon], with the time, lev, lat and lon axes). Its runs are found by
+    source.runs (see RunDiscovery).
+
+    Usage:
+    s = OpendapSource('nam', 'http://nomads.ncep.noaa.gov:9090/dods')
+    location = s.location(datetime(2014, 2, 22, 18))
+    if s.available(location):
+        dataset = s.open(location)
+    """
+
+    modelname = ''
+    baseurl = ''
+    timeurl = ''
+
+    def __init__(self, modelname, url):
+        self.modelname = modelname
+        url = url.rstrip('/')
+        self.baseurl = '{url}/{model}/{model}{date}/{model}_{hour}z'.format(url=url,model=modelname,date='{date}',hour='{hour}')
+        self.timeurl = '{url}/{model}'.format(url=url,model=modelname)
+        self.runs = RunDiscovery(modelname, self.timeurl)
+
+    def location(self, datatime):
+        """
+        LOCATION returns the url of the run at datatime
+        """
+        date = datetime.strftime(datatime, '%Y%m%d')
+        hour = datetime.strftime(datatime, '%H')
+        return self.baseurl.format(date=date,hour=hour)
+
+    def available(self, location):
+        """
+        AVAILABLE checks the dds of a run for an error
+        """
+        try:
+            util.request(location+'.dds')
+            return True
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except:
+            return False
+
+    def open(self, location):
+        """
+        OPEN a run with pydap. Nothing but the metadata is downloaded until the grids are sliced.
+        pydap's requests go through the shared connections of util.request (see util.install).
+        """
+        util.install()
+        return open_url(location)
+
+class FileSource:
+    """
+    FILESOURCE reads the runs of a model from local files, so runs that are already on disk (a mirror of
+    NOMADS, say) are loaded at the speed of the disk instead of downloaded again.
+
+    The files are found by a pattern with the {date} (yyyymmdd) and {hour} (hh) of the run:
+      * NetCDF: a file per run, with the fields as variables of (time, lat, lon) or (time, lev, lat, lon).
+        Classic files are memory-mapped (see netcdf.Dataset); NetCDF-4 files need the netCDF4 library, which
+        reads them a chunk at a time. Variables can be named differently from the fields: pass
+        variables={'tmp2m': 'TMP_2maboveground'}.
+      * GRIB2: a file per forecast hour, so the pattern also has the {fhour} of the file. Each file needs its
+        inventory (file + '.idx', from wgrib2 -s) next to it, and the messages of a field are read from the
+        memory-mapped file by their byte ranges (see grib.Dataset). Fields are looked up by the (variable, level)
+        of grib.FIELDS, or of the variables given: variables={'tmp2m': ('TMP', '2 m above ground')}.
+
+    The format is guessed from the pattern: GRIB2 if it has an {fhour}, NetCDF otherwise.
+
+    Usage:
+    s = FileSource('gfs', '/data/gfs/gfs.{date}/{hour}/gfs.t{hour}z.pgrb2.0p25.f{fhour}')
+    m = Model('gfs')
+    m.setsource(s)
+    m.transfer(['tmp2m'], datetime(2014, 2, 22, 18))
+    """
+
+    modelname = ''
+    baseurl = ''
+    timeurl = ''
+    format = 'netcdf'
+
+    def __init__(self, modelname, pattern, variables=None, format=None):
+        self.modelname = modelname
+        self.baseurl = pattern
+        self.variables = {}
+        if variables != None:
+            self.variables = dict([(k, tuple(v) if isinstance(v, list) else v) for k, v in variables.items()])
+        if format != None:
+            self.format = format
+        elif '{fhour}' in pattern:
+            self.format = 'grib'
+        if self.format == 'grib' and '{fhour}' not in pattern:
+            raise Exception('GRIB2 files need an {fhour} in the pattern')
+        if self.format not in ('netcdf', 'grib'):
+            raise Exception('Unknown file format %s' % self.format)
+        self.runs = FileRuns(self)
+
+    def location(self, datatime):
+        """
+        LOCATION returns the path of the run at datatime (still with its {fhour} for GRIB2)
+        """
+        date = datetime.strftime(datatime, '%Y%m%d')
+        hour = datetime.strftime(datatime, '%H')
+        return self.baseurl.format(date=date,hour=hour,fhour='{fhour}')
+
+    def available(self, location):
+        """
+        AVAILABLE checks that the files of the run are there
+        """
+        if self.format == 'grib':
+            return len(self.files(location)) > 0
+        return os.path.isfile(location)
+
+    def open(self, location):
+        """
+        OPEN the run at a location as a dataset of grids
+        """
+        if self.format == 'grib':
+            return grib.Dataset([(fhour, grib.LocalFile(path)) for fhour, path in self.files(location)], self.variables)
+        return NetcdfDataset(location, self.variables)
+
+    def files(self, location):
+        """
+        FILES returns the (forecast hour, path) of each GRIB2 file of a run
+        """
+        found = []
+        expression = re.compile('^' + re.escape(location).replace(re.escape('{fhour}'), '(\d+)') + '$')
+        for path in glob.glob(location.replace('{fhour}', '*')):
+            match = expression.match(path)
+            if match:
+                found.append((int(match.group(1)), path))
+        return sorted(found)
+
+    def paths(self):
+        """
+        PATHS returns the datatime of every run on disk
+        """
+        expression = re.escape(self.baseurl)
+        for name, group in (('date', '\d{8}'), ('hour', '\d\d'), ('fhour', '\d+')):
+            placeholder = re.escape('{%s}' % name)
+            expression = expression.replace(placeholder, '(?P<%s>%s)' % (name, group), 1).replace(placeholder, '(?P=%s)' % name)
+        expression = re.compile('^' + expression + '$')
+
+        runs = set()
+        for path in glob.glob(self.baseurl.format(date='*',hour='*',fhour='*')):
+            match = expression.match(path)
+            if match:
+                runs.add(datetime.strptime(match.group('date') + match.group('hour'), '%Y%m%d%H'))
+        return sorted(runs)
+
+class FileRuns:
+    """
+    FILERUNS finds the runs of a FileSource on disk, the way RunDiscovery finds them on a server
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def refresh(self):
+        pass
+
+    def days(self):
+        return sorted(set([int(run.strftime('%Y%m%d')) for run in self.source.paths()]))
+
+    def runs(self, day):
+        return sorted([run.hour for run in self.source.paths() if int(run.strftime('%Y%m%d')) == day])
+
+    def latestruns(self, n=1):
+        return list(reversed(self.source.paths()))[:n]
+
+class GribSource:
+    """
+    GRIBSOURCE downloads the runs of a model as GRIB2 files from an http server, a file per forecast hour with its
+    .idx inventory next to it, like https://nomads.ncep.noaa.gov/pub/data/nccf/com/. Only the messages of the fields
+    that are transferred are downloaded, with Range requests (see grib.RemoteFile and grib.Dataset): the ranges of
+    a file are merged into as few requests as possible, and up to connections requests are made at the same time.
+
+    The url pattern has the {date} (yyyymmdd) and {hour} (hh) of the run and the {fhour} of the file, with a format
+    if the forecast hour is padded, like {fhour:03d}. Plain file servers have no run listings, so the runs are found
+    by asking for them (see ProbedRuns); a run counts as available once the inventory of its last forecast hour is out.
+    Fields are looked up as for the GRIB2 files of a FileSource.
+
+    Usage:
+    s = GribSource('gfs', 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/gfs.{date}/{hour}/atmos/gfs.t{hour}z.pgrb2.0p25.f{fhour:03d}',
+                   fhours=range(0, 121, 3))
+    m = Model('gfs')
+    m.setsource(s)
+    """
+
+    modelname = ''
+    baseurl = ''
+    timeurl = ''
+
+    # forecast hours of a run, and hours of the runs of a day
+    fhours = [0]
+    hours = [0, 6, 12, 18]
+
+    # requests made at the same time
+    connections = 4
+
+    def __init__(self, modelname, pattern, fhours, hours=None, variables=None, connections=None):
+        self.modelname = modelname
+        self.baseurl = pattern
+        self.fhours = sorted(fhours)
+        if hours != None:
+            self.hours = sorted(hours)
+        self.variables = {}
+        if variables != None:
+            self.variables = dict([(k, tuple(v)) for k, v in variables.items()])
+        if connections != None:
+            self.connections = connections
+        if '{fhour' not in pattern:
+            raise Exception('GRIB2 files need an {fhour} in the pattern')
+        self.runs = ProbedRuns(self)
+
+    def location(self, datatime):
+        """
+        LOCATION returns the url of the run at datatime, still with its {fhour}
+        """
+        date = datetime.strftime(datatime, '%Y%m%d')
+        hour = datetime.strftime(datatime, '%H')
+        return self.baseurl.replace('{date}', date).replace('{hour}', hour)
+
+    def available(self, location):
+        """
+        AVAILABLE checks that the inventory of the last forecast hour is out
+        """
+        try:
+            resp, body = util.request(location.format(fhour=self.fhours[-1]) + '.idx')
+            return resp.status == 200
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except:
+            return False
+
+    def open(self, location):
+        """
+        OPEN the run at a location, with the inventories of every forecast hour
+        """
+        urls = [location.format(fhour=fhour) for fhour in self.fhours]
+        inventories = grib.parallel([lambda url=url: util.request(url + '.idx') for url in urls], self.connections)
+        files = []
+        for fhour, url, (resp, body) in zip(self.fhours, urls, inventories):
+            if resp.status != 200:
+                raise Exception('Could not read the inventory of %s: %s' % (url, resp.status))
+            files.append((fhour, grib.RemoteFile(url, body)))
+        return grib.Dataset(files, self.variables, self.connections)
+
+class ProbedRuns:
+    """
+    PROBEDRUNS finds the runs of a GribSource by asking the source whether each run is available, from the latest
+    cycle back over lookback days. Runs that are out are remembered; missing runs are asked for again after
+    ttl seconds, so polling for the next run costs a request.
+    """
+
+    # days of runs looked at
+    lookback = 2
+
+    # seconds a missing run is trusted to be missing
+    ttl = 120
+
+    def __init__(self, source, lookback=None, ttl=None):
+        self.source = source
+        if lookback != None:
+            self.lookback = lookback
+        if ttl != None:
+            self.ttl = ttl
+        self.found = set()
+        self.missing = {}
+
+    def refresh(self):
+        self.missing = {}
+
+    def candidates(self):
+        """
+        CANDIDATES returns the datatimes of the runs that could be out, newest first
+        """
+        now = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        hours = [now - timedelta(hours=i) for i in range(24*self.lookback)]
+        return [run for run in hours if run.hour in self.source.hours]
+
+    def available(self, run):
+        if run in self.found:
+            return True
+        if run in self.missing and time.time() - self.missing[run] < self.ttl:
+            return False
+        if self.source.available(self.source.location(run)):
+            self.found.add(run)
+            return True
+        self.missing[run] = time.time()
+        return False
+
+    def days(self):
+        return sorted(set([int(run.strftime('%Y%m%d')) for run in self.candidates() if self.available(run)]))
+
+    def runs(self, day):
+        return sorted([run.hour for run in self.candidates() if int(run.strftime('%Y%m%d')) == day and self.available(run)])
+
+    def latestruns(self, n=1):
+        results = []
+        for run in self.candidates():
+            if len(results) >= n:
+                break
+            if self.available(run):
+                results.append(run)
+        return results
+
+class NetcdfGrid:
+    """
+    NETCDFGRID is a variable of a NetCDF file with the look of a grid of an OPeNDAP dataset: its array is sliced as
+    [time, lev, lat, lon] (or [time, lat, lon]), with the axes as time, lev, lat and lon. Times are given in days since
+    0001-01-01 (plus one) and levels in mb, as the OPeNDAP server sends them.
+    Missing values are set to grib.MISSING, and packed values are unpacked.
+    """
+
+    name = ''
+    dimensions = ()
+    shape = ()
+
+    def __init__(self, name, variable, dataset):
+        self.name = name
+        self.variable = variable
+        self.dimensions = tuple([AXES.get(d, d) for d in variable.dimensions])
+        self.shape = tuple(variable.shape)
+
+        # latitudes go from south to north and levels from the ground up, as on the OPeNDAP server
+        self.flipped = []
+        for i, (d, axis) in enumerate(zip(variable.dimensions, self.dimensions)):
+            if axis not in ('time', 'lev', 'lat', 'lon'):
+                continue
+            if d in dataset.variables:
+                values = _unpack(dataset.variables[d], dataset.variables[d][:])
+                units = _attribute(dataset.variables[d], 'units', '')
+            else:
+                values = np.arange(variable.shape[i])
+                units = ''
+            if axis == 'time':
+                values = _ordinals(values, units)
+            elif axis == 'lev' and units == 'Pa':
+                values = values/100.
+            if d in dataset.variables and len(values) > 1 and ((axis == 'lat' and values[0] > values[-1]) or (axis == 'lev' and values[0] < values[-1])):
+                values = values[::-1]
+                self.flipped.append(i)
+            setattr(self, axis, np.asarray(values))
+        self.array = _NetcdfArray(self)
+
+class _NetcdfArray:
+    def __init__(self, grid):
+        self.grid = grid
+        self.shape = grid.shape
+
+    def __getitem__(self, index):
+        grid = self.grid
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = list(index + (slice(None),)*(len(grid.shape) - len(index)))
+
+        # the flipped axes are read in the order of the file, and turned around
+        for i in grid.flipped:
+            n = grid.shape[i]
+            if isinstance(index[i], slice):
+                rows = np.arange(n)[::-1][index[i]]
+                if len(rows) == 0:
+                    index[i] = slice(0, 0)
+                else:
+                    step = abs(rows[1] - rows[0]) if len(rows) > 1 else 1
+                    index[i] = slice(rows.min(), rows.max() + 1, step)
+            else:
+                index[i] = n - 1 - (index[i] % n)
+
+        values = _unpack(grid.variable, grid.variable[tuple(index)])
+
+        for i in grid.flipped:
+            if isinstance(index[i], slice):
+                values = np.flip(values, i - len([s for s in index[:i] if not isinstance(s, slice)]))
+        return values
+
+class NetcdfDataset:
+    """
+    NETCDFDATASET opens a NetCDF file of a run as a dataset of grids (see NetcdfGrid), with the netCDF4 library
+    when it's installed, and with netcdf.Dataset (classic files only) otherwise
+    """
+
+    def __init__(self, path, variables=None):
+        self.path = path
+        self.names = variables if variables != None else {}
+        if netCDF4 != None:
+            self.dataset = netCDF4.Dataset(path)
+            self.dataset.set_auto_maskandscale(False)
+        else:
+            self.dataset = netcdf.Dataset(path)
+        self.cache = {}
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            variable = self.names.get(name, name)
+            if variable not in self.dataset.variables:
+                raise Exception('%s is not in %s' % (variable, self.path))
+            self.cache[name] = NetcdfGrid(name, self.dataset.variables[variable], self.dataset)
+        return self.cache[name]
+
+def _attribute(variable, name, default=None):
+    if name in variable.ncattrs():
+        return variable.getncattr(name)
+    return default
+
+def _unpack(variable, values):
+    """
+    Apply the scale_factor and add_offset of a variable, and set its missing values to grib.MISSING
+    """
+    values = np.asarray(values)
+    missing = None
+    for name in ('_FillValue', 'missing_value'):
+        fill = _attribute(variable, name)
+        if fill is not None:
+            missing = (values == fill) if missing is None else (missing | (values == fill))
+    scale = _attribute(variable, 'scale_factor')
+    offset = _attribute(variable, 'add_offset')
+    if scale is not None or offset is not None:
+        values = values*(scale if scale is not None else 1) + (offset if offset is not None else 0)
+    if missing is not None and np.any(missing):
+        values = np.where(missing, grib.MISSING, values).astype(values.dtype if values.dtype.kind == 'f' else 'f8')
+    return values
+
+# units of the time axis, in days
+TIMEUNITS = {'second': 1/86400., 'minute': 1/1440., 'hour': 1/24., 'day': 1.}
+
+def _ordinals(values, units):
+    """
+    Turn the values of a time axis ('hours since 2014-02-22 18:00', ...) into days since 0001-01-01 (plus one)
+    """
+    match = re.match('^\s*(second|minute|hour|day)s? since (\d+)-(\d+)-(\d+)(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?', units)
+    if not match:
+        raise Exception('Unknown time units: %s' % units)
+    if int(match.group(2)) == 1 and match.group(1) == 'day':
+        # already the days since 1-1-1 of the OPeNDAP server
+        return np.asarray(values, dtype='f8')
+    base = datetime(int(match.group(2)), int(match.group(3)), int(match.group(4)))
+    if match.group(5) != None:
+        base = base + timedelta(hours=int(match.group(5)), minutes=int(match.group(6)), seconds=float(match.group(7) or 0))
+    return grib.ordinal(base) + np.asarray(values, dtype='f8')*TIMEUNITS[match.group(1)]
@@ -1,9 +1,115 @@
 import re
+import threading
+import Queue
 from urlparse import urlsplit, urlunsplit
 import httplib2
 
+import metrics
 
-def request(url):
+# Settings for the shared http client, see configure()
+CACHE = "/tmp/pydap-cache/"
+TIMEOUT = 120
+POOLSIZE = 8
+
+class HttpPool:
+    """
+    HTTPPOOL hands out httplib2.Http clients, each to one thread at a time.
+
+    A client keeps its connections open between requests, so consecutive requests to the same
+    server skip the TCP (and TLS) handshake. httplib2.Http isn't thread-safe, hence the pool:
+    a thread borrows a client for the duration of a request and gives it back afterwards.
+
+    Usage:
+    pool = HttpPool(size=8, timeout=60, cache='/tmp/pydap-cache/')
+    h = pool.acquire()
+    try:
+        resp, data = h.request(url)
+    finally:
+        pool.release(h)
+    """
+
+    def __init__(self, size, timeout, cache):
+        self.size = size
+        self.timeout = timeout
+        self.cache = cache
+        self.clients = Queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Borrow a client, creating one if the pool isn't full yet, otherwise waiting for one
+        """
+        try:
+            return self.clients.get_nowait()
+        except Queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return httplib2.Http(cache=self.cache, timeout=self.timeout)
+        return self.clients.get()
+
+    def release(self, h):
+        """
+        Give a client back to the pool
+        """
+        self.clients.put(h)
+
+    def close(self):
+        """
+        Close the open connections of the clients that aren't in use
+        """
+        while True:
+            try:
+                h = self.clients.get_nowait()
+            except Queue.Empty:
+                break
+            for conn in h.connections.values():
+                conn.close()
+            h.connections.clear()
+
+_pool = None
+_poollock = threading.Lock()
+
+# pydap's own request functions while request() stands in for them, see install()
+_installed = None
+
+def configure(timeout=None, poolsize=None, cache=None):
+    """
+    Configure the shared http client used by request(). Any open connections are dropped.
+
+    Arguments:
+      * timeout: socket timeout in seconds
+        poolsize: the largest number of requests in flight at the same time
+        cache: directory of the cache for metadata documents (.dds, .das, listings), False to disable it
+    """
+    global CACHE, TIMEOUT, POOLSIZE, _pool
+
+    if timeout != None:
+        TIMEOUT = timeout
+    if poolsize != None:
+        POOLSIZE = poolsize
+    if cache != None:
+        CACHE = cache or None
+    with _poollock:
+        if _pool != None:
+            _pool.close()
+        _pool = None
+
+def pool():
+    """
+    The shared http client pool, created on first use
+    """
+    global _pool
+
+    with _poollock:
+        if _pool == None:
+            _pool = HttpPool(POOLSIZE, TIMEOUT, CACHE)
+        return _pool
+
+def request(url, headers=None):
     """
     Open a given URL and return headers and body.
 
@@ -12,21 +118,39 @@ def request(url):
     username and password to the URL; this will be sent as clear text
     only if the server only supports Basic authentication.
 
+    Connections are kept alive and shared between calls through the pool. Metadata documents
+    are cached on disk and revalidated with conditional requests; data (.dods) responses and
+    byte ranges are never cached.
+
     """
-    h = httplib2.Http(cache="/tmp/pydap-cache/")
     scheme, netloc, path, query, fragment = urlsplit(url)
+    credentials = None
     if '@' in netloc:
         credentials, netloc = netloc.split('@', 1)  # remove credentials from netloc
-        username, password = credentials.split(':', 1)
-        h.add_credentials(username, password)
 
     url = urlunsplit((
             scheme, netloc, path, query, fragment
             )).rstrip('?&')
 
-    resp, data = h.request(url, "GET", headers = {
-        'user-agent': 'TESTING-AGENT',
-        'connection': 'close'})
+    allheaders = {'user-agent': 'TESTING-AGENT'}
+    if headers != None:
+        for key, value in headers.items():
+            allheaders[key.lower()] = value
+    if path.endswith('.dods') or 'range' in allheaders:
+        allheaders['cache-control'] = 'no-store'
+
+    p = pool()
+    h = p.acquire()
+    try:
+        h.clear_credentials()
+        if credentials != None:
+            username, password = credentials.split(':', 1)
+            h.add_credentials(username, password)
+        resp, data = h.request(url, "GET", headers = allheaders)
+    finally:
+        p.release(h)
+    metrics.counter('forecasting_http_requests_total', 'Requests made to remote servers').inc(host=netloc, status=resp.status)
+    metrics.counter('forecasting_http_bytes_total', 'Bytes downloaded from remote servers').inc(len(data), host=netloc)
 
     # When an error is returned, we parse the error message from the
     # server and return it in a ``ClientError`` exception.
@@ -37,3 +161,39 @@ def request(url):
         raise Exception(msg)
 
     return resp, data
+
+def install():
+    """
+    Route pydap's requests through request(), so data downloads share the pooled connections. Nothing is changed
+    until this is called (OpendapSource does when it opens a run), and uninstall() puts pydap's own requests back.
+    """
+    global _installed
+    try:
+        import pydap.client
+        import pydap.proxy
+        import pydap.util.http
+    except ImportError:
+        return
+
+    with _poollock:
+        if _installed != None:
+            return
+        _installed = (pydap.client.request, pydap.proxy.request, pydap.util.http.request)
+        pydap.client.request = request
+        pydap.proxy.request = request
+        pydap.util.http.request = request
+
+def uninstall():
+    """
+    Undo install()
+    """
+    global _installed
+
+    with _poollock:
+        if _installed == None:
+            return
+        import pydap.client
+        import pydap.proxy
+        import pydap.util.http
+        pydap.client.request, pydap.proxy.request, pydap.util.http.request = _installed
+        _installed = None
@@ -3,11 +3,11 @@
 from distutils.core import setup
 
 setup(name='Forecasting',
-      version='0.5.0',
+      version='0.10.0',
       description='Weather Forecasting Utilities',
       author='Spencer Alexander',
       author_email='contact@getforecasting.com',
       url='http://getforecasting.com',
       packages=['forecasting'],
-      package_data={'forecasting': ['db/0.5.0/up/*.sql','db/0.5.0/down/*.sql']},
+      package_data={'forecasting': ['db/0.5.0/up/*.sql','db/0.5.0/down/*.sql','db/0.6.0/up/*.sql','db/0.6.0/down/*.sql','db/0.7.0/up/*.sql','db/0.7.0/down/*.sql','db/0.8.0/up/*.sql','db/0.8.0/down/*.sql','db/0.9.0/up/*.sql','db/0.9.0/down/*.sql','db/0.10.0/up/*.sql','db/0.10.0/down/*.sql']},
      )
@@ -0,0 +1,128 @@
+import unittest
+import threading
+from datetime import datetime
+
+from forecasting import backfill
+from forecasting.backfill import Backfill, parsetime
+from forecasting.model import Model
+
+class FakeRuns:
+    def days(self):
+        return [20140221, 20140222, 20140223]
+
+    def runs(self, day):
+        return [0, 6, 12, 18]
+
+class FakeDatabase:
+    def __init__(self):
+        self.checkpoints = []
+
+    def setcheckpoint(self, datatime, fields, scope):
+        self.checkpoints.append((datatime, fields, scope))
+
+class FakePlanDatabase:
+    def getcheckpoints(self, scope, start, end):
+        return set()
+
+    def close(self):
+        pass
+
+class FakeModel:
+    baseurl = 'http://nomads.ncep.noaa.gov:9090/dods/nam/nam{date}/nam_{hour}z'
+    calcfields = []
+
+    def __init__(self, fail=False):
+        self.database = FakeDatabase()
+        self.fail = fail
+        self.transfers = []
+
+    def transfer(self, fields, datatime=None, geos=None, pressure=None):
+        self.transfers.append((fields, datatime, [c.keys()[0] for c in self.calcfields]))
+        if self.fail:
+            raise Exception('Datatime is not available on the remote server')
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {'model': 'nam', 'fields': ['ugrd10m','tmp2m','vgrd10m'], 'geos': {'lat': 40., 'lon': -105., 'k': 1}}
+        self.b = Backfill([self.config], processes=2, perhost=1)
+
+    def test_a_datatimes(self):
+        datatimes = self.b.datatimes(FakeRuns(), datetime(2014,2,21,12), datetime(2014,2,22,6))
+        self.assertEqual(datatimes, [datetime(2014,2,21,12), datetime(2014,2,21,18), datetime(2014,2,22,0), datetime(2014,2,22,6)])
+
+    def test_b_groups(self):
+        m = Model('nam')
+        m.addcalculatedfield('wnd10m', ['ugrd10m','vgrd10m'], 'sqrt(ugrd10m^2+vgrd10m^2)')
+        m.addcalculatedfield('rhosfc', ['pressfc','tmpsfc'], 'pressfc/(tmpsfc*%(r)s)', {'r': 287.058})
+        self.assertEqual(self.b.groups(m, self.config['fields']), [['ugrd10m','vgrd10m'], ['tmp2m']])
+
+    def test_c_pending(self):
+        d = datetime(2014,2,22,0)
+        units = [(0, d, ['ugrd10m','vgrd10m']), (0, d, ['tmp2m']), (0, datetime(2014,2,22,6), ['tmp2m'])]
+        done = set([(d, 'ugrd10m'), (d, 'tmp2m')])
+        self.assertEqual(self.b.pending(units, done), [units[0], units[2]], 'Half done unit skipped')
+
+    def test_d_scope(self):
+        other = dict(self.config, geos={'lat': 41., 'lon': -105., 'k': 1})
+        self.assertEqual(self.b.scope(self.config), self.b.scope(dict(self.config, fields=['tmp2m'])))
+        self.assertNotEqual(self.b.scope(self.config), self.b.scope(other), 'Different geos share a scope')
+        self.assertEqual(len(self.b.scope(self.config)), 40)
+
+    def test_e_transferunit(self):
+        m = FakeModel()
+        m.calcfields = [{'wnd10m': {'dependents': ['ugrd10m','vgrd10m'], 'calculation': 'sqrt(ugrd10m^2+vgrd10m^2)'}}]
+        backfill._initworker([self.config], {'nomads.ncep.noaa.gov:9090': threading.Semaphore(1)})
+        backfill._worker['models'][0] = (m, {'geos': self.config['geos']}, list(m.calcfields))
+
+        d = datetime(2014,2,22,0)
+        self.assertEqual(backfill._transferunit((0, d, ['tmp2m'])), (0, d, ['tmp2m'], None))
+        self.assertEqual(backfill._transferunit((0, d, ['ugrd10m','vgrd10m']))[3], None)
+        self.assertEqual([t[2] for t in m.transfers], [[], ['wnd10m']], 'Calculations not limited to the unit')
+        self.assertEqual([c[:2] for c in m.database.checkpoints], [(d, ['tmp2m']), (d, ['ugrd10m','vgrd10m'])])
+        self.assertEqual(m.database.checkpoints[0][2], self.b.scope(self.config))
+
+    def test_f_failedunit(self):
+        m = FakeModel(fail=True)
+        backfill._initworker([self.config], {'nomads.ncep.noaa.gov:9090': threading.Semaphore(1)})
+        backfill._worker['models'][0] = (m, {}, [])
+        m.database.close = lambda: None
+
+        unit = (0, datetime(2014,2,22,0), ['tmp2m'])
+        self.assertEqual(backfill._transferunit(unit), unit + ('Datatime is not available on the remote server',))
+        self.assertEqual(m.database.checkpoints, [], 'Failed unit recorded as done')
+        self.assertFalse(0 in backfill._worker['models'], 'Failed model kept')
+
+    def test_g_parsetime(self):
+        self.assertEqual(parsetime('2014-02-01'), datetime(2014,2,1))
+        self.assertEqual(parsetime('2014-02-01', end=True), datetime(2014,2,1,23))
+        self.assertEqual(parsetime('2014-02-01T06'), datetime(2014,2,1,6))
+        self.assertEqual(parsetime('2014020118'), datetime(2014,2,1,18))
+
+    def test_h_server(self):
+        # the model of a config with its own server downloads from that server, not from NOMADS
+        def loadmodel(config):
+            m = Model(config['model'])
+            m.setserver(config['server'])
+            m._setup = lambda: None
+            m.runs = FakeRuns()
+            m.database = FakePlanDatabase()
+            return m, {}
+        config = dict(self.config, server='http://localhost:8001/dods/')
+        b = Backfill([config])
+        original = backfill.loadmodel
+        backfill.loadmodel = loadmodel
+        try:
+            units = b.plan(datetime(2014,2,22,0), datetime(2014,2,22,6))
+        finally:
+            backfill.loadmodel = original
+        self.assertEqual(len(units), 6)
+        self.assertEqual(b.hosts, set(['localhost:8001']))
+
+        m = FakeModel()
+        m.baseurl = 'http://localhost:8001/dods/nam/nam{date}/nam_{hour}z'
+        backfill._initworker([config], dict([(host, threading.Semaphore(1)) for host in b.hosts]))
+        backfill._worker['models'][0] = (m, {}, [])
+        self.assertEqual(backfill._transferunit(units[0])[3], None)
+
+if __name__ == '__main__':
+    unittest.main()
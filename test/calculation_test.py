@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+
+from forecasting.calculation import Calculation
+
+class CalculationTest(unittest.TestCase):
+    def test_a_evaluate(self):
+        c = Calculation('wnd10m', ['ugrd10m','vgrd10m'], 'sqrt(ugrd10m^2+vgrd10m^2)')
+        self.assertTrue(c.supported())
+        values = c.evaluate({'ugrd10m': np.array([3.,0.]), 'vgrd10m': np.array([4.,2.])})
+        self.assertEqual(list(values), [5.,2.])
+
+    def test_b_functions(self):
+        c = Calculation('rhosfc', ['pressfc','tmpsfc'], 'pressfc/(tmpsfc*287.058) + ln(exp(0)) + log(10)')
+        values = c.evaluate({'pressfc': np.array([287.058]), 'tmpsfc': np.array([1.])})
+        self.assertAlmostEqual(values[0], 2.)
+
+    def test_c_unused(self):
+        c = Calculation('one', ['a','b'], 'a*0 + 1')
+        self.assertEqual(c.evaluate({'a': np.zeros(3), 'b': np.zeros(3)}).shape, (3,))
+
+    def test_d_invalid(self):
+        c = Calculation('root', ['a'], 'sqrt(a)')
+        self.assertTrue(np.isnan(c.evaluate({'a': np.array([-1.])})[0]))
+
+    def test_d_parameters(self):
+        c = Calculation('rhosfc', ['pressfc','tmpsfc'], 'pressfc/(tmpsfc*%(r)s)', {'r': 2.})
+        self.assertEqual(c.evaluate({'pressfc': np.array([8.]), 'tmpsfc': np.array([2.])})[0], 2.)
+        self.assertFalse(Calculation('rhosfc', ['pressfc','tmpsfc'], 'pressfc/(tmpsfc*%(r)s)').supported())
+
+    def test_e_unsupported(self):
+        # these either mean something else in python, or aren't plain arithmetic
+        for calculation in ['-a^2', 'a^b^2', 'a % b', 'c + a', '__import__(a)', 'a.real', 'case when a > 0 then a else b end']:
+            c = Calculation('x', ['a','b'], calculation)
+            self.assertFalse(c.supported(), '%s should be left to the database' % calculation)
+            self.assertRaises(Exception, c.evaluate, {'a': np.zeros(1), 'b': np.zeros(1)})
+
+    def test_f_validate(self):
+        # what only python reads differently is fine in the database
+        for calculation in ['-a^2', 'a^b^2', 'sqrt(a^2+b^2)', 'a*%(r)s']:
+            Calculation('x', ['a','b'], calculation, {'r': 1.}).validate()
+        try:
+            Calculation('rhosfc', ['pressfc','tmpsfc'], 'pressfc/(tmpsfc*%(r)s)').validate()
+            self.fail('Missing parameter let through')
+        except Exception, e:
+            self.assertTrue('parameter r' in str(e), str(e))
+        for calculation in ['a; drop table data', 'c + a', '__import__(a)', 'a.real']:
+            self.assertRaises(Exception, Calculation('x', ['a','b'], calculation).validate)
+        self.assertRaises(Exception, Calculation('x', ['a','b) as x; --'], 'a').validate)
+
+if __name__ == '__main__':
+    unittest.main()
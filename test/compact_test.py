@@ -0,0 +1,43 @@
+import unittest
+import zlib
+import numpy as np
+
+from forecasting.compact import encodeslice, decodeslice
+
+class CompactTest(unittest.TestCase):
+    def setUp(self):
+        self.ords = np.arange(1000, 3000)
+        self.values = (280. + 10*np.sin(np.arange(2000)/50.)).astype('f4')
+        self.values[7] = np.nan
+
+    def test_a_roundtrip(self):
+        firstord, lastord, npoints, scale, ords, values = encodeslice(self.ords, self.values)
+        self.assertEqual((firstord, lastord, npoints, scale), (1000, 2999, 2000, None))
+        dords, dvalues = decodeslice(npoints, scale, ords, values)
+        self.assertTrue(np.all(dords == self.ords))
+        self.assertTrue(np.array_equal(np.isnan(dvalues), np.isnan(self.values)))
+        self.assertTrue(np.all(dvalues[~np.isnan(dvalues)] == self.values[~np.isnan(self.values)]))
+
+    def test_b_compressed(self):
+        row = encodeslice(self.ords, self.values)
+        self.assertTrue(len(row[4]) < 100, 'Ords not compressed')
+        self.assertTrue(len(row[5]) < 4*2000, 'Values not compressed')
+
+    def test_c_quantized(self):
+        npoints, scale, ords, values = encodeslice(self.ords, self.values, precision=0.01)[2:]
+        dords, dvalues = decodeslice(npoints, scale, ords, values)
+        self.assertTrue(np.isnan(dvalues[7]))
+        self.assertTrue(np.nanmax(np.abs(dvalues - self.values)) <= 0.005 + 1e-4)
+        self.assertTrue(len(values) < len(encodeslice(self.ords, self.values)[5]), 'Quantized values larger than float32')
+
+    def test_d_unordered(self):
+        npoints, scale, ords, values = encodeslice([5, 2, 9], [1., 2., 3.])[2:]
+        dords, dvalues = decodeslice(npoints, scale, ords, values)
+        self.assertEqual(list(dords), [2, 5, 9])
+        self.assertEqual(list(dvalues), [2., 1., 3.])
+
+    def test_e_toolarge(self):
+        self.assertRaises(Exception, encodeslice, [1], [1e10], 0.01)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import os
+import threading
 import datetime
 import numpy as np
 import psycopg2 as pg
@@ -39,6 +40,16 @@ class DatabaseTest(unittest.TestCase):
         self.d.setupgrid(self.lat,self.lon)
         self.assertEqual(self.d.numberofgridpoints(),len(self.lat)*len(self.lon), 'Grid not initialized')
 
+    def test_b_setupgridgeom(self):
+        conn = pg.connect(database=self.database)
+        curs = conn.cursor()
+        curs.execute('select ord, ST_X(geom), ST_Y(geom) from gridpoints where modelid = %d order by ord' % self.d.dbmodelid)
+        rows = curs.fetchall()
+        conn.close()
+        self.assertEqual([row[0] for row in rows],[0,1,2,3],'Grid ord not sequential')
+        self.assertEqual(rows[1][1:],(self.lon[1],self.lat[0]),'Grid ord does not match lat/lon')
+        self.assertEqual(rows[2][1:],(self.lon[0],self.lat[1]),'Grid ord does not match lat/lon')
+
     def test_c_createfields(self):
         field1 = self.d.getfieldid('field1')
         self.assertEqual(field1,1,'Field not initialized')
@@ -62,6 +73,46 @@ class DatabaseTest(unittest.TestCase):
         forecast2 = self.d.getforecastid(field2, datatime,datatime,None)
         self.assertEqual(forecast2,2,'Forecast not initialized')
 
+    def test_d_forecastids(self):
+        field1 = self.d.getfieldid('field1')
+        field2 = self.d.getfieldid('field2')
+
+        # use a separate run so the forecasts don't interfere with the calculated fields
+        datatime = self.datatime + datetime.timedelta(days=1)
+        later = datatime + datetime.timedelta(hours=1)
+        forecasts = [(field1,datatime,datatime,None),(field1,datatime,later,None),(field2,datatime,datatime,850.),(field1,datatime,datatime,None)]
+
+        forecastids = self.d.getforecastids(forecasts)
+        self.assertEqual(len(forecastids),4,'Wrong number of forecastids')
+        self.assertEqual(len(set(forecastids)),3,'Forecast duplicated')
+        self.assertEqual(forecastids[0],forecastids[3],'Forecast duplicated')
+
+        forecastidsa = self.d.getforecastids(forecasts)
+        self.assertEqual(list(forecastids),list(forecastidsa),'Forecast duplicated on repeat')
+
+        forecastid = self.d.getforecastid(field2,datatime,datatime,850.)
+        self.assertEqual(forecastid,forecastids[2],'Bulk and single forecastids disagree')
+
+    def test_d_forecastidsconcurrent(self):
+        # connections creating the same forecasts at the same time end up with the same forecastids
+        field1 = self.d.getfieldid('field1')
+        datatime = self.datatime + datetime.timedelta(days=2)
+        forecasts = [(field1,datatime,datatime + datetime.timedelta(hours=h),lev) for h in range(24) for lev in [None,850.,500.]]
+        results = []
+        def resolve():
+            d = Database(database=self.database)
+            d.cachemodelid('rap')
+            results.append(list(d.getforecastids(forecasts)))
+            d.close()
+        threads = [threading.Thread(target=resolve) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results),4)
+        self.assertTrue(all([r == results[0] for r in results]),'Forecasts created twice')
+        self.assertEqual(len(set(results[0])),len(forecasts),'Forecasts shared')
+
     # Helper to count the number of datapoints for a forecast
     def forecastcount(self,forecastid):
         q = 'SELECT count(*) from data where forecastid = %d' % forecastid
@@ -112,6 +163,33 @@ class DatabaseTest(unittest.TestCase):
         self.d.senddata(data)
         self.assertEqual(self.forecastcount(forecast2),4,'Incorrect forecast length')
 
+    def test_d_upsert(self):
+        field1 = self.d.getfieldid('field1')
+        datatime = self.datatime + datetime.timedelta(days=2)
+        forecastid = self.d.getforecastid(field1,datatime,datatime,None)
+        gridpointids = self.d.retrievegridids()
+
+        dtype = ([('forecastid','i4'), ('gridpointid','i4'), ('value','f4')])
+        data = np.empty(len(gridpointids),dtype)
+        data['gridpointid'] = gridpointids
+        data['forecastid'] = forecastid
+        data['value'] = self.dfield1
+        self.d.senddata(data)
+
+        # a repeat keeps the existing values by default
+        data['value'] = self.dfield2
+        self.d.senddata(data)
+        self.assertEqual(self.forecastcount(forecastid),4,'Incorrect forecast length on repeat')
+        self.assertEqual(sorted(self.forecastvalues(forecastid)),sorted(self.dfield1),'Existing values overwritten')
+
+        # unless asked to overwrite them, with duplicates in the same batch
+        self.d.setconflict('overwrite')
+        data = np.concatenate([data,data])
+        self.d.senddata(data)
+        self.d.setconflict('keep')
+        self.assertEqual(self.forecastcount(forecastid),4,'Incorrect forecast length on overwrite')
+        self.assertEqual(sorted(self.forecastvalues(forecastid)),sorted(self.dfield2),'Existing values not overwritten')
+
     def test_e_knn(self):
         knn = self.d.getknn(1,1,1,len(self.lon))
         self.assertEqual(knn,[[[0,1,1],[0,1,1]]])
@@ -128,12 +206,141 @@ class DatabaseTest(unittest.TestCase):
 
         print self.forecastvalues(forecast3)
 
+    def test_f_calcfieldparameters(self):
+        datatime = self.datatime
+
+        self.d.calculatefield('field4',['field1','field2'],'field1*%(a)s+field2',datatime,{'a': 2.})
+        # a second run of the same calculation reuses the prepared statement
+        self.d.calculatefield('field4',['field1','field2'],'field1*%(a)s+field2',datatime,{'a': 2.})
+
+        field4 = self.d.getfieldid('field4')
+        forecast4 = self.d.getforecastid(field4,datatime,datatime,None)
+        self.assertEqual(sorted(self.forecastvalues(forecast4)),[6,7,8,9],'Incorrect calculated values')
+
     def test_f_badcalcfield(self):
         datatime = self.datatime
         self.assertRaises(Exception,self.d.calculatefield,'field3',['field1','fieldnotexist'],'field1+field2',datatime)
 
+    def test_g_runs(self):
+        runid = self.d.getrunid(self.datatime)
+        self.assertEqual(runid,self.d.getrunid(self.datatime),'Run duplicated')
+        conn = pg.connect(database=self.database)
+        curs = conn.cursor()
+        curs.execute("select to_regclass('data_r%d') is not null" % runid)
+        self.assertTrue(curs.fetchone()[0],'Run partition not created')
+        curs.execute('select count(*) from forecasts where runid is null')
+        self.assertEqual(curs.fetchone()[0],0,'Forecast without a run')
+        conn.close()
+
+    def test_h_timeseries(self):
+        runid, datatime = self.d.getrun(self.datatime)
+        self.assertEqual(datatime,self.datatime,'Wrong run')
+        gridpointids = self.d.retrievegridids()
+        rows = self.d.gettimeseries(['field1'],runid,gridpointids[:2])
+        self.assertEqual(len(rows),2,'Incorrect timeseries length')
+        self.assertEqual([row[4] for row in rows],self.dfield1[:2],'Incorrect timeseries values')
+        self.assertEqual(self.d.getrun(datetime.datetime(2000,1,1)),None,'Found a run that does not exist')
+
+    def test_h_readdata(self):
+        runid, datatime = self.d.getrun(self.datatime)
+        forecasts = self.d.getforecasts('field1',runid)
+        forecastids = [f[0] for f in forecasts]
+        rows = self.d.readdata(forecastids,runid)
+        self.assertEqual(len(rows),4*len(forecastids),'Incorrect number of values')
+        rows = np.sort(rows[rows['idx'] == 1],order='gridpointid')
+        self.assertEqual(list(rows['value']),self.dfield1,'Incorrect values')
+
+        gridpointids = self.d.retrievegridids()
+        rows = self.d.readdata(forecastids,runid,gridpointids[:1])
+        self.assertEqual(len(rows),len(forecastids),'Values outside of the crop')
+
+    def test_h_arrays(self):
+        field1 = self.d.getfieldid('field1')
+        datatime = self.datatime + datetime.timedelta(days=3)
+        forecastid = self.d.getforecastid(field1,datatime,datatime,None)
+        runid = self.d.getrunid(datatime)
+        gridpointids = self.d.retrievegridids()
+
+        dtype = ([('forecastid','i4'), ('gridpointid','i4'), ('value','f4'), ('runid','i4')])
+        data = np.empty(len(gridpointids),dtype)
+        data['gridpointid'] = gridpointids
+        data['forecastid'] = forecastid
+        data['value'] = self.dfield1
+        data['runid'] = runid
+
+        self.d.setstorage('arrays')
+        try:
+            self.d.senddata(data,np.arange(len(gridpointids)))
+            self.d.senddata(self.d.encodedata(data,np.arange(len(gridpointids))))
+            rows = self.d.readarrays([forecastid],runid)
+            self.assertEqual(list(rows['value']),self.dfield1,'Incorrect array values')
+            rows = self.d.readarrays([forecastid],runid,[1,2])
+            self.assertEqual(list(rows['ord']),[1,2],'Values outside of the crop')
+            rows = self.d.gettimeseries(['field1'],runid,gridpointids[2:],[2,3])
+            self.assertEqual([row[4] for row in rows],self.dfield1[2:],'Incorrect timeseries values')
+
+            # a slice starting at the same cell but covering fewer is stored too, and the cells come back once
+            self.d.senddata(data[:2],np.arange(2))
+            conn = pg.connect(database=self.database)
+            curs = conn.cursor()
+            curs.execute('select count(*) from dataarrays where forecastid = %d' % forecastid)
+            self.assertEqual(curs.fetchone()[0],2,'Smaller slice dropped')
+            conn.close()
+            rows = self.d.readarrays([forecastid],runid)
+            self.assertEqual(list(rows['ord']),[0,1,2,3],'Overlapping cells read twice')
+            rows = self.d.gettimeseries(['field1'],runid,gridpointids,[0,1,2,3])
+            self.assertEqual(len(rows),4,'Overlapping cells read twice')
+        finally:
+            self.d.setstorage('rows')
+
+    def test_i_checkpoints(self):
+        start = self.datatime - datetime.timedelta(days=1)
+        end = self.datatime + datetime.timedelta(days=1)
+        self.assertEqual(self.d.getcheckpoints('scope',start,end),set(),'Checkpoints out of nowhere')
+        self.d.setcheckpoint(self.datatime,['field1','field2'],'scope')
+        self.d.setcheckpoint(self.datatime,['field1'],'scope')
+        self.assertEqual(self.d.getcheckpoints('scope',start,end),set([(self.datatime,'field1'),(self.datatime,'field2')]),'Checkpoints not recorded')
+        self.assertEqual(self.d.getcheckpoints('other',start,end),set(),'Checkpoints shared between scopes')
+        self.assertEqual(self.d.getcheckpoints('scope',end,end),set(),'Checkpoints outside of the range')
+
+    def test_i_completed(self):
+        runid = self.d.getrunid(self.datatime)
+        self.assertEqual(self.d.getcompleted(runid),set(),'Slices complete out of nowhere')
+        self.d.setcompleted(runid,[1,2],'scope')
+        self.d.setcompleted(runid,[2,3],'scope')
+        self.d.setcompleted(runid,[1],'other')
+        self.assertEqual(self.d.getcompleted(runid),set([(1,'scope'),(2,'scope'),(3,'scope'),(1,'other')]),'Slices not recorded')
+
+    def test_z_dropruns(self):
+        # every run in here is years old
+        self.assertTrue(self.d.dropruns(1) > 0,'No runs dropped')
+        conn = pg.connect(database=self.database)
+        curs = conn.cursor()
+        curs.execute('select count(*) from data')
+        self.assertEqual(curs.fetchone()[0],0,'Data left behind')
+        curs.execute("select count(*) from dataarrays")
+        self.assertEqual(curs.fetchone()[0],0,'Arrays left behind')
+        curs.execute("select count(*) from pg_tables where tablename ~ '^data(arrays)?_r[0-9]+$'")
+        self.assertEqual(curs.fetchone()[0],0,'Partition left behind')
+        curs.execute('select count(*) from checkpoints')
+        self.assertEqual(curs.fetchone()[0],0,'Checkpoints left behind')
+        curs.execute('select count(*) from completedslices')
+        self.assertEqual(curs.fetchone()[0],0,'Completed slices left behind')
+        curs.execute('select count(*) from runs')
+        self.assertEqual(curs.fetchone()[0],0,'Run left behind')
+        conn.close()
+
+
+
 
 
+class MigrateTest(unittest.TestCase):
+    def test_a_newer(self):
+        # a database migrated by a newer version of forecasting is left alone
+        class Unconnected(Database):
+            def __init__(self):
+                pass
+        self.assertRaises(Exception, Unconnected()._migrate, '0.9.0', '0.10.0')
 
 if __name__ == '__main__':
     unittest.main()
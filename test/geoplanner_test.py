@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+
+from forecasting.geoplanner import GeoPlanner
+
+class GeoPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.nlat = 50
+        self.nlon = 100
+        self.planner = GeoPlanner(self.nlat,self.nlon,0.5)
+
+    # Helper to list the cells covered by a set of geobounds
+    def covered(self,geobounds):
+        ords = []
+        for geobound in geobounds:
+            ords.extend(list(geobound[2]))
+        return sorted(ords)
+
+    def test_a_empty(self):
+        self.assertEqual(self.planner.plan([]),[])
+
+    def test_b_block(self):
+        cells = [(10,20),(10,21),(11,20),(11,21)]
+        geobounds = self.planner.plan(cells)
+        self.assertEqual(len(geobounds),1,'Neighboring cells not merged')
+        self.assertEqual(geobounds[0][:2],[[10,12,1],[20,22,1]])
+        self.assertEqual(self.covered(geobounds),sorted([i*self.nlon+j for i,j in cells]))
+
+    def test_c_apart(self):
+        cells = [(0,0),(40,90)]
+        geobounds = self.planner.plan(cells)
+        self.assertEqual(len(geobounds),2,'Distant cells merged')
+
+    def test_d_waste(self):
+        cells = [(5,5),(5,7)]
+        self.assertEqual(len(GeoPlanner(self.nlat,self.nlon,0.5).plan(cells)),1)
+        self.assertEqual(len(GeoPlanner(self.nlat,self.nlon,0.).plan(cells)),2)
+
+    def test_e_duplicates(self):
+        cells = [(3,3),(3,3),(3,4),(30,30),(31,30),(30,31)]
+        geobounds = self.planner.plan(cells)
+        self.assertEqual(self.covered(geobounds),sorted(set([i*self.nlon+j for i,j in cells])),'Cell requested twice or lost')
+        for geobound in geobounds:
+            for o in geobound[2]:
+                self.assertTrue(geobound[0][0] <= o // self.nlon < geobound[0][1])
+                self.assertTrue(geobound[1][0] <= o % self.nlon < geobound[1][1])
+
+    def test_f_scattered(self):
+        np.random.seed(1)
+        cells = zip(np.random.randint(0,self.nlat,300),np.random.randint(0,self.nlon,300))
+        geobounds = self.planner.plan(cells)
+        self.assertEqual(self.covered(geobounds),sorted(set([i*self.nlon+j for i,j in cells])))
+        self.assertTrue(len(geobounds) < len(set(cells)),'Nothing merged')
+
+
+if __name__ == '__main__':
+    unittest.main()
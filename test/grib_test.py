@@ -0,0 +1,278 @@
+import unittest
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+from datetime import datetime
+import BaseHTTPServer
+import SocketServer
+import numpy as np
+
+from forecasting import grib
+from forecasting import util
+
+def _sign(value, nbytes):
+    # GRIB2 keeps the sign in the highest bit
+    if value < 0:
+        return (1 << (8*nbytes - 1)) | -value
+    return value
+
+def message(values, lat, lon, decimals=2, nbits=16, fhour=0):
+    """
+    Encode values [lat, lon] on a lat/lon grid as a GRIB2 message with simple packing. The rows are written
+    north to south, as NOMADS does.
+    """
+
+    values = np.asarray(values, dtype='f8')[::-1]
+    nj, ni = values.shape
+    present = values < 1e10
+
+    sec1 = struct.pack('>IBHHBBBHBBBBBBB', 21, 1, 7, 0, 2, 1, 1, 2014, 2, 22, 18, 0, 0, 0, 1)
+    sec3 = struct.pack('>IBBIBBH', 72, 3, 0, ni*nj, 0, 0, 0)
+    sec3 += struct.pack('>BBIBIBIIIIIIIBIIIIB', 6, 0, 0, 0, 0, 0, 0, ni, nj, 0, 0xFFFFFFFF,
+                        _sign(int(round(lat[-1]*1e6)), 4), int(round(lon[0]*1e6)), 48,
+                        _sign(int(round(lat[0]*1e6)), 4), int(round(lon[-1]*1e6)),
+                        int(round((lon[1]-lon[0])*1e6)), int(round((lat[1]-lat[0])*1e6)), 0)
+    sec4 = struct.pack('>IBHH', 34, 4, 0, 0) + struct.pack('>BBBBBHBBIBBIBBI', 0, 0, 2, 0, 96, 0, 0, 1, fhour, 103, 0, 2, 255, 0, 0)
+
+    scaled = np.round(values[present]*10**decimals)
+    reference = float(np.min(scaled)) if len(scaled) > 0 else 0.
+    sec5 = struct.pack('>IBIH', 21, 5, len(scaled), 0) + struct.pack('>fHHBB', reference, 0, _sign(decimals, 2), nbits, 0)
+
+    if np.all(present):
+        sec6 = struct.pack('>IBB', 6, 6, 255)
+    else:
+        bitmap = np.packbits(present.ravel().astype('u1')).tostring()
+        sec6 = struct.pack('>IBB', 6 + len(bitmap), 6, 0) + bitmap
+
+    packed = (scaled - reference).astype('i8')
+    bits = ((packed[:,np.newaxis] >> np.arange(nbits - 1, -1, -1)) & 1).astype('u1')
+    data = np.packbits(bits.ravel()).tostring()
+    sec7 = struct.pack('>IB', 5 + len(data), 7) + data
+
+    body = sec1 + sec3 + sec4 + sec5 + sec6 + sec7 + '7777'
+    return 'GRIB' + struct.pack('>HBBQ', 0, 0, 2, 16 + len(body)) + body
+
+def grib2(fields, fhour=0, run=datetime(2014, 2, 22, 18)):
+    """
+    Encode a GRIB2 file of (variable, level, values, lat, lon) messages. Returns the file and its inventory.
+    """
+
+    data = ''
+    lines = []
+    for i, (variable, level, values, lat, lon) in enumerate(fields):
+        lines.append('%d:%d:d=%s:%s:%s:%s:' % (i + 1, len(data), run.strftime('%Y%m%d%H'), variable, level, '%d hour fcst' % fhour if fhour else 'anl'))
+        data += message(values, lat, lon, fhour=fhour)
+    return data, '\n'.join(lines) + '\n'
+
+def writegrib(path, fields, fhour=0, run=datetime(2014, 2, 22, 18)):
+    """
+    Write a GRIB2 file of (variable, level, values, lat, lon) messages, with its inventory
+    """
+
+    data, inventory = grib2(fields, fhour, run)
+    open(path, 'wb').write(data)
+    open(path + '.idx', 'w').write(inventory)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the files of the server, with Range requests like NOMADS (unless the server ignores them)
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        byterange = self.headers.getheader('range')
+        self.server.requests.append((self.path, byterange))
+        if self.path not in self.server.files:
+            body = 'not found'
+            self.send_response(404)
+        elif byterange != None and self.server.ranges:
+            start, end = re.match('bytes=(\d+)-(\d*)', byterange).groups()
+            data = self.server.files[self.path]
+            end = int(end) + 1 if end else len(data)
+            body = data[int(start):end]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%d/%d' % (start, end - 1, len(data)))
+        else:
+            body = self.server.files[self.path]
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(files):
+    """
+    Start a server of files (by path) from a background thread
+    """
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.files = files
+    server.requests = []
+    server.ranges = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    return server
+
+INVENTORY = """1:0:d=2014022218:PRMSL:mean sea level:anl:
+2:1000:d=2014022218:TMP:500 mb:anl:
+3:1800:d=2014022218:TMP:1000 mb:anl:
+4.1:2500:d=2014022218:UGRD:10 m above ground:anl:
+4.2:2500:d=2014022218:VGRD:10 m above ground:anl:
+5:4000:d=2014022218:TMP:2 m above ground:anl:
+6:4600:d=2014022218:TMP:2 m above ground:anl:
+"""
+
+class GribTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lat = np.array([10., 11., 12.])
+        self.lon = np.array([0., 90., 180., 270.])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_inventory(self):
+        messages = grib.parseinventory(INVENTORY, 5000)
+        self.assertEqual([(m['start'], m['end']) for m in messages[:3]], [(0, 1000), (1000, 1800), (1800, 2500)])
+        self.assertEqual((messages[3]['end'], messages[4]['end']), (4000, 4000), 'Submessages split')
+        self.assertEqual(messages[-1]['end'], 5000)
+        self.assertEqual(grib.parseinventory(INVENTORY)[-1]['end'], None)
+        self.assertEqual(messages[0]['datatime'], datetime(2014, 2, 22, 18))
+
+    def test_b_select(self):
+        messages = grib.parseinventory(INVENTORY, 5000)
+        self.assertEqual([(lev, m['start']) for lev, m in grib.select(messages, 'TMP', 'mb')], [(1000., 1800), (500., 1000)])
+        self.assertEqual([(lev, m['start']) for lev, m in grib.select(messages, 'TMP', '2 m above ground')], [(None, 4000)])
+        self.assertEqual(grib.select(messages, 'RH', 'mb'), [])
+
+    def test_c_decode(self):
+        if grib.pygrib != None:
+            return
+        values = np.array([[280.25, 281.5, 282., 283.], [284., 285., 286., 287.], [288., 289., 290.75, -1.5]])
+        decoded, lat, lon = grib.decode(message(values, self.lat, self.lon))
+        self.assertEqual(list(lat), [10., 11., 12.], 'Latitudes not south to north')
+        self.assertEqual(list(lon), [0., 90., 180., 270.])
+        self.assertTrue(np.allclose(decoded, values, atol=1e-3))
+
+    def test_d_bitmap(self):
+        if grib.pygrib != None:
+            return
+        values = np.ones((3, 4))
+        values[1,2] = grib.MISSING
+        decoded, lat, lon = grib.decode(message(values, self.lat, self.lon))
+        self.assertEqual(decoded[1,2], np.float32(grib.MISSING))
+        self.assertEqual(np.count_nonzero(decoded == 1.), 11)
+
+    def test_e_dataset(self):
+        files = []
+        for fhour in [0, 3]:
+            path = os.path.join(self.directory, 'gfs.t18z.f%03d' % fhour)
+            writegrib(path, [('TMP', '2 m above ground', np.ones((3, 4))*(280 + fhour), self.lat, self.lon),
+                             ('TMP', '500 mb', np.ones((3, 4))*250, self.lat, self.lon),
+                             ('TMP', '850 mb', np.arange(12.).reshape((3, 4)), self.lat, self.lon)], fhour=fhour)
+            files.append((fhour, grib.LocalFile(path)))
+        ds = grib.Dataset(files)
+
+        self.assertEqual(ds['tmp2m'].dimensions, ('time', 'lat', 'lon'))
+        self.assertEqual(ds['tmp2m'].shape, (2, 3, 4))
+        self.assertEqual(list(ds['tmp2m'].time), [735287.75, 735287.875])
+        self.assertEqual(list(ds['tmpprs'].lev), [850., 500.])
+        self.assertEqual(list(ds['tmpprs'].lat[:]), [10., 11., 12.])
+
+        self.assertTrue(np.allclose(ds['tmp2m'].array[:,0:2,1:3], [[[280]*2]*2, [[283]*2]*2]))
+        self.assertEqual(ds['tmpprs'].array[1,:,1:3,0:4:2].shape, (2, 2, 2))
+        self.assertTrue(np.allclose(ds['tmpprs'].array[1,0,1:3,0:4:2], [[4., 6.], [8., 10.]]))
+        self.assertRaises(Exception, lambda: ds['hgtprs'])
+
+        # local files are read from their memory maps, not kept
+        self.assertTrue(isinstance(files[0][1].fetch(0, 4), buffer))
+        self.assertEqual(len(ds.data), 0)
+
+    def test_f_mergeranges(self):
+        self.assertEqual(grib.mergeranges([(400, None), (100, 250), (0, 100)]), [(0, 250), (400, None)])
+        self.assertEqual(grib.mergeranges([(0, 100), (150, 200)]), [(0, 100), (150, 200)])
+        self.assertEqual(grib.mergeranges([(0, 100), (150, 200)], gap=50), [(0, 200)])
+        self.assertEqual(grib.mergeranges([(0, 100), (50, 80), (90, None), (300, 400)]), [(0, None)])
+
+    def test_g_remote(self):
+        files = {}
+        for fhour in [0, 3]:
+            data, inventory = grib2([('UGRD', '10 m above ground', np.ones((3, 4))*fhour, self.lat, self.lon),
+                                     ('TMP', '2 m above ground', np.ones((3, 4))*(280 + fhour), self.lat, self.lon),
+                                     ('VGRD', '10 m above ground', np.ones((3, 4))*(2 + fhour), self.lat, self.lon)], fhour=fhour)
+            files['/gfs.f%03d' % fhour] = data
+            files['/gfs.f%03d.idx' % fhour] = inventory
+        server = serve(files)
+        try:
+            remote = [(fhour, grib.RemoteFile(server.url + '/gfs.f%03d' % fhour)) for fhour in [0, 3]]
+            remote[0][1].gap = 0
+            remote[1][1].gap = 0
+            ds = grib.Dataset(remote, connections=4)
+            self.assertTrue(np.allclose(ds['tmp2m'].array[:,1,1], [280., 283.]))
+
+            # the messages of a file that are next to each other come in one request, the others apart
+            del server.requests[:]
+            ds.read([(remote[0][1], [m for lev, m in grib.select(remote[0][1].messages, 'UGRD', '10 m above ground')] +
+                                    [m for lev, m in grib.select(remote[0][1].messages, 'TMP', '2 m above ground')]),
+                     (remote[1][1], [m for lev, m in grib.select(remote[1][1].messages, 'UGRD', '10 m above ground')] +
+                                    [m for lev, m in grib.select(remote[1][1].messages, 'VGRD', '10 m above ground')])])
+            self.assertEqual(len(server.requests), 3)
+            self.assertTrue(('/gfs.f003', 'bytes=%d-' % remote[1][1].messages[2]['start']) in server.requests, 'Last message not open ended')
+
+            # a server that ignores the ranges sends the whole file
+            server.ranges = False
+            values = ds['vgrd10m'].array[1,0:2,0:2]
+            self.assertTrue(np.allclose(values, 5.))
+
+            # the messages are read once, however many geobounds are sliced out of them
+            server.ranges = True
+            ds = grib.Dataset([(fhour, grib.RemoteFile(server.url + '/gfs.f%03d' % fhour)) for fhour in [0, 3]], connections=4)
+            del server.requests[:]
+            self.assertTrue(np.allclose(ds['tmp2m'].array[:,0:2,0:2], 280. + np.array([0., 3.])[:,np.newaxis,np.newaxis]))
+            requests = len(server.requests)
+            self.assertEqual(len([r for r in server.requests if r[1] != None]), 2)
+            self.assertTrue(np.allclose(ds['tmp2m'].array[:,1:3,2:4], 280. + np.array([0., 3.])[:,np.newaxis,np.newaxis]))
+            self.assertEqual(len(server.requests), requests, 'Messages downloaded again for another geobound')
+            self.assertEqual(ds.databytes, sum([len(data) for data in ds.data.values()]))
+
+            # beyond the limit, the least recently used messages are dropped
+            ds = grib.Dataset([(fhour, grib.RemoteFile(server.url + '/gfs.f%03d' % fhour)) for fhour in [0, 3]], maxcache=1)
+            ds['tmp2m'].array[:,0:2,0:2]
+            self.assertTrue(len(ds.data) <= 1)
+            requests = len(server.requests)
+            ds['tmp2m'].array[:,1:3,2:4]
+            self.assertTrue(len(server.requests) > requests, 'Messages kept beyond the limit')
+        finally:
+            util.configure()
+            server.shutdown()
+
+    def test_h_levels(self):
+        path = os.path.join(self.directory, 'gfs.t18z.f000')
+        writegrib(path, [('TMP', '1000 mb', np.ones((3, 4))*1000., self.lat, self.lon),
+                         ('TMP', '850 mb', np.ones((3, 4))*850., self.lat, self.lon),
+                         ('TMP', '500 mb', np.ones((3, 4))*500., self.lat, self.lon),
+                         ('VVEL', '850 mb', np.ones((3, 4))*.85, self.lat, self.lon),
+                         ('VVEL', '500 mb', np.ones((3, 4))*.5, self.lat, self.lon)])
+        ds = grib.Dataset([(0, grib.LocalFile(path))])
+
+        # both fields have every level, the ones a field lacks are missing
+        self.assertEqual(list(ds['vvelprs'].lev), [1000., 850., 500.])
+        self.assertEqual(ds['vvelprs'].shape, ds['tmpprs'].shape)
+        values = ds['vvelprs'].array[0:1,0:3,0,0]
+        self.assertEqual(values.shape, (1, 3))
+        self.assertEqual(values[0,0], np.float32(grib.MISSING))
+        self.assertTrue(np.allclose(values[0,1:], [.85, .5]))
+        self.assertTrue(np.allclose(ds['tmpprs'].array[0,1:3,0,0], [850., 500.]))
+
+if __name__ == '__main__':
+    unittest.main()
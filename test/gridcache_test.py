@@ -0,0 +1,42 @@
+import unittest
+import shutil
+import tempfile
+import numpy as np
+
+from forecasting.gridcache import GridCache
+
+class GridCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = GridCache('nam', self.directory)
+        self.lat = np.array([1.,2.,3.])
+        self.lon = np.array([10.,11.])
+        self.lev = np.array([1000.,850.])
+        self.gridpointids = np.arange(1,7)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_empty(self):
+        self.assertEqual(self.cache.load('abc'),None,'Empty cache returned a grid')
+
+    def test_b_roundtrip(self):
+        self.cache.save('abc',self.lat,self.lon,self.lev,self.gridpointids)
+        grid = self.cache.load('abc')
+        self.assertEqual((grid['nlat'],grid['nlon'],grid['nlev']),(3,2,2))
+        self.assertTrue(np.all(grid['lat'] == self.lat))
+        self.assertTrue(np.all(grid['gridpointids'] == self.gridpointids))
+        self.assertTrue(isinstance(grid['gridpointids'],np.memmap),'Grid not memory-mapped')
+
+    def test_c_fingerprint(self):
+        self.cache.save('abc',self.lat,self.lon,self.lev,self.gridpointids)
+        self.assertEqual(self.cache.load('def'),None,'Stale cache returned a grid')
+
+    def test_d_clear(self):
+        self.cache.save('abc',self.lat,self.lon,self.lev,self.gridpointids)
+        self.cache.clear()
+        self.assertEqual(self.cache.load('abc'),None,'Cleared cache returned a grid')
+
+
+if __name__ == '__main__':
+    unittest.main()
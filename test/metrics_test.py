@@ -0,0 +1,64 @@
+import unittest
+import os
+import shutil
+import tempfile
+import urllib2
+
+from forecasting import metrics
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_a_counter(self):
+        c = metrics.counter('test_bytes_total', 'Bytes')
+        c.inc(10, host='a')
+        c.inc(5, host='a')
+        c.inc(host='b')
+        self.assertEqual((c.get(host='a'), c.get(host='b'), c.get(host='c')), (15, 1, 0))
+        self.assertTrue(metrics.counter('test_bytes_total') is c, 'Counter not shared')
+        self.assertRaises(Exception, metrics.histogram, 'test_bytes_total')
+
+        text = metrics.exposition()
+        self.assertTrue('# TYPE test_bytes_total counter\n' in text)
+        self.assertTrue('test_bytes_total{host="a"} 15.0\n' in text)
+
+    def test_b_histogram(self):
+        h = metrics.histogram('test_seconds', 'Seconds', buckets=[1, 10])
+        for value in [0.5, 2, 20]:
+            h.observe(value, stage='copy')
+        with h.time(stage='fetch'):
+            pass
+        self.assertEqual(h.get(stage='copy'), (3, 22.5))
+
+        lines = metrics.exposition().split('\n')
+        self.assertTrue('test_seconds_bucket{stage="copy",le="1.0"} 1' in lines)
+        self.assertTrue('test_seconds_bucket{stage="copy",le="10.0"} 2' in lines, 'Buckets not cumulative')
+        self.assertTrue('test_seconds_bucket{stage="copy",le="+Inf"} 3' in lines)
+        self.assertTrue('test_seconds_count{stage="fetch"} 1' in lines)
+
+    def test_c_serve(self):
+        metrics.counter('test_polls_total', 'Polls').inc(model='nam')
+        server = metrics.serve(0)
+        try:
+            body = urllib2.urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1]).read()
+        finally:
+            server.shutdown()
+        self.assertTrue('test_polls_total{model="nam"} 1.0' in body)
+
+    def test_d_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            metrics.counter('test_polls_total', 'Polls').inc()
+            path = os.path.join(directory, 'forecasting.prom')
+            metrics.write(path)
+            self.assertTrue('test_polls_total 1.0' in open(path).read())
+            self.assertEqual(os.listdir(directory), ['forecasting.prom'], 'Temporary file left behind')
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
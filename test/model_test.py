@@ -0,0 +1,268 @@
+import unittest
+import datetime
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from forecasting.model import Model
+from forecasting.sources import FileSource
+from netcdf_test import writenetcdf
+
+class FakeDatabase:
+    """
+    Stands in for the database: a 3x4 grid (gridpointid = ord + 100) where each value is its own gridpointid
+    """
+    run = datetime.datetime(2014, 2, 22, 18)
+
+    def getrun(self, datatime=None):
+        return 7, self.run
+
+    def gettimeseries(self, fieldnames, runid, gridpointids, ords=None):
+        rows = []
+        for hour in [0, 1]:
+            datatimeforecast = self.run + datetime.timedelta(hours=hour)
+            for gridpointid in gridpointids:
+                rows.append(('tmp2m', None, datatimeforecast, gridpointid, float(gridpointid + hour)))
+                for lev in [850., 1000.]:
+                    rows.append(('tmpprs', lev, datatimeforecast, gridpointid, float(gridpointid + lev)))
+        return rows
+
+    def getforecasts(self, fieldname, runid):
+        return [(1, None, self.run), (2, None, self.run + datetime.timedelta(hours=6))]
+
+    def readdata(self, forecastids, runid, gridpointids=None):
+        if gridpointids is None:
+            gridpointids = np.arange(12) + 100
+        rows = np.empty(len(gridpointids)*len(forecastids), [('idx','i4'), ('gridpointid','i4'), ('value','f4')])
+        rows['idx'] = np.repeat(np.arange(len(forecastids)) + 1, len(gridpointids))
+        rows['gridpointid'] = np.tile(gridpointids, len(forecastids))
+        rows['value'] = rows['gridpointid'] + 1000*rows['idx']
+        # a value missing from the database
+        return rows[1:]
+
+class FakeField:
+    """
+    Stands in for a pydap grid of shape [time, lat, lon]
+    """
+    dimensions = ('time', 'lat', 'lon')
+
+    def __init__(self, values):
+        self.array = values
+        self.shape = values.shape
+        # 2014-02-22 18:00 and 19:00, in days since 0001-01-01 (plus one), as the server sends them
+        self.time = np.array([735287.75, 735287.75 + 1./24])
+
+class FakeTransferDatabase:
+    """
+    Collects what a transfer sends to the database
+    """
+    storage = 'rows'
+
+    def __init__(self):
+        self.fieldids = {}
+        self.sent = []
+        self.ords = []
+        self.completed = []
+
+    def getrunid(self, datatime):
+        return 7
+
+    def getfieldid(self, field):
+        return self.fieldids.setdefault(field, len(self.fieldids) + 1)
+
+    def getforecastids(self, forecasts):
+        return np.array([fieldid*100 + i for i, (fieldid, datatime, datatimeforecast, lev) in enumerate(forecasts)])
+
+    def encodedata(self, data, ords=None):
+        self.ords.append(ords)
+        return data
+
+    def senddata(self, data):
+        self.sent.append(data)
+
+    def setcompleted(self, runid, forecastids, scope):
+        self.completed.extend([(forecastid, scope) for forecastid in forecastids])
+
+class ModelTest(unittest.TestCase):
+    def setUp(self):
+        self.m = Model('nam')
+        self.m.database = FakeDatabase()
+        self.m.lat = np.array([10., 11., 12.])
+        self.m.lon = np.array([0., 90., 180., 270.])
+        self.m.nlat = 3
+        self.m.nlon = 4
+        self.m.gridpointids = np.arange(12) + 100
+
+    def test_a_nearest(self):
+        ts = self.m.timeseries(10.9, 89., ['tmp2m'])
+        self.assertEqual(list(ts['tmp2m']['values']), [105., 106.])
+        self.assertEqual(ts['tmp2m']['times'][1], np.datetime64('2014-02-22T19:00:00'))
+        self.assertEqual(ts['tmp2m']['pressure'], None)
+
+    def test_b_bilinear(self):
+        ts = self.m.timeseries(10.5, 45., ['tmp2m'], method='bilinear')
+        # halfway between ords 0, 1, 4 and 5
+        self.assertAlmostEqual(ts['tmp2m']['values'][0], 102.5)
+
+    def test_c_batch(self):
+        ts = self.m.timeseries([10., 12.], [0., 270.], ['tmp2m', 'tmpprs'])
+        self.assertEqual(ts['tmp2m']['values'].shape, (2, 2))
+        self.assertEqual(list(ts['tmp2m']['values'][:,0]), [100., 111.])
+        self.assertEqual(list(ts['tmpprs']['pressure']), [850., 1000.])
+        self.assertEqual(ts['tmpprs']['values'].shape, (2, 2, 2))
+        self.assertEqual(ts['tmpprs']['values'][1,0,1], 1111.)
+
+    def test_d_wrap(self):
+        # the grid is global, so the last column connects back to the first
+        ts = self.m.timeseries(10., -45., ['tmp2m'], method='bilinear')
+        self.assertAlmostEqual(ts['tmp2m']['values'][0], 101.5)
+
+    def test_e_outside(self):
+        self.assertRaises(Exception, self.m.timeseries, 20., 0., ['tmp2m'])
+
+    def test_f_readfield(self):
+        f = self.m.readfield('tmp2m')
+        self.assertEqual(f['values'].shape, (2, 3, 4))
+        self.assertTrue(np.isnan(f['values'][0,0,0]), 'Missing value not nan')
+        self.assertEqual(f['values'][1,2,3], 2111.)
+
+    def test_g_readfieldcrop(self):
+        f = self.m.readfield('tmp2m', hours=6, bounds={'n': 12., 's': 11., 'e': 180., 'w': 90.})
+        self.assertEqual(f['values'].shape, (1, 2, 2))
+        self.assertEqual(list(f['lon']), [90., 180.])
+        self.assertEqual(f['values'][0,1,1], 1110.)
+
+    def test_h_inlinecalculation(self):
+        u = np.ones((2, 3, 4))*3.
+        v = np.ones((2, 3, 4))*4.
+        v[1,2,3] = 9.999e20
+        self.m.modelconn = {'ugrd10m': FakeField(u), 'vgrd10m': FakeField(v)}
+        self.m.calcfields = [{'wnd10m': {'dependents': ['ugrd10m','vgrd10m'], 'calculation': 'sqrt(ugrd10m^2+vgrd10m^2)'}}]
+
+        calcs, later = self.m._plancalculations(['ugrd10m','vgrd10m','tmp2m'])
+        self.assertEqual(([c.name for c in calcs], later), (['wnd10m'], []))
+        groups = self.m._groupfields(['ugrd10m','tmp2m','vgrd10m'], calcs)
+        self.assertEqual([group for group, groupcalcs in groups], [['ugrd10m','vgrd10m'], ['tmp2m']])
+
+        database = FakeTransferDatabase()
+        self.m._processfield(['ugrd10m','vgrd10m'], FakeDatabase.run, [[0,3,1],[0,4,1]], [0,1,1], database=database, calcs=calcs)
+        data = np.concatenate(database.sent)
+        wnd = data[data['forecastid'] // 100 == database.fieldids['wnd10m']]
+        self.assertEqual(len(wnd), 2*12 - 1, 'Calculated from a missing value')
+        self.assertTrue(np.all(wnd['value'] == 5.))
+        self.assertTrue(np.all(data['runid'] == 7))
+
+    def test_i_databasecalculation(self):
+        self.m.calcfields = [{'wnd10m': {'dependents': ['ugrd10m','vgrd10m'], 'calculation': 'sqrt(ugrd10m^2+vgrd10m^2)'}}]
+        calcs, later = self.m._plancalculations(['ugrd10m'])
+        self.assertEqual((calcs, [c.name for c in later]), ([], ['wnd10m']))
+
+    def test_j_arraystorage(self):
+        u = np.ones((2, 3, 4))
+        u[0,1,0] = 9.999e20
+        self.m.modelconn = {'ugrd10m': FakeField(u)}
+        database = FakeTransferDatabase()
+        database.storage = 'arrays'
+        self.m._processfield('ugrd10m', FakeDatabase.run, [[1,3,1],[0,4,1]], [0,1,1], database=database)
+        # bad values are kept for the array storage, every cell of the box comes with its ord
+        self.assertEqual([len(data) for data in database.sent], [8, 8])
+        self.assertEqual(list(database.ords[0]), range(4, 12))
+
+    def test_k_slabcache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.m.setslabcache(directory)
+            self.m.url = 'http://localhost/dods/nam/nam20140222/nam_18z'
+            self.m.modelconn = {'tmp2m': FakeField(np.ones((2, 3, 4)))}
+            self.m._processfield('tmp2m', FakeDatabase.run, [[0,3,1],[0,4,1]], [0,1,1], database=FakeTransferDatabase())
+
+            # the second time around, nothing comes from the server
+            self.m.modelconn = {'tmp2m': FakeField(np.zeros((2, 3, 4)))}
+            database = FakeTransferDatabase()
+            self.m._processfield('tmp2m', FakeDatabase.run, [[0,3,1],[0,4,1]], [0,1,1], database=database)
+            self.assertTrue(np.all(np.concatenate(database.sent)['value'] == 1.), 'Slabs fetched again')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_l_server(self):
+        self.m.setserver('http://localhost:8001/dods/')
+        self.assertEqual(self.m._createurl(datetime.datetime(2014, 2, 22, 6)), 'http://localhost:8001/dods/nam/nam20140222/nam_06z')
+        self.assertEqual(self.m.runs.timeurl, 'http://localhost:8001/dods/nam')
+
+    def test_m_filesource(self):
+        directory = tempfile.mkdtemp()
+        try:
+            writenetcdf(os.path.join(directory, 'nam20140222_18z.nc'), [('time', 2), ('lat', 3), ('lon', 4)], [
+                ('time', ('time',), np.array([0., 1.]), {'units': 'hours since 2014-02-22 18:00:00'}),
+                ('tmp2m', ('time', 'lat', 'lon'), np.arange(24, dtype='f4').reshape((2, 3, 4)), {}),
+            ])
+            self.m.setsource(FileSource('nam', os.path.join(directory, 'nam{date}_{hour}z.nc')))
+            self.assertEqual(self.m.latestruns(1), [FakeDatabase.run])
+
+            self.m.url = self.m._createurl(FakeDatabase.run)
+            self.assertTrue(self.m._checkurl(self.m.url))
+            self.m.modelconn = self.m.source.open(self.m.url)
+            database = FakeTransferDatabase()
+            self.m._processfield('tmp2m', FakeDatabase.run, [[1,3,1],[0,4,2]], [0,1,1], database=database)
+            self.assertEqual([list(data['value']) for data in database.sent], [[4., 6., 8., 10.], [16., 18., 20., 22.]])
+            self.assertEqual(list(database.sent[1]['gridpointid']), [104, 106, 108, 110])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_n_incremental(self):
+        self.m.modelconn = {'ugrd10m': FakeField(np.ones((2, 3, 4))*3.), 'vgrd10m': FakeField(np.ones((2, 3, 4))*4.)}
+        self.m.calcfields = [{'wnd10m': {'dependents': ['ugrd10m','vgrd10m'], 'calculation': 'sqrt(ugrd10m^2+vgrd10m^2)'}}]
+        calcs, later = self.m._plancalculations(['ugrd10m','vgrd10m'])
+        geobound = [[0,3,1],[0,4,1]]
+        scope = self.m._geoscope(geobound)
+
+        # the first timestep is in for every field, the second only for the calculated one
+        database = FakeTransferDatabase()
+        self.m._processfield(['ugrd10m','vgrd10m'], FakeDatabase.run, geobound, [0,1,1], database=database, calcs=calcs, completed=set())
+        completed = set([(forecastid, scope) for forecastid in [100, 202, 304, 305]])
+        self.assertEqual(set(database.completed), set([(forecastid, scope) for forecastid in [100, 101, 202, 203, 304, 305]]))
+
+        database = FakeTransferDatabase()
+        self.m._processfield(['ugrd10m','vgrd10m'], FakeDatabase.run, geobound, [0,1,1], database=database, calcs=calcs, completed=completed)
+        data = np.concatenate(database.sent)
+        self.assertEqual(sorted(set(data['forecastid'])), [101, 203, 305], 'Complete timestep sent again')
+
+        # another geobound starts over
+        database = FakeTransferDatabase()
+        self.m._processfield(['ugrd10m','vgrd10m'], FakeDatabase.run, [[1,3,1],[0,4,1]], [0,1,1], database=database, calcs=calcs, completed=completed)
+        self.assertEqual(len(database.sent), 2)
+
+        # nothing left to do
+        database = FakeTransferDatabase()
+        completed = set([(forecastid, scope) for forecastid in [100, 101, 202, 203, 304, 305]])
+        self.m._processfield(['ugrd10m','vgrd10m'], FakeDatabase.run, geobound, [0,1,1], database=database, calcs=calcs, completed=completed)
+        self.assertEqual(database.sent, [])
+
+    def test_o_missingchunks(self):
+        done = np.zeros((6, 3), dtype=bool)
+        done[0:2,:] = True
+        done[3,:] = True
+        done[4:6,0] = True
+        self.assertEqual(self.m._missingchunks([[0,6,0,3]], done), [[2,3,0,3], [4,6,1,3]])
+        self.assertEqual(self.m._missingchunks([[0,2,0,3], [2,4,0,3]], done), [[2,3,0,3]])
+        self.assertEqual(self.m._missingchunks([[0,6,0,3]], np.zeros((6, 3), dtype=bool)), [[0,6,0,3]])
+
+    def test_p_gridcache(self):
+        # the grid cache tells the sources apart
+        self.m.database.gridfingerprint = lambda: 'abc'
+        fingerprint = self.m._gridfingerprint()
+        self.m.setserver('http://localhost:8001/dods/')
+        self.assertNotEqual(self.m._gridfingerprint(), fingerprint, 'Grid cached across sources')
+
+        # and a cached grid is checked against the levels of the run
+        self.m.lev = np.array([1000., 850., 500.])
+        tmpprs = FakeField(np.ones((2, 3, 3, 4)))
+        tmpprs.lev = np.array([1000., 850., 500.])
+        self.assertTrue(self.m._gridmatches({'tmpprs': tmpprs}))
+        tmpprs.lev = np.array([1000., 925., 850., 700., 500.])
+        tmpprs.shape = (2, 5, 3, 4)
+        self.assertFalse(self.m._gridmatches({'tmpprs': tmpprs}), 'Stale levels used')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+
+from forecasting import netcdf
+
+TYPES = {'>i1': 1, 'S1': 2, '>i2': 3, '>i4': 4, '>f4': 5, '>f8': 6}
+
+def _pad(raw):
+    return raw + '\x00'*((4 - len(raw) % 4) % 4)
+
+def _name(name):
+    return struct.pack('>i', len(name)) + _pad(name)
+
+def _attributes(attributes):
+    if len(attributes) == 0:
+        return struct.pack('>ii', 0, 0)
+    out = struct.pack('>ii', netcdf.NC_ATTRIBUTE, len(attributes))
+    for name, value in sorted(attributes.items()):
+        if isinstance(value, str):
+            out += _name(name) + struct.pack('>ii', 2, len(value)) + _pad(value)
+        else:
+            values = np.atleast_1d(np.asarray(value, dtype='>f8'))
+            out += _name(name) + struct.pack('>ii', 6, len(values)) + _pad(values.tostring())
+    return out
+
+def writenetcdf(path, dimensions, variables, numrecs=0):
+    """
+    Write a classic (CDF-1) NetCDF file. dimensions is a list of (name, length), with a length of 0 for the
+    record dimension, and variables a list of (name, dimension names, values, attributes).
+    """
+
+    variables = [(name, dims, np.asarray(values).astype(np.asarray(values).dtype.newbyteorder('>')), attributes) for name, dims, values, attributes in variables]
+    dimids = dict([(name, i) for i, (name, length) in enumerate(dimensions)])
+    records = [v[0] for v in variables if len(v[1]) > 0 and dict(dimensions)[v[1][0]] == 0]
+
+    def header(begins):
+        out = 'CDF\x01' + struct.pack('>i', numrecs)
+        out += struct.pack('>ii', netcdf.NC_DIMENSION, len(dimensions))
+        for name, length in dimensions:
+            out += _name(name) + struct.pack('>i', length)
+        out += struct.pack('>ii', 0, 0)
+        out += struct.pack('>ii', netcdf.NC_VARIABLE, len(variables))
+        for (name, dims, values, attributes), begin in zip(variables, begins):
+            values = np.asarray(values)
+            size = values[0].nbytes if name in records else values.nbytes
+            out += _name(name) + struct.pack('>i', len(dims)) + ''.join([struct.pack('>i', dimids[d]) for d in dims])
+            out += _attributes(attributes) + struct.pack('>iii', TYPES[values.dtype.str], (size + 3)//4*4, begin)
+        return out
+
+    offset = len(header([0]*len(variables)))
+    begins = []
+    fixed = ''
+    for name, dims, values, attributes in variables:
+        if name in records:
+            begins.append(None)
+            continue
+        begins.append(offset + len(fixed))
+        fixed += _pad(np.asarray(values).tostring())
+    start = offset + len(fixed)
+    for i, v in enumerate(variables):
+        if begins[i] == None:
+            begins[i] = start
+            start += (np.asarray(v[2])[0].nbytes + 3)//4*4
+
+    data = ''
+    for r in range(numrecs):
+        for name, dims, values, attributes in variables:
+            if name in records:
+                data += _pad(values[r:r+1].tostring())
+    open(path, 'wb').write(header(begins) + fixed + data)
+
+class NetcdfTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'nam.nc')
+        self.tmp = np.arange(2*3*4, dtype='>f4').reshape((2, 3, 4))
+        self.ugrd = -np.arange(2*3*4, dtype='>f4').reshape((2, 3, 4))
+        writenetcdf(self.path, [('time', 0), ('lat', 3), ('lon', 4)], [
+            ('lat', ('lat',), np.array([10., 11., 12.], dtype='>f8'), {'units': 'degrees_north'}),
+            ('lon', ('lon',), np.array([0., 90., 180., 270.], dtype='>f8'), {}),
+            ('time', ('time',), np.array([0., 1.], dtype='>f8'), {'units': 'hours since 2014-02-22 18:00:00'}),
+            ('tmp2m', ('time', 'lat', 'lon'), self.tmp, {'_FillValue': 9.999e20}),
+            ('ugrd10m', ('time', 'lat', 'lon'), self.ugrd, {}),
+        ], numrecs=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_header(self):
+        ds = netcdf.Dataset(self.path)
+        self.assertEqual(sorted(ds.variables), ['lat', 'lon', 'time', 'tmp2m', 'ugrd10m'])
+        self.assertEqual(ds.variables['tmp2m'].dimensions, ('time', 'lat', 'lon'))
+        self.assertEqual(ds.variables['tmp2m'].shape, (2, 3, 4))
+        self.assertEqual(ds.variables['lat'].getncattr('units'), 'degrees_north')
+        self.assertEqual(ds.variables['tmp2m'].getncattr('_FillValue'), 9.999e20)
+
+    def test_b_fixed(self):
+        ds = netcdf.Dataset(self.path)
+        self.assertEqual(list(ds.variables['lon'][1:3]), [90., 180.])
+        self.assertEqual(ds.variables['lat'][:].dtype, np.dtype('f8'), 'Not in native byte order')
+
+    def test_c_records(self):
+        # the two record variables are interleaved in the file
+        ds = netcdf.Dataset(self.path)
+        self.assertEqual(list(ds.variables['time'][:]), [0., 1.])
+        self.assertTrue(np.all(ds.variables['tmp2m'][:] == self.tmp))
+        self.assertTrue(np.all(ds.variables['ugrd10m'][1,1:3,::2] == self.ugrd[1,1:3,::2]))
+
+    def test_d_notnetcdf(self):
+        open(self.path, 'wb').write('\x89HDF\r\n\x1a\n' + '\x00'*100)
+        self.assertRaises(Exception, netcdf.Dataset, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
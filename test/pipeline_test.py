@@ -0,0 +1,36 @@
+import unittest
+
+from forecasting.pipeline import Pipeline
+
+class PipelineTest(unittest.TestCase):
+    def test_a_order(self):
+        results = []
+        p = Pipeline([('fetch',iter(range(20))),('encode',lambda x: x*2),('copy',results.append)],2)
+        p.run()
+        self.assertEqual(results,[x*2 for x in range(20)],'Items lost or reordered')
+
+    def test_b_report(self):
+        p = Pipeline([('fetch',iter(range(5))),('copy',lambda x: x)])
+        p.run()
+        report = p.report()
+        self.assertEqual([r['name'] for r in report],['fetch','copy'])
+        self.assertEqual([r['items'] for r in report],[5,5])
+
+    def test_c_error(self):
+        def encode(x):
+            if x == 3:
+                raise ValueError('bad item')
+            return x
+        p = Pipeline([('fetch',iter(range(100))),('encode',encode),('copy',lambda x: x)],1)
+        self.assertRaises(ValueError,p.run)
+
+    def test_d_fetcherror(self):
+        def fetch():
+            yield 1
+            raise IOError('server went away')
+        p = Pipeline([('fetch',fetch()),('copy',lambda x: x)])
+        self.assertRaises(IOError,p.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import threading
+from datetime import datetime
+import BaseHTTPServer
+import SocketServer
+
+from forecasting import util
+from forecasting.runs import RunDiscovery
+
+LISTINGS = {
+    '/dods/nam': '<a href="http://localhost/dods/nam/nam20140221">nam20140221</a> <a href="http://localhost/dods/nam/nam20140222">nam20140222</a>',
+    '/dods/nam/nam20140221': '<b>nam_00z:</b> <b>nam_06z:</b> <b>nam_12z:</b> <b>nam_18z:</b> <b>nam1hr_18z:</b>',
+    '/dods/nam/nam20140222': '<b>nam_00z:</b> <b>nam1hr_06z:</b> <b>nam_06z_ak:</b>',
+}
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path in LISTINGS:
+            body = LISTINGS[self.path]
+            self.send_response(200)
+        else:
+            body = 'not found'
+            self.send_response(404)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class RunDiscoveryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.server = Server(('127.0.0.1',0),Handler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/dods/nam' % self.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(self):
+        util.configure()
+        self.server.shutdown()
+
+    def test_a_days(self):
+        r = RunDiscovery('nam',self.url)
+        self.assertEqual(r.days(),[20140221,20140222])
+
+    def test_b_runs(self):
+        r = RunDiscovery('nam',self.url)
+        self.assertEqual(r.runs(20140221),[0,6,12,18],'Other datasets parsed as runs')
+        self.assertEqual(r.runs(20140222),[0])
+        self.assertEqual(r.runs(20140101),[],'Missing day has runs')
+
+    def test_c_latest(self):
+        r = RunDiscovery('nam',self.url)
+        self.assertEqual(r.latestruns(1),[datetime(2014,2,22,0)])
+        self.assertEqual(r.latestruns(3),[datetime(2014,2,22,0),datetime(2014,2,21,18),datetime(2014,2,21,12)])
+
+    def test_d_cached(self):
+        r = RunDiscovery('nam',self.url)
+        r.latestruns(2)
+        del self.server.requests[:]
+        r.latestruns(2)
+        self.assertEqual(self.server.requests,[],'Listings not cached')
+        r.refresh()
+        r.latestruns(1)
+        self.assertTrue(len(self.server.requests) > 0,'Refresh did not refetch')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from forecasting.schedule import Schedule
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.s = Schedule('nam', self.directory, lead=300, minpoll=30, maxpoll=600)
+        self.run = datetime(2014,2,22,18)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_unknown(self):
+        now = self.run + timedelta(hours=1)
+        self.assertEqual(self.s.expected(self.run), None)
+        self.assertEqual(self.s.nextpoll(self.run, now), now + timedelta(seconds=600))
+
+    def test_b_observe(self):
+        self.s.observe(self.run - timedelta(days=1), self.run - timedelta(days=1) + timedelta(hours=2))
+        self.s.observe(self.run - timedelta(days=2), self.run - timedelta(days=2) + timedelta(hours=1, minutes=50))
+        self.s.observe(self.run - timedelta(hours=6), self.run)
+        self.assertEqual(self.s.expected(self.run), self.run + timedelta(hours=1, minutes=50), 'Not the shortest delay of the cycle hour')
+
+        # sleep until shortly before, then poll often and back off
+        expected = self.run + timedelta(hours=1, minutes=50)
+        self.assertEqual(self.s.nextpoll(self.run, self.run), expected - timedelta(seconds=300))
+        now = expected - timedelta(seconds=300)
+        self.assertEqual(self.s.nextpoll(self.run, now), now + timedelta(seconds=30))
+        now = expected + timedelta(seconds=300)
+        self.assertEqual(self.s.nextpoll(self.run, now), now + timedelta(seconds=300))
+        now = expected + timedelta(hours=2)
+        self.assertEqual(self.s.nextpoll(self.run, now), now + timedelta(seconds=600))
+
+    def test_c_history(self):
+        self.s.history = 2
+        for hours in [1, 3, 4]:
+            self.s.observe(self.run, self.run + timedelta(hours=hours))
+        self.assertEqual(self.s.expected(self.run), self.run + timedelta(hours=3), 'Old observations kept')
+
+    def test_d_persist(self):
+        self.s.observe(self.run, self.run + timedelta(hours=2))
+        s = Schedule('nam', self.directory)
+        self.assertEqual(s.expected(self.run + timedelta(days=1)), self.run + timedelta(days=1, hours=2))
+        self.assertEqual(Schedule('rap', self.directory).expected(self.run), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from forecasting.scheduler import ModelTask, Scheduler
+
+class FakeModel:
+    baseurl = 'http://nomads.ncep.noaa.gov:9090/dods/nam/nam{date}/nam_{hour}z'
+
+    # transfers running at the same time, over every model
+    running = [0]
+    most = [0]
+    lock = threading.Lock()
+
+    def __init__(self, available, fail=False):
+        self.available = available
+        self.fail = fail
+        self.transfers = []
+
+    def getlatesttime(self):
+        return self.available[0]
+
+    def latestruns(self, n=1):
+        return self.available[:n]
+
+    def transfer(self, fields, datatime=None, geos=None, pressure=None):
+        with self.lock:
+            self.running[0] += 1
+            self.most[0] = max(self.most[0], self.running[0])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[0] -= 1
+            self.transfers.append(datatime)
+        if self.fail:
+            raise Exception('Datatime is not available on the remote server')
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = {'model': 'nam', 'fields': ['tmp2m'], 'modelint': 21600, 'poll': 600, 'schedule': {'directory': self.directory}}
+        self.run = datetime(2014,2,22,18)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_poll(self):
+        t = ModelTask(self.config, FakeModel([self.run]))
+        self.assertTrue(t.poll(), 'Available run not transferred')
+        self.assertEqual(t.transfer(), None)
+        self.assertEqual(t.latest, self.run + timedelta(hours=6))
+        self.assertTrue(t.due <= time.time(), 'Not looking again right after a transfer')
+        self.assertFalse(t.poll(), 'Run transferred before it is out')
+        self.assertTrue(t.due > time.time() + 500, 'Next poll not an interval away')
+
+    def test_b_giveup(self):
+        t = ModelTask(self.config, FakeModel([self.run], fail=True))
+        # 21600/600*2/3 tries
+        for i in range(24):
+            self.assertTrue(t.poll())
+            self.assertNotEqual(t.transfer(), None)
+        self.assertFalse(t.poll(), 'Failing run tried forever')
+        self.assertEqual((t.latest, t.ntries), (self.run + timedelta(hours=6), 0))
+
+    def test_c_step(self):
+        s = Scheduler()
+        t = ModelTask(self.config, FakeModel([self.run]))
+        s.add(t)
+        wait = s.step()
+        self.assertTrue(t.busy, 'Transfer not queued')
+        self.assertEqual(s.queue.get_nowait(), t)
+        self.assertEqual(wait, s.maxsleep, 'Busy model polled')
+
+    def test_d_shared(self):
+        # two models on the same server, with room for one transfer per server
+        s = Scheduler(maxtransfers=2, perhost=1)
+        FakeModel.most[0] = 0
+        models = [FakeModel([self.run]), FakeModel([self.run, self.run - timedelta(hours=6)])]
+        for i, m in enumerate(models):
+            s.add(ModelTask(dict(self.config, name='model%d' % i), m))
+        thread = threading.Thread(target=s.run)
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while time.time() < deadline and not all([len(m.transfers) > 0 for m in models]):
+                time.sleep(0.01)
+        finally:
+            s.stop()
+            thread.join()
+        self.assertEqual([m.transfers for m in models], [[self.run], [self.run]])
+        self.assertEqual(FakeModel.most[0], 1, 'Server limit not shared between models')
+        self.assertTrue(all([not t.busy for t in s.tasks]))
+
+    def test_e_schedule(self):
+        m = FakeModel([self.run])
+        t = ModelTask(self.config, m)
+        t.poll()
+        t.transfer()
+        # the next run isn't out yet, then shows up
+        self.assertFalse(t.poll())
+        m.available = [self.run + timedelta(hours=6)]
+        self.assertTrue(t.poll())
+        self.assertEqual(len(t.schedule.delays['00']), 1, 'Publication not observed')
+
+        # the same cycle hour of the next day is expected just as long after its datatime, the others aren't known
+        self.assertTrue(t.schedule.expected(self.run + timedelta(hours=30)) != None)
+        self.assertEqual(t.schedule.expected(self.run + timedelta(hours=12)), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from forecasting.slabcache import SlabCache
+
+class SlabCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SlabCache(self.directory, maxbytes=3000)
+        self.url = 'http://nomads.ncep.noaa.gov:9090/dods/nam/nam20140222/nam_18z'
+        self.index = (slice(0,2), slice(0,10,1), slice(5,15,1))
+        self.slab = np.arange(200, dtype='f4').reshape(2,10,10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_empty(self):
+        self.assertTrue(self.cache.load(self.url,'tmp2m','array',self.index) is None,'Empty cache returned a slab')
+
+    def test_b_roundtrip(self):
+        self.cache.save(self.url,'tmp2m','array',self.index,self.slab)
+        slab = self.cache.load(self.url,'tmp2m','array',self.index)
+        self.assertTrue(isinstance(slab,np.memmap),'Slab not memory-mapped')
+        self.assertTrue(np.all(slab == self.slab))
+
+    def test_c_keys(self):
+        self.cache.save(self.url,'tmp2m','array',self.index,self.slab)
+        self.assertTrue(self.cache.load(self.url,'tmpsfc','array',self.index) is None,'Fields share slabs')
+        self.assertTrue(self.cache.load(self.url,'tmp2m','array',(slice(0,2),slice(0,10,2),slice(5,15,1))) is None,'Hyperslabs share slabs')
+        self.assertTrue(self.cache.load(self.url.replace('18z','12z'),'tmp2m','array',self.index) is None,'Runs share slabs')
+
+    def test_d_evict(self):
+        # each slab takes a bit over 800 bytes, so only three fit
+        for i in range(3):
+            self.cache.save(self.url,'field%d' % i,'array',self.index,self.slab)
+            path = os.path.join(self.directory,self.cache.key(self.url,'field%d' % i,'array',self.index))
+            os.utime(path,(1000+i,1000+i))
+
+        # using the oldest slab makes the second one the least recently used
+        self.cache.load(self.url,'field0','array',self.index)
+        self.cache.save(self.url,'field3','array',self.index,self.slab)
+
+        self.assertTrue(self.cache.size() <= 3000,'Cache over its size')
+        self.assertTrue(self.cache.load(self.url,'field0','array',self.index) is not None,'Recently used slab evicted')
+        self.assertTrue(self.cache.load(self.url,'field1','array',self.index) is None,'Least recently used slab kept')
+        self.assertTrue(self.cache.load(self.url,'field3','array',self.index) is not None,'New slab evicted')
+
+    def test_e_clear(self):
+        self.cache.save(self.url,'tmp2m','array',self.index,self.slab)
+        self.cache.clear()
+        self.assertEqual(self.cache.size(),0,'Cache not empty')
+
+if __name__ == '__main__':
+    unittest.main()
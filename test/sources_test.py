@@ -0,0 +1,117 @@
+import unittest
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+
+from forecasting import grib
+from forecasting import util
+from forecasting.sources import FileSource, GribSource, OpendapSource
+from netcdf_test import writenetcdf
+from grib_test import grib2, serve, writegrib
+
+class SourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pattern = os.path.join(self.directory, 'nam{date}', 'nam_{hour}z.nc')
+        self.values = np.arange(2*3*3*4, dtype='f4').reshape((2, 3, 3, 4))
+        for run in ['nam20140222/nam_12z.nc', 'nam20140222/nam_18z.nc', 'nam20140221/nam_18z.nc']:
+            path = os.path.join(self.directory, run)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # latitudes north to south and levels in Pa from the top down, as some files have them
+            writenetcdf(path, [('time', 2), ('isobaric', 3), ('latitude', 3), ('longitude', 4)], [
+                ('time', ('time',), np.array([0., 3600.]), {'units': 'seconds since 2014-02-22 18:00:00'}),
+                ('isobaric', ('isobaric',), np.array([50000., 85000., 100000.]), {'units': 'Pa'}),
+                ('latitude', ('latitude',), np.array([12., 11., 10.]), {}),
+                ('longitude', ('longitude',), np.array([0., 90., 180., 270.]), {}),
+                ('TMP_isobaric', ('time', 'isobaric', 'latitude', 'longitude'), self.values, {'_FillValue': -1.}),
+            ])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_opendap(self):
+        s = OpendapSource('nam', 'http://localhost:8001/dods/')
+        self.assertEqual(s.location(datetime(2014, 2, 22, 6)), 'http://localhost:8001/dods/nam/nam20140222/nam_06z')
+        self.assertEqual(s.runs.timeurl, 'http://localhost:8001/dods/nam')
+
+    def test_b_runs(self):
+        s = FileSource('nam', self.pattern)
+        self.assertEqual(s.runs.days(), [20140221, 20140222])
+        self.assertEqual(s.runs.runs(20140222), [12, 18])
+        self.assertEqual(s.runs.latestruns(2), [datetime(2014, 2, 22, 18), datetime(2014, 2, 22, 12)])
+        self.assertTrue(s.available(s.location(datetime(2014, 2, 22, 18))))
+        self.assertFalse(s.available(s.location(datetime(2014, 2, 22, 6))))
+
+    def test_c_netcdf(self):
+        s = FileSource('nam', self.pattern, variables={'tmpprs': 'TMP_isobaric'})
+        grid = s.open(s.location(datetime(2014, 2, 22, 18)))['tmpprs']
+        self.assertEqual(grid.dimensions, ('time', 'lev', 'lat', 'lon'))
+        self.assertEqual(list(grid.lat), [10., 11., 12.])
+        self.assertEqual(list(grid.lev), [1000., 850., 500.])
+        self.assertEqual(list(grid.time), [735287.75, 735287.75 + 1./24])
+
+        # the same values as the file, with the latitudes and levels turned around
+        expected = self.values[:,::-1,::-1,:]
+        self.assertTrue(np.all(grid.array[:,0:3:2,0:2,1:3] == expected[:,0:3:2,0:2,1:3]))
+        self.assertTrue(np.all(grid.array[1,1,2,:] == expected[1,1,2,:]))
+
+    def test_d_missing(self):
+        self.values[0,0,0,0] = -1.
+        writenetcdf(self.pattern.format(date='20140222', hour='18'), [('time', 2), ('lev', 3), ('lat', 3), ('lon', 4)], [
+            ('time', ('time',), np.array([0., 1.]), {'units': 'hours since 2014-02-22 18:00'}),
+            ('tmpprs', ('time', 'lev', 'lat', 'lon'), self.values, {'_FillValue': -1.}),
+        ])
+        s = FileSource('nam', self.pattern)
+        grid = s.open(s.location(datetime(2014, 2, 22, 18)))['tmpprs']
+        self.assertEqual(grid.array[0,0,0,0], np.float32(grib.MISSING))
+        self.assertEqual(list(grid.lev), [0., 1., 2.], 'Axis without a variable not numbered')
+
+    def test_e_grib(self):
+        pattern = os.path.join(self.directory, 'gfs.{date}', 'gfs.t{hour}z.f{fhour}')
+        os.makedirs(os.path.join(self.directory, 'gfs.20140222'))
+        for fhour in [0, 3, 6]:
+            writegrib(pattern.format(date='20140222', hour='18', fhour='%03d' % fhour),
+                      [('TMP', '2 m above ground', np.ones((3, 4))*fhour, [10., 11., 12.], [0., 90., 180., 270.])], fhour=fhour)
+        s = FileSource('gfs', pattern)
+        self.assertEqual(s.format, 'grib')
+        self.assertEqual(s.runs.latestruns(1), [datetime(2014, 2, 22, 18)])
+        location = s.location(datetime(2014, 2, 22, 18))
+        self.assertEqual([fhour for fhour, path in s.files(location)], [0, 3, 6], 'Inventories taken for files')
+        self.assertTrue(np.allclose(s.open(location)['tmp2m'].array[:,1,1], [0., 3., 6.]))
+
+    def test_f_gribsource(self):
+        # the two latest cycles, the latest one still coming in
+        now = datetime.utcnow()
+        latest = now.replace(hour=now.hour - now.hour % 6, minute=0, second=0, microsecond=0)
+        files = {}
+        for run, fhours in [(latest - timedelta(hours=6), [0, 1, 2]), (latest, [0, 1])]:
+            for fhour in fhours:
+                data, inventory = grib2([('TMP', '2 m above ground', np.ones((3, 4))*fhour, [10., 11., 12.], [0., 90., 180., 270.]),
+                                         ('TMP', '850 mb', np.ones((3, 4))*fhour, [10., 11., 12.], [0., 90., 180., 270.])], fhour=fhour, run=run)
+                path = '/gfs.%s/gfs.t%sz.f%03d' % (run.strftime('%Y%m%d'), run.strftime('%H'), fhour)
+                files[path] = data
+                files[path + '.idx'] = inventory
+        server = serve(files)
+        try:
+            s = GribSource('gfs', server.url + '/gfs.{date}/gfs.t{hour}z.f{fhour:03d}', fhours=[0, 1, 2], connections=2)
+            self.assertEqual(s.runs.latestruns(1), [latest - timedelta(hours=6)], 'Incomplete run found')
+
+            del server.requests[:]
+            s.runs.latestruns(1)
+            self.assertEqual(server.requests, [], 'Runs asked for again')
+
+            location = s.location(latest - timedelta(hours=6))
+            self.assertEqual(location, server.url + '/gfs.%s/gfs.t%sz.f{fhour:03d}' % ((latest - timedelta(hours=6)).strftime('%Y%m%d'), (latest - timedelta(hours=6)).strftime('%H')))
+            ds = s.open(location)
+            self.assertEqual(ds['tmpprs'].shape, (3, 1, 3, 4))
+            self.assertTrue(np.allclose(ds['tmp2m'].array[:,2,3], [0., 1., 2.]))
+            self.assertTrue(all([byterange != None for path, byterange in server.requests if not path.endswith('.idx')]), 'Whole file downloaded')
+        finally:
+            util.configure()
+            server.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
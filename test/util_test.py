@@ -0,0 +1,107 @@
+import unittest
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from forecasting import util
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.ports.add(self.client_address[1])
+        self.server.requests.append(self.headers.get('if-none-match'))
+        if self.path.endswith('.dds') and self.headers.get('if-none-match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag','"v1"')
+            self.send_header('Content-Length','0')
+            self.end_headers()
+            return
+        if self.path.startswith('/error'):
+            body = 'Error {\n    code = 0;\n    message = "No such file";\n};'
+        else:
+            body = 'Dataset { Float32 tmp2m[time = 1]; } nam;'
+        self.send_response(200)
+        self.send_header('ETag','"v1"')
+        self.send_header('Content-Length',str(len(body)))
+        if self.path.startswith('/error'):
+            self.send_header('Content-Description','dods_error')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UtilTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.server = Server(('127.0.0.1',0),Handler)
+        self.server.ports = set()
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.cache = tempfile.mkdtemp()
+        self.settings = (util.POOLSIZE, util.CACHE)
+        util.configure(poolsize=1, cache=self.cache)
+
+    @classmethod
+    def tearDownClass(self):
+        util.configure(poolsize=self.settings[0], cache=self.settings[1])
+        self.server.shutdown()
+        shutil.rmtree(self.cache)
+
+    def test_a_keepalive(self):
+        self.server.ports.clear()
+        for i in range(5):
+            resp, data = util.request(self.url + '/nam/nam_00z.dods')
+            self.assertEqual(resp.status,200)
+        self.assertEqual(len(self.server.ports),1,'Connection not reused')
+
+    def test_b_conditional(self):
+        util.request(self.url + '/nam/nam_06z.dds')
+        resp, data = util.request(self.url + '/nam/nam_06z.dds')
+        self.assertEqual(self.server.requests[-1],'"v1"','Metadata not revalidated')
+        self.assertTrue(data.startswith('Dataset'),'Cached body not returned')
+
+    def test_c_error(self):
+        self.assertRaises(Exception,util.request,self.url + '/error.dds')
+
+    def test_d_threads(self):
+        util.configure(poolsize=3)
+        errors = []
+        def fetch():
+            try:
+                for i in range(10):
+                    util.request(self.url + '/nam/nam_12z.dods')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=fetch) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors,[])
+        self.assertTrue(util.pool().created <= 3,'Pool grew past its size')
+
+    def test_e_install(self):
+        import pydap.client
+        import pydap.util.http
+        util.uninstall()
+        original = pydap.client.request
+        self.assertFalse(original is util.request, 'pydap patched on import')
+        util.install()
+        util.install()
+        self.assertTrue(pydap.client.request is util.request and pydap.util.http.request is util.request)
+        util.uninstall()
+        self.assertTrue(pydap.client.request is original, 'pydap not put back')
+
+
+if __name__ == '__main__':
+    unittest.main()